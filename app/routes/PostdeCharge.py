@@ -5,23 +5,24 @@ import json
 from fastapi.responses import Response
 from fastapi import APIRouter, HTTPException, Request
 from datetime import datetime
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.ddl import apply_table_design
+from app.utils.checkpoint import retrieve_checkpoint, load_checkpoint, start_checkpoint, save_checkpoint, complete_checkpoint
+from app.utils.config import get_sync_setting
+from app.utils.retry import run_batch_with_retry, get_retry_counts, run_transaction_with_retry, is_retryable_error
+from app.utils.db import get_connection
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.utilisation import refresh_utilisation_days, refresh_utilisation, get_changed_days
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.dimkeys import add_dimension_keys, add_dimension_key_columns
+from app.utils.folders import run_folder_extraction, add_folder_column, get_folders, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
+# Columns the /sage readout can be filtered and paged on
+POSTEDECHARGE_READOUT = {"generated_dates": True, "filters": {"company": "company", "workstation": "poste"}, "folders": True}
 
 # Function to load the Madin Warehouse database connection configuration from a JSON file
 def load_madin_warehouse_db_config():
@@ -38,73 +39,79 @@ def load_sage_x3_db_config():
     return sagex3_db_config
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(readout=None):
     sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-             # Query for WORKSTATIO data
-            workstatio_query = """
-                SELECT WST_0 as poste, TWD_0 as [schema], WSTDES_0 as designationPoste, 
-                       LEGCPY_0 as company 
-                FROM SEED.WORKSTATIO 
-                INNER JOIN SEED.FACILITY ON FACILITY.FCY_0 = WCRFCY_0
-            """
-            workstatio_data = pd.read_sql(workstatio_query, cnxn)
-            
-            # Query for TABWEEDIA data
-            tabweedia_query = """
-                SELECT TWD_0 as [schema], DAYCAP_0 as Lundi, DAYCAP_1 as Mardi, 
-                       DAYCAP_2 as Mercredi, DAYCAP_3 as Jeudi, DAYCAP_4 as Vendredi, 
-                       DAYCAP_5 as Samedi, DAYCAP_6 as Dimanche
-                FROM SEED.TABWEEDIA
-            """
-            tabweedia_data = pd.read_sql(tabweedia_query, cnxn)
-            
-            # Merge the data on schema
-            merged_data = pd.merge(workstatio_data, tabweedia_data, on='schema')
+    try:
+         # Query for WORKSTATIO data
+        workstatio_query = """
+            SELECT WST_0 as poste, TWD_0 as [schema], WSTDES_0 as designationPoste, 
+                   LEGCPY_0 as company 
+            FROM SEED.WORKSTATIO 
+            INNER JOIN SEED.FACILITY ON FACILITY.FCY_0 = WCRFCY_0
+        """
+        params = None
+        folders = None
+        if readout is not None:
+            # Push the company and workstation filters down into the query
+            workstatio_query, params = apply_readout_filters(workstatio_query, POSTEDECHARGE_READOUT, readout)
+            folders = readout["folders"]
+        # Read the workstations and week schemas of each Sage X3 folder, in parallel
+        workstatio_data = run_folder_extraction(sagex3_db, workstatio_query, "WORKSTATIO extract", params=params, folders=folders)
+        
+        # Query for TABWEEDIA data
+        tabweedia_query = """
+            SELECT TWD_0 as [schema], DAYCAP_0 as Lundi, DAYCAP_1 as Mardi, 
+                   DAYCAP_2 as Mercredi, DAYCAP_3 as Jeudi, DAYCAP_4 as Vendredi, 
+                   DAYCAP_5 as Samedi, DAYCAP_6 as Dimanche
+            FROM SEED.TABWEEDIA
+        """
+        tabweedia_data = run_folder_extraction(sagex3_db, tabweedia_query, "TABWEEDIA extract", folders=folders)
+        
+        # Merge the data on schema, a workstation uses the week schemas of its own folder
+        merged_data = pd.merge(workstatio_data, tabweedia_data, on=['schema', FOLDER_COLUMN])
+        
+        start_date = datetime(2016, 1, 1)
+        end_date = datetime.today()
+        if readout is not None:
+            # Only generate the calendar days of the requested range
+            if readout["date_from"]:
+                start_date = max(start_date, datetime.combine(readout["date_from"], datetime.min.time()))
+            if readout["date_to"]:
+                end_date = min(end_date, datetime.combine(readout["date_to"], datetime.min.time()))
+        date_range = pd.date_range(start_date, end_date)
+        
+        final_data = pd.DataFrame()
+        
+        for _, row in merged_data.iterrows():
+            temp_df = pd.DataFrame(date_range, columns=['dateschema'])
+            temp_df['poste'] = row['poste']
+            temp_df['schema'] = row['schema']
+            temp_df['designationPoste'] = row['designationPoste']
+            temp_df['company'] = row['company']
+            temp_df['dossier'] = row['dossier']
+            temp_df['day_of_week'] = temp_df['dateschema'].dt.day_name()
             
-            start_date = datetime(2016, 1, 1)
-            end_date = datetime.today()
-            date_range = pd.date_range(start_date, end_date)
+            day_cap_mapping = {
+                'Monday': row['Lundi'],
+                'Tuesday': row['Mardi'],
+                'Wednesday': row['Mercredi'],
+                'Thursday': row['Jeudi'],
+                'Friday': row['Vendredi'],
+                'Saturday': row['Samedi'],
+                'Sunday': row['Dimanche']
+            }
             
-            final_data = pd.DataFrame()
+            temp_df['tempstheorique'] = temp_df['day_of_week'].map(day_cap_mapping)
+            final_data = pd.concat([final_data, temp_df], ignore_index=True)
             
-            for _, row in merged_data.iterrows():
-                temp_df = pd.DataFrame(date_range, columns=['dateschema'])
-                temp_df['poste'] = row['poste']
-                temp_df['schema'] = row['schema']
-                temp_df['designationPoste'] = row['designationPoste']
-                temp_df['company'] = row['company']
-                temp_df['day_of_week'] = temp_df['dateschema'].dt.day_name()
-                
-                day_cap_mapping = {
-                    'Monday': row['Lundi'],
-                    'Tuesday': row['Mardi'],
-                    'Wednesday': row['Mercredi'],
-                    'Thursday': row['Jeudi'],
-                    'Friday': row['Vendredi'],
-                    'Saturday': row['Samedi'],
-                    'Sunday': row['Dimanche']
-                }
-                
-                temp_df['tempstheorique'] = temp_df['day_of_week'].map(day_cap_mapping)
-                final_data = pd.concat([final_data, temp_df], ignore_index=True)
-                
-            final_data = final_data[['poste', 'schema', 'designationPoste', 'company', 'dateschema', 'tempstheorique']]
-            print("Retrieved Data Type:", type(final_data))  # Debugging line
-            print("Retrieved Data Head:\n", final_data.head())  # Debugging line
-            return final_data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+        final_data = final_data[['poste', 'schema', 'designationPoste', 'company', 'dateschema', 'tempstheorique', 'dossier']]
+        print("Retrieved Data Type:", type(final_data))  # Debugging line
+        print("Retrieved Data Head:\n", final_data.head())  # Debugging line
+        return final_data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
-    
+
 # Function to create POSTEDECHARGE table in Madin Warehouse
 def create_POSTEDECHARGE_table(db_config):
     try:
@@ -116,6 +123,13 @@ def create_POSTEDECHARGE_table(db_config):
             table_exists = cursor.tables(table='POSTEDECHARGE', tableType='TABLE').fetchone()
             if table_exists:
                 print("POSTEDECHARGE table already exists.")
+                # Integer date, workstation and company keys, filled for the rows already loaded
+                add_dimension_key_columns(cursor, "POSTEDECHARGE")
+                # Tables created before multi-folder support get the folder column (part of the clustered key)
+                add_folder_column(cursor, "POSTEDECHARGE")
+                # Create the clustered key and indexes on an existing table in place
+                apply_table_design(cursor, "POSTEDECHARGE")
+                cnxn.commit()
                 return "exists"
             else:
                 # SQL query to create POSTEDECHARGE table
@@ -126,11 +140,16 @@ def create_POSTEDECHARGE_table(db_config):
                 designationPoste VARCHAR(255),
                 company VARCHAR(50),
                 dateschema DATE,
-                tempstheorique FLOAT
+                tempstheorique FLOAT,
+                dossier VARCHAR(50),
+                DateKey INT,
+                workstationKey INT,
+                companyKey INT
             );
                 """
                 # Execute the query
                 cursor.execute(create_table_query)
+                apply_table_design(cursor, "POSTEDECHARGE")
                 # Commit changes
                 cnxn.commit()
                 print("POSTEDECHARGE table created successfully.")
@@ -155,34 +174,42 @@ def insert_data_into_POSTEDECHARGE(data, clear_table=False, batch_size=1000):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-            rows_inserted = 0
-            
             if clear_table:
-                cursor.execute("TRUNCATE TABLE POSTEDECHARGE")
-                cnxn.commit()
+                cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, lambda cursor: cursor.execute("TRUNCATE TABLE POSTEDECHARGE"), "POSTEDECHARGE insert")
             
             # Sort the data to ensure it is inserted in an organized manner
-            data_sorted = data[['poste', 'schema', 'designationPoste', 'company', 'dateschema', 'tempstheorique']].drop_duplicates()
+            data_sorted = data[['poste', 'schema', 'designationPoste', 'company', 'dateschema', 'tempstheorique', 'dossier']].drop_duplicates()
             data_sorted['dateschema'] = pd.to_datetime(data_sorted['dateschema'])  # Ensure dates are in datetime format
-            data_sorted = data_sorted.sort_values(by=['poste', 'schema', 'dateschema'])
+            data_sorted = data_sorted.sort_values(by=['dossier', 'poste', 'schema', 'dateschema'])
+            # Integer date, workstation and company keys, looked up once for all the batches
+            data_sorted = add_dimension_keys(data_sorted, "POSTEDECHARGE")
 
             insert_query = """
-                INSERT INTO POSTEDECHARGE (poste, [schema], designationPoste, company, dateschema, tempstheorique)
-                VALUES (?, ?, ?, ?, ?, ?)
+                INSERT INTO POSTEDECHARGE (poste, [schema], designationPoste, company, dateschema, tempstheorique, dossier, DateKey, workstationKey, companyKey)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """
-            
-            # Insert in batches
-            for start in range(0, len(data_sorted), batch_size):
-                batch = data_sorted.iloc[start:start + batch_size]
-                try:
-                    cursor.executemany(insert_query, batch.values.tolist())
-                    rows_inserted += len(batch)
-                except pyodbc.Error as db_err:
-                    print(f"Database error on batch starting at row {start}: {db_err}")
-                    print(batch)
-            
-            cnxn.commit()
+
+            def insert_rows(cursor):
+                rows_inserted = 0
+                # Insert in batches
+                for start in range(0, len(data_sorted), batch_size):
+                    batch = data_sorted.iloc[start:start + batch_size]
+                    try:
+                        cursor.executemany(insert_query, batch.values.tolist())
+                        rows_inserted += len(batch)
+                    except pyodbc.Error as db_err:
+                        # A transient error aborts the transaction, it is replayed as a whole
+                        if is_retryable_error(db_err):
+                            raise
+                        print(f"Database error on batch starting at row {start}: {db_err}")
+                        print(batch)
+
+                # Recompute the workstation utilisation of the loaded capacity days
+                refresh_utilisation_days(cursor, data_sorted['dateschema'].unique())
+                return rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, rows_inserted = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "POSTEDECHARGE insert")
             
             if rows_inserted == 0:
                 print("No rows were inserted.")
@@ -215,64 +242,133 @@ def sync_data_with_POSTEDECHARGE(data, batch_size=1000):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-
-            # Create a temporary table
-            cursor.execute("""
-                IF OBJECT_ID('tempdb..#TempPosteDeCharge') IS NOT NULL
-                    DROP TABLE #TempPosteDeCharge;
-                
-                CREATE TABLE #TempPosteDeCharge (
-                    poste NVARCHAR(255),
-                    [schema] NVARCHAR(255),
-                    designationPoste NVARCHAR(255),
-                    company NVARCHAR(255),
-                    dateschema DATE,
-                    tempstheorique NVARCHAR(255)
-                )
-            """)
-            cnxn.commit()
-
-            # Insert data into the temporary table in batches
-            data_sorted = data[['poste', 'schema', 'designationPoste', 'company', 'dateschema', 'tempstheorique']].drop_duplicates()
+            def start_sync(cursor):
+                # Create a temporary table
+                cursor.execute("""
+                    IF OBJECT_ID('tempdb..#TempPosteDeCharge') IS NOT NULL
+                        DROP TABLE #TempPosteDeCharge;
+                    
+                    CREATE TABLE #TempPosteDeCharge (
+                        poste NVARCHAR(255),
+                        [schema] NVARCHAR(255),
+                        designationPoste NVARCHAR(255),
+                        company NVARCHAR(255),
+                        dateschema DATE,
+                        tempstheorique NVARCHAR(255),
+                        dossier VARCHAR(50),
+                        DateKey INT,
+                        workstationKey INT,
+                        companyKey INT
+                    )
+                """)
+                checkpoint = load_checkpoint(cursor, "POSTEDECHARGE")
+                if checkpoint is None:
+                    start_checkpoint(cursor, "POSTEDECHARGE")
+                return checkpoint
+
+            cnxn, checkpoint = run_transaction_with_retry(cnxn, madin_warehouse_db, start_sync, "POSTEDECHARGE sync")
+
+            # Sort the data so that batches follow the (dossier, poste, schema, dateschema) key
+            data_sorted = data[['poste', 'schema', 'designationPoste', 'company', 'dateschema', 'tempstheorique', 'dossier']].drop_duplicates()
             data_sorted['dateschema'] = pd.to_datetime(data_sorted['dateschema'])
-            data_sorted = data_sorted.sort_values(by=['poste', 'schema', 'dateschema'])
+            data_sorted = data_sorted.sort_values(by=['dossier', 'poste', 'schema', 'dateschema'])
+
+            if checkpoint is not None and checkpoint["last_key"] is not None:
+                # Skip the rows already merged by the interrupted sync
+                last_key = checkpoint["last_key"].split("|")
+                if len(last_key) == 3:
+                    # Keys saved before multi-folder support belong to the first folder
+                    last_key = [get_folders()[0]["name"]] + last_key
+                last_dossier, last_poste, last_schema, last_date = last_key
+                last_date = pd.Timestamp(last_date)
+                same_dossier = data_sorted['dossier'] == last_dossier
+                already_merged = (data_sorted['dossier'] < last_dossier) | \
+                    (same_dossier & (data_sorted['poste'] < last_poste)) | \
+                    (same_dossier & (data_sorted['poste'] == last_poste) & (data_sorted['schema'] < last_schema)) | \
+                    (same_dossier & (data_sorted['poste'] == last_poste) & (data_sorted['schema'] == last_schema) & (data_sorted['dateschema'] <= last_date))
+                data_sorted = data_sorted[~already_merged]
+                print(f"Resuming POSTEDECHARGE sync after {checkpoint['last_key']}.")
+            rows_merged = checkpoint["rows_loaded"] if checkpoint is not None else 0
+            # Integer date, workstation and company keys, looked up once for all the batches
+            data_sorted = add_dimension_keys(data_sorted, "POSTEDECHARGE")
 
             insert_temp_query = """
-                INSERT INTO #TempPosteDeCharge (poste, [schema], designationPoste, company, dateschema, tempstheorique)
-                VALUES (?, ?, ?, ?, ?, ?)
+                INSERT INTO #TempPosteDeCharge (poste, [schema], designationPoste, company, dateschema, tempstheorique, dossier, DateKey, workstationKey, companyKey)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """
-            
-            for start in range(0, len(data_sorted), batch_size):
-                batch = data_sorted.iloc[start:start + batch_size]
-                cursor.executemany(insert_temp_query, batch.values.tolist())
-            cnxn.commit()
 
             # Update existing rows and insert new rows
             update_query = """
                 UPDATE p
                 SET p.designationPoste = t.designationPoste,
                     p.company = t.company,
-                    p.tempstheorique = t.tempstheorique
+                    p.tempstheorique = t.tempstheorique,
+                    p.DateKey = t.DateKey,
+                    p.workstationKey = t.workstationKey,
+                    p.companyKey = t.companyKey
                 FROM POSTEDECHARGE p
                 INNER JOIN #TempPosteDeCharge t
-                ON p.poste = t.poste AND p.[schema] = t.[schema] AND p.dateschema = t.dateschema
+                ON p.poste = t.poste AND p.[schema] = t.[schema] AND p.dateschema = t.dateschema AND p.dossier = t.dossier
             """
-            cursor.execute(update_query)
-            cnxn.commit()
-            rows_updated = cursor.rowcount
 
             insert_query = """
-                INSERT INTO POSTEDECHARGE (poste, [schema], designationPoste, company, dateschema, tempstheorique)
-                SELECT t.poste, t.[schema], t.designationPoste, t.company, t.dateschema, t.tempstheorique
+                INSERT INTO POSTEDECHARGE (poste, [schema], designationPoste, company, dateschema, tempstheorique, dossier, DateKey, workstationKey, companyKey)
+                SELECT t.poste, t.[schema], t.designationPoste, t.company, t.dateschema, t.tempstheorique, t.dossier, t.DateKey, t.workstationKey, t.companyKey
                 FROM #TempPosteDeCharge t
                 LEFT JOIN POSTEDECHARGE p
-                ON t.poste = p.poste AND t.[schema] = p.[schema] AND t.dateschema = p.dateschema
+                ON t.poste = p.poste AND t.[schema] = p.[schema] AND t.dateschema = p.dateschema AND t.dossier = p.dossier
                 WHERE p.poste IS NULL
             """
-            cursor.execute(insert_query)
-            cnxn.commit()
-            rows_inserted = cursor.rowcount
+
+            # Merge the data by checkpointed batches, each committed with its last key
+            merge_counts = {"rows_updated": 0, "rows_inserted": 0}
+            checkpoint_batch_size = get_sync_setting("checkpoint", "batch_size", 5000)
+            for merge_start in range(0, len(data_sorted), checkpoint_batch_size):
+                merge_batch = data_sorted.iloc[merge_start:merge_start + checkpoint_batch_size]
+                last_row = merge_batch.iloc[-1]
+                rows_merged += len(merge_batch)
+
+                def merge_batch_into_POSTEDECHARGE(batch_cnxn, merge_batch=merge_batch, last_row=last_row, rows_merged=rows_merged):
+                    batch_cursor = batch_cnxn.cursor()
+                    # The temporary table is recreated when the batch runs on a new connection
+                    batch_cursor.execute("""
+                        IF OBJECT_ID('tempdb..#TempPosteDeCharge') IS NULL
+                            CREATE TABLE #TempPosteDeCharge (
+                                poste NVARCHAR(255),
+                                [schema] NVARCHAR(255),
+                                designationPoste NVARCHAR(255),
+                                company NVARCHAR(255),
+                                dateschema DATE,
+                                tempstheorique NVARCHAR(255),
+                                dossier VARCHAR(50),
+                                DateKey INT,
+                                workstationKey INT,
+                                companyKey INT
+                            )
+                    """)
+                    batch_cursor.execute("TRUNCATE TABLE #TempPosteDeCharge")
+                    for start in range(0, len(merge_batch), batch_size):
+                        batch = merge_batch.iloc[start:start + batch_size]
+                        batch_cursor.executemany(insert_temp_query, batch.values.tolist())
+
+                    batch_cursor.execute(update_query)
+                    rows_updated = batch_cursor.rowcount
+                    batch_cursor.execute(insert_query)
+                    rows_inserted = batch_cursor.rowcount
+
+                    save_checkpoint(batch_cursor, "POSTEDECHARGE", f"{last_row['dossier']}|{last_row['poste']}|{last_row['schema']}|{last_row['dateschema'].date().isoformat()}", rows_merged)
+                    batch_cnxn.commit()
+                    merge_counts["rows_updated"] += rows_updated
+                    merge_counts["rows_inserted"] += rows_inserted
+
+                # Replay only this batch after a deadlock, lock timeout or dropped connection
+                cnxn = run_batch_with_retry(cnxn, madin_warehouse_db, merge_batch_into_POSTEDECHARGE, "POSTEDECHARGE sync")
+
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, lambda cursor: complete_checkpoint(cursor, "POSTEDECHARGE"), "POSTEDECHARGE sync")
+            rows_updated = merge_counts["rows_updated"]
+            rows_inserted = merge_counts["rows_inserted"]
+            retries = get_retry_counts().get("POSTEDECHARGE sync", 0)
+            print(f"{retries} batch retries on POSTEDECHARGE sync since startup.")
 
             print(f"{rows_updated} rows updated and {rows_inserted} rows inserted into POSTEDECHARGE table.")
             return True
@@ -302,7 +398,7 @@ def retrieve_data_from_postedecharge():
     if cnxn:
         try:
             query = """
-                SELECT poste, [schema], designationPoste, company, dateschema, tempstheorique
+                SELECT poste, [schema], designationPoste, company, dateschema, tempstheorique, dossier
                 FROM POSTEDECHARGE
             """
             data = pd.read_sql(query, cnxn)
@@ -324,8 +420,17 @@ def synchronize_data():
         print("Failed to retrieve data from source database.")
         return False
 
+    # An interrupted sync is resumed directly, the merge skips the rows already committed
+    if retrieve_checkpoint("POSTEDECHARGE") is not None:
+        sync_result = sync_data_with_POSTEDECHARGE(source_data)
+        if sync_result:
+            save_snapshot("POSTEDECHARGE", source_data)
+            # The rows merged before the interruption are unknown, every capacity day is recomputed
+            sync_result = refresh_utilisation(source_data['dateschema'])
+        return sync_result
+
     # Retrieve data from the target database
-    target_data = retrieve_data_from_postedecharge()
+    target_data = load_target_state("POSTEDECHARGE", retrieve_data_from_postedecharge)
     if target_data is None:
         print("Failed to retrieve data from target database.")
         return False
@@ -337,7 +442,14 @@ def synchronize_data():
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
         # Synchronize data by inserting into the target database
-        return sync_data_with_POSTEDECHARGE(source_data)
+        changed_days = get_changed_days(source_data, target_data, 'dateschema')
+        sync_result = sync_data_with_POSTEDECHARGE(source_data)
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("POSTEDECHARGE", source_data)
+            # The merge commits by batches, the utilisation of the changed capacity days is recomputed after it
+            sync_result = refresh_utilisation(changed_days)
+        return sync_result
 
 
 
@@ -348,15 +460,23 @@ def synchronize_data():
 
 @router.get("/sage/POSTEDECHARGE")
 async def retrieve_data_from_sage_post(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, POSTEDECHARGE_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage post.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, POSTEDECHARGE_READOUT, readout)})
     
 @router.post("/madin/warehouse/create-table-POSTEDECHARGE")
 async def create_POSTEDECHARGE_table_handler(request: Request):
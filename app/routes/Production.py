@@ -4,23 +4,21 @@ import os
 import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.db import get_connection
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, scope_unique_key_to_folder, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
+# Columns the /sage readout can be filtered and paged on
+PRODUCTION_READOUT = {"date": "daterealisation", "filters": {"company": "company", "item": "codearticle"}, "folders": True,
+                      "columns": ["numerosuivi", "codearticle", "company", "quantiterealise", "daterealisation"]}
 
 # Function to load the Madin Warehouse database connection configuration from a JSON file
 def load_madin_warehouse_db_config():
@@ -53,7 +51,8 @@ def create_PRODUCTION_table(db_config):
                     company NVARCHAR(255) NOT NULL,
                     quantiterealise FLOAT NOT NULL,
                     daterealisation DATETIME NOT NULL,
-                    UNIQUE(numerosuivi)
+                    dossier VARCHAR(50) NOT NULL,
+                    UNIQUE(numerosuivi, dossier)
                 )
                 """
                 # Execute the query
@@ -63,6 +62,11 @@ def create_PRODUCTION_table(db_config):
                 print("PRODUCTION table created successfully.")
             else:
                 print("PRODUCTION table already exists.")
+            # Tables created before multi-folder support get the folder column, and a tracking number
+            # is unique within a folder instead of across all of them
+            add_folder_column(cursor, "PRODUCTION")
+            scope_unique_key_to_folder(cursor, "PRODUCTION", "numerosuivi")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -75,22 +79,22 @@ def create_PRODUCTION_table(db_config):
             cnxn.close()
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(readout=None):
     sagex3_db = load_sage_x3_db_config()
     # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "select MFGTRKNUM_0 as numerosuivi ,ITMREF_0 as codearticle ,LEGCPY_0 as company ,CPLQTY_0 as quantiterealise,IPTDAT_0 as daterealisation from [x3v12src].[SEED].[MFGITMTRK] inner join [x3v12src].[SEED].[FACILITY] on FACILITY .FCY_0 =MFGFCY_0"
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = "select MFGTRKNUM_0 as numerosuivi ,ITMREF_0 as codearticle ,LEGCPY_0 as company ,CPLQTY_0 as quantiterealise,IPTDAT_0 as daterealisation from [x3v12src].[SEED].[MFGITMTRK] inner join [x3v12src].[SEED].[FACILITY] on FACILITY .FCY_0 =MFGFCY_0"
+        params = None
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, PRODUCTION_READOUT, readout)
+            folders = readout["folders"]
+        # Read the production tracking lines of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "PRODUCTION extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
 
 # Function to insert data into PRODUCTION table in Madina Warehouse
@@ -101,19 +105,30 @@ def insert_data_into_PRODUCTION(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-            
-            rows_inserted = 0
-            for row in data:
-                # Check if the tracking number already exists in the table
-                cursor.execute("SELECT COUNT(1) FROM PRODUCTION WHERE numerosuivi = ?", (row[0],))
-                exists = cursor.fetchone()[0]
-                if not exists:
-                    cursor.execute("INSERT INTO PRODUCTION (numerosuivi, codearticle, company, quantiterealise, daterealisation) VALUES (?, ?, ?, ?, ?)",
-                                   (row[0], row[1], row[2], row[3], row[4]))
-                    rows_inserted += 1
+            def insert_rows(cursor):
+                rows_inserted = 0
+                key_indexes = []
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    # Find the tracking numbers not yet present in this folder of the PRODUCTION table
+                    key_index = load_key_index(cursor, "PRODUCTION", "numerosuivi", key_type="str", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
 
-            cnxn.commit()
+                    inserted_keys = set()
+                    for row in folder_rows:
+                        if str(row[0]) in new_keys and str(row[0]) not in inserted_keys:
+                            cursor.execute("INSERT INTO PRODUCTION (numerosuivi, codearticle, company, quantiterealise, daterealisation, dossier) VALUES (?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2], row[3], row[4], row[5]))
+                            inserted_keys.add(str(row[0]))
+                    key_index.add(inserted_keys, len(inserted_keys))
+                    key_indexes.append(key_index)
+                    rows_inserted += len(inserted_keys)
+
+                return key_indexes, rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "PRODUCTION insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             return rows_inserted
         except pyodbc.Error as db_err:
@@ -137,43 +152,45 @@ def insert_data_into_PRODUCTION_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def synchronize_rows(cursor):
+                rows_inserted = 0
+                rows_updated = 0
 
-            rows_inserted = 0
-            rows_updated = 0
+                 # Iterate over the data and perform upsert
+                for row in data:
+                    # Check if the row exists in the target table
+                    cursor.execute("""
+                        SELECT COUNT(*) FROM PRODUCTION WHERE numerosuivi = ? AND dossier = ?
+                    """, (row[0], row[5]))
+                    exists = cursor.fetchone()[0]
 
-             # Iterate over the data and perform upsert
-            for row in data:
-                # Check if the row exists in the target table
-                cursor.execute("""
-                    SELECT COUNT(*) FROM PRODUCTION WHERE numerosuivi = ?
-                """, (row[0],))
-                exists = cursor.fetchone()[0]
+                    # Perform the upsert
 
-                # Perform the upsert
-                
-                cursor.execute("""
-                    MERGE INTO PRODUCTION AS target
-                    USING (VALUES (?, ?, ?, ?, ?)) AS source (numerosuivi, codearticle, company, quantiterealise, daterealisation)
-                    ON target.numerosuivi = source.numerosuivi
-                    WHEN MATCHED THEN
-                        UPDATE SET
-                            codearticle = source.codearticle,
-                            company = source.company,
-                            quantiterealise = source.quantiterealise,
-                            daterealisation = source.daterealisation
-                    WHEN NOT MATCHED BY TARGET THEN
-                        INSERT (numerosuivi, codearticle, company, quantiterealise, daterealisation)
-                        VALUES (source.numerosuivi, source.codearticle, source.company, source.quantiterealise, source.daterealisation);
-                """, (row[0], row[1], row[2], row[3], row[4]))
+                    cursor.execute("""
+                        MERGE INTO PRODUCTION AS target
+                        USING (VALUES (?, ?, ?, ?, ?, ?)) AS source (numerosuivi, codearticle, company, quantiterealise, daterealisation, dossier)
+                        ON target.numerosuivi = source.numerosuivi AND target.dossier = source.dossier
+                        WHEN MATCHED THEN
+                            UPDATE SET
+                                codearticle = source.codearticle,
+                                company = source.company,
+                                quantiterealise = source.quantiterealise,
+                                daterealisation = source.daterealisation
+                        WHEN NOT MATCHED BY TARGET THEN
+                            INSERT (numerosuivi, codearticle, company, quantiterealise, daterealisation, dossier)
+                            VALUES (source.numerosuivi, source.codearticle, source.company, source.quantiterealise, source.daterealisation, source.dossier);
+                    """, (row[0], row[1], row[2], row[3], row[4], row[5]))
 
-                # Update the counters based on existence
-                if exists:
-                    rows_updated += 1
-                else:
-                    rows_inserted += 1
+                    # Update the counters based on existence
+                    if exists:
+                        rows_updated += 1
+                    else:
+                        rows_inserted += 1
 
-            cnxn.commit()
+                return rows_inserted, rows_updated
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (rows_inserted, rows_updated) = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "PRODUCTION sync")
             print(f"Data synchronized successfully. Rows inserted: {rows_inserted}, Rows updated: {rows_updated}")
             return {"rows_inserted": rows_inserted, "rows_updated": rows_updated}
         
@@ -196,7 +213,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT numerosuivi, codearticle, company, quantiterealise, daterealisation FROM PRODUCTION"
+            source_query = "SELECT numerosuivi, codearticle, company, quantiterealise, daterealisation, dossier FROM PRODUCTION"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -214,7 +231,7 @@ def synchronize_data():
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("PRODUCTION", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -223,7 +240,12 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_PRODUCTION_sync(source_data.values.tolist())
+        sync_result = insert_data_into_PRODUCTION_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("PRODUCTION", source_data)
+            invalidate_key_index("PRODUCTION")
+        return sync_result
 
 @router.post("/madin/warehouse/insert-data-production")
 async def insert_data_into_PRODUCTION_handler(request: Request):
@@ -244,15 +266,23 @@ async def insert_data_into_PRODUCTION_handler(request: Request):
 
 @router.get("/sage/production")
 async def retrieve_data_from_sage_production(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, PRODUCTION_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage production.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, PRODUCTION_READOUT, readout)})
 
 @router.post("/madin/warehouse/create-table-production")
 async def create_production_table_handler(request: Request):
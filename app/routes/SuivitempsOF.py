@@ -4,23 +4,23 @@ import os
 import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.db import get_connection
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.utilisation import refresh_utilisation_days, get_changed_days
+from app.utils.timetracking import retrieve_time_tracking_from_sagex3, split_time_tracking_by_table
+from app.utils.dimkeys import load_dimension_keys, append_dimension_keys, add_dimension_key_columns
+from app.utils.folders import add_folder_column, scope_unique_key_to_folder, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
+# Columns of the extracted rows, in the order they are written
+SUIVITEMPSOF_COLUMNS = ["numerosuivi", "company", "quantite", "quantiterejet", "posterealise", "morealise",
+                        "tempsreglage", "tempsopérealise", "message", "dateimputation", "Time_type", "Time_unit", "dossier"]
 
 # Function to load the Madin Warehouse database connection configuration from a JSON file
 def load_madin_warehouse_db_config():
@@ -38,22 +38,11 @@ def load_sage_x3_db_config():
 
 # Function to retrieve data from Sage X3
 def retrieve_data_from_sagex3():
-    sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "SELECT MFGTRKNUM_0 AS numerosuivi, LEGCPY_0 AS company, CPLQTY_0 AS quantite, REJCPLQTY_0 AS quantiterejet, CPLWST_0 AS posterealise, CPLLAB_0 AS morealise, CASE WHEN TIMUOMCOD_0 = 2 THEN CPLSETTIM_0 / 60.0 ELSE CPLSETTIM_0 END AS tempsreglage, CASE WHEN TIMUOMCOD_0 = 2 THEN CPLOPETIM_0 / 60.0 ELSE CPLOPETIM_0 END AS tempsopérealise, MSGNUM_0 AS message, IPTDAT_0 AS dateimputation, TIMTYP_0 AS Time_type, TIMUOMCOD_0 AS Time_unit FROM SEED.MFGOPETRK INNER JOIN SEED.FACILITY ON FACILITY.FCY_0 = MFGFCY_0 WHERE TIMTYP_0 = 1"
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    # MFGOPETRK is read once for all time types, only the lines of this table are kept
+    data = retrieve_time_tracking_from_sagex3()
+    if data is None:
         return None
+    return split_time_tracking_by_table(data)["SUIVITEMPSOF"]
 
 # Function to create SUIVITEMPSOF table in Madin Warehouse
 def create_SUIVITEMPSOF_table(db_config):
@@ -67,7 +56,7 @@ def create_SUIVITEMPSOF_table(db_config):
                 # SQL query to create SUIVITEMPSOF table
                 create_table_query = """
                 CREATE TABLE SUIVITEMPSOF (
-                    numerosuivi VARCHAR(50) PRIMARY KEY,
+                    numerosuivi VARCHAR(50) NOT NULL,
                     company VARCHAR(50),
                     quantite FLOAT,
                     quantiterejet FLOAT,
@@ -78,7 +67,12 @@ def create_SUIVITEMPSOF_table(db_config):
                     message INT,
                     dateimputation DATETIME,
                     Time_type INT,
-                    Time_unit INT
+                    Time_unit INT,
+                    DateKey INT,
+                    workstationKey INT,
+                    companyKey INT,
+                    dossier VARCHAR(50) NOT NULL,
+                    PRIMARY KEY (numerosuivi, dossier)
                 )
                 """
                 # Execute the query
@@ -89,6 +83,13 @@ def create_SUIVITEMPSOF_table(db_config):
                 return {"status": "created", "message": "SUIVITEMPSOF table created successfully."}
             else:
                 print("SUIVITEMPSOF table already exists.")
+                # Integer date, workstation and company keys, filled for the rows already loaded
+                add_dimension_key_columns(cursor, "SUIVITEMPSOF")
+                # Tables created before multi-folder support get the folder column, and a tracking
+                # number is unique within a folder instead of across all of them
+                add_folder_column(cursor, "SUIVITEMPSOF")
+                scope_unique_key_to_folder(cursor, "SUIVITEMPSOF", "numerosuivi")
+                cnxn.commit()
                 return {"status": "exists", "message": "SUIVITEMPSOF table already exists."}
         else:
             print("Failed to connect to the database.")
@@ -108,30 +109,51 @@ def insert_data_into_SUIVITEMPSOF(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-            
-            rows_inserted = 0
-            for row in data:
-                print(f"Inserting row: {row}")  # Debugging line to check the row data
-                # Check if the tracking number already exists in the table
-                cursor.execute("SELECT COUNT(1) FROM SUIVITEMPSOF WHERE numerosuivi = ?", (row[0],))
-                exists = cursor.fetchone()[0]
-                if not exists:
-                    # Insert into SUIVITEMPSOF table
-                    cursor.execute("""
-                        INSERT INTO SUIVITEMPSOF (
-                            numerosuivi, company, quantite, quantiterejet, posterealise, 
-                            morealise, tempsreglage, tempsopérealise, message, dateimputation,Time_type, Time_unit
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        row[0], row[1], row[2], row[3], 
-                        row[4], row[5], row[6], row[7], 
-                        row[8], row[9], row[10], row[11]
-                    ))
-                    rows_inserted += 1
+            # The date, workstation and company keys are appended once, outside the replayed transaction
+            data = append_dimension_keys(data, SUIVITEMPSOF_COLUMNS, "SUIVITEMPSOF", load_dimension_keys())
+
+            def insert_rows(cursor):
+                rows_inserted = 0
+                key_indexes = []
+                inserted_dates = []
+                # The folder is the last extracted column, before the appended dimension keys
+                rows_by_folder = {}
+                for row in data:
+                    rows_by_folder.setdefault(row[12], []).append(row)
+                for folder_name, folder_rows in rows_by_folder.items():
+                    # Find the tracking numbers not yet present in this folder of the SUIVITEMPSOF table
+                    key_index = load_key_index(cursor, "SUIVITEMPSOF", "numerosuivi", key_type="str", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
+                    inserted_keys = set()
+                    for row in folder_rows:
+                        print(f"Inserting row: {row}")  # Debugging line to check the row data
+                        if str(row[0]) in new_keys and str(row[0]) not in inserted_keys:
+                            # Insert into SUIVITEMPSOF table
+                            cursor.execute("""
+                                INSERT INTO SUIVITEMPSOF (
+                                    numerosuivi, company, quantite, quantiterejet, posterealise, 
+                                    morealise, tempsreglage, tempsopérealise, message, dateimputation,Time_type, Time_unit,
+                                    dossier, DateKey, workstationKey, companyKey
+                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            """, (
+                                row[0], row[1], row[2], row[3], 
+                                row[4], row[5], row[6], row[7], 
+                                row[8], row[9], row[10], row[11],
+                                row[12], row[13], row[14], row[15]
+                            ))
+                            inserted_keys.add(str(row[0]))
+                            inserted_dates.append(row[9])
+                    key_index.add(inserted_keys, len(inserted_keys))
+                    key_indexes.append(key_index)
+                    rows_inserted += len(inserted_keys)
+                # Recompute the workstation utilisation of the days of the new tracking lines
+                refresh_utilisation_days(cursor, inserted_dates)
+                return key_indexes, rows_inserted
 
-            cnxn.commit()
-            
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "SUIVITEMPSOF insert")
+            for key_index in key_indexes:
+                key_index.save()
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
             else:
@@ -150,7 +172,8 @@ def insert_data_into_SUIVITEMPSOF(data):
         return False
 
 # Function to update data in SUIVITEMPSOF table in Madina Warehouse
-def insert_data_into_SUIVITEMPSOF_sync(data):
+# (changed_days are the imputation days whose workstation utilisation is recomputed with the merge)
+def insert_data_into_SUIVITEMPSOF_sync(data, changed_days=None):
     # Load Madin Warehouse database connection config
     madin_warehouse_db = load_madin_warehouse_db_config()
 
@@ -158,46 +181,56 @@ def insert_data_into_SUIVITEMPSOF_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            # The date, workstation and company keys are appended once, outside the replayed transaction
+            data = append_dimension_keys(data, SUIVITEMPSOF_COLUMNS, "SUIVITEMPSOF", load_dimension_keys())
 
-             # Iterate over the data and perform upsert
-            for row in data:
-                cursor.execute("""
-                    MERGE INTO SUIVITEMPSOF AS target
-                    USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)) AS source (
-                        numerosuivi, company, quantite, quantiterejet, posterealise, 
-                        morealise, tempsreglage, tempsopérealise, message, dateimputation,
-                        Time_type, Time_unit)
-                    ON target.numerosuivi = source.numerosuivi
-                    WHEN MATCHED THEN
-                        UPDATE SET
-                            company = source.company,
-                            quantite = source.quantite,
-                            quantiterejet = source.quantiterejet,
-                            posterealise = source.posterealise,
-                            morealise = source.morealise,
-                            tempsreglage = source.tempsreglage,
-                            tempsopérealise = source.tempsopérealise,
-                            message = source.message,
-                            dateimputation = source.dateimputation,
-                            Time_type = source.Time_type,
-                            Time_unit = source.Time_unit
-                    WHEN NOT MATCHED BY TARGET THEN
-                        INSERT (
+            def synchronize_rows(cursor):
+                 # Iterate over the data and perform upsert
+                for row in data:
+                    cursor.execute("""
+                        MERGE INTO SUIVITEMPSOF AS target
+                        USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)) AS source (
                             numerosuivi, company, quantite, quantiterejet, posterealise, 
                             morealise, tempsreglage, tempsopérealise, message, dateimputation,
-                            Time_type, Time_unit)
-                        VALUES (
-                            source.numerosuivi, source.company, source.quantite, source.quantiterejet, 
-                            source.posterealise, source.morealise, source.tempsreglage, source.tempsopérealise, 
-                            source.message, source.dateimputation, source.Time_type, source.Time_unit);
-                """, (
-                    row[0], row[1], row[2], row[3], 
-                    row[4], row[5], row[6], row[7], 
-                    row[8], row[9], row[10], row[11]
-                    ))
+                            Time_type, Time_unit, dossier, DateKey, workstationKey, companyKey)
+                        ON target.numerosuivi = source.numerosuivi AND target.dossier = source.dossier
+                        WHEN MATCHED THEN
+                            UPDATE SET
+                                company = source.company,
+                                quantite = source.quantite,
+                                quantiterejet = source.quantiterejet,
+                                posterealise = source.posterealise,
+                                morealise = source.morealise,
+                                tempsreglage = source.tempsreglage,
+                                tempsopérealise = source.tempsopérealise,
+                                message = source.message,
+                                dateimputation = source.dateimputation,
+                                Time_type = source.Time_type,
+                                Time_unit = source.Time_unit,
+                                DateKey = source.DateKey,
+                                workstationKey = source.workstationKey,
+                                companyKey = source.companyKey
+                        WHEN NOT MATCHED BY TARGET THEN
+                            INSERT (
+                                numerosuivi, company, quantite, quantiterejet, posterealise, 
+                                morealise, tempsreglage, tempsopérealise, message, dateimputation,
+                                Time_type, Time_unit, dossier, DateKey, workstationKey, companyKey)
+                            VALUES (
+                                source.numerosuivi, source.company, source.quantite, source.quantiterejet, 
+                                source.posterealise, source.morealise, source.tempsreglage, source.tempsopérealise, 
+                                source.message, source.dateimputation, source.Time_type, source.Time_unit,
+                                source.dossier, source.DateKey, source.workstationKey, source.companyKey);
+                    """, (
+                        row[0], row[1], row[2], row[3], 
+                        row[4], row[5], row[6], row[7], 
+                        row[8], row[9], row[10], row[11],
+                        row[12], row[13], row[14], row[15]
+                        ))
 
-            cnxn.commit()
+                refresh_utilisation_days(cursor, changed_days if changed_days is not None else [row[9] for row in data])
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "SUIVITEMPSOF sync")
             print("Data synchronized successfully.")
             return True
         
@@ -220,7 +253,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT numerosuivi, company, quantite, quantiterejet, posterealise, morealise, tempsreglage, tempsopérealise, message, dateimputation, Time_type, Time_unit FROM SUIVITEMPSOF;"
+            source_query = "SELECT numerosuivi, company, quantite, quantiterejet, posterealise, morealise, tempsreglage, tempsopérealise, message, dateimputation, Time_type, Time_unit, dossier FROM SUIVITEMPSOF;"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -233,12 +266,14 @@ def retrieve_data_from_target():
         return None
 
 # Function to compare data between source and target databases and synchronize if needed
-def synchronize_data():
-    source_data = retrieve_data_from_sagex3()
+# (source_data can be given when the extract is shared with another table)
+def synchronize_data(source_data=None):
+    if source_data is None:
+        source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("SUIVITEMPSOF", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -247,19 +282,28 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_SUIVITEMPSOF_sync(source_data.values.tolist())
+        changed_days = get_changed_days(source_data, target_data, "dateimputation")
+        sync_result = insert_data_into_SUIVITEMPSOF_sync(source_data.values.tolist(), changed_days)
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("SUIVITEMPSOF", source_data)
+            invalidate_key_index("SUIVITEMPSOF")
+        return sync_result
 
 @router.get("/sage/SUIVITEMPSOF")
 async def retrieve_data_from_sage_SUIVITEMPSOF(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, retrieve_data_from_sagex3)
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage SUIVITEMPSOF.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag})
 
 @router.post("/madin/warehouse/create-table-SUIVITEMPSOF")
 async def create_SUIVITEMPSOF_table_handler(request: Request):
@@ -4,24 +4,18 @@ import os
 import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.db import get_connection
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.timetracking import retrieve_time_tracking_from_sagex3, split_time_tracking_by_table
+from app.utils.folders import group_rows_by_folder, add_folder_column, scope_unique_key_to_folder, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
 # Function to load the Madin Warehouse database connection configuration from a JSON file
 def load_madin_warehouse_db_config():
     madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
@@ -38,22 +32,11 @@ def load_sage_x3_db_config():
 
 # Function to retrieve data from Sage X3
 def retrieve_data_from_sagex3():
-    sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "SELECT MFGTRKNUM_0 AS numerosuivi, LEGCPY_0 AS company, CPLQTY_0 AS quantite, REJCPLQTY_0 AS quantiterejet, CPLWST_0 AS posterealise, CPLLAB_0 AS morealise, CASE WHEN TIMUOMCOD_0 = 2 THEN CPLSETTIM_0 / 60.0 ELSE CPLSETTIM_0 END AS tempsreglage, CASE WHEN TIMUOMCOD_0 = 2 THEN CPLOPETIM_0 / 60.0 ELSE CPLOPETIM_0 END AS tempsopérealise, MSGNUM_0 AS message, IPTDAT_0 AS dateimputation, TIMTYP_0 AS Time_type, TIMUOMCOD_0 AS Time_unit FROM SEED.MFGOPETRK INNER JOIN SEED.FACILITY ON FACILITY.FCY_0 = MFGFCY_0 WHERE TIMTYP_0 = 3"
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    # MFGOPETRK is read once for all time types, only the lines of this table are kept
+    data = retrieve_time_tracking_from_sagex3()
+    if data is None:
         return None
+    return split_time_tracking_by_table(data)["SUIVITEMPSDIVERS"]
 
 # Function to create SUIVITEMPSDIVERS table in Madin Warehouse
 def create_SUIVITEMPSDIVERS_table(db_config):
@@ -67,7 +50,7 @@ def create_SUIVITEMPSDIVERS_table(db_config):
                 # SQL query to create SUIVITEMPSDIVERS table
                 create_table_query = """
                 CREATE TABLE SUIVITEMPSDIVERS (
-                numerosuivi VARCHAR(50) PRIMARY KEY,
+                numerosuivi VARCHAR(50) NOT NULL,
                 company VARCHAR(50),
                 quantite FLOAT,
                 quantiterejet FLOAT,
@@ -78,7 +61,9 @@ def create_SUIVITEMPSDIVERS_table(db_config):
                 message INT,
                 dateimputation DATETIME,
                 Time_type INT,        -- Adding [Time type] column
-                Time_unit INT
+                Time_unit INT,
+                dossier VARCHAR(50) NOT NULL,
+                PRIMARY KEY (numerosuivi, dossier)
                 )"""
                 # Execute the query
                 cursor.execute(create_table_query)
@@ -88,6 +73,11 @@ def create_SUIVITEMPSDIVERS_table(db_config):
                 return "created"
             else:
                 print("SUIVITEMPSDIVERS table already exists.")
+                # Tables created before multi-folder support get the folder column, and a tracking
+                # number is unique within a folder instead of across all of them
+                add_folder_column(cursor, "SUIVITEMPSDIVERS")
+                scope_unique_key_to_folder(cursor, "SUIVITEMPSDIVERS", "numerosuivi")
+                cnxn.commit()
                 return "exists"
         else:
             print("Failed to connect to the database.")
@@ -107,29 +97,40 @@ def insert_data_into_SUIVITEMPSDIVERS(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-            
-            rows_inserted = 0
-            for row in data:
-                print(f"Inserting row: {row}")  # Debugging line to check the row data
-                # Check if the tracking number already exists in the table
-                cursor.execute("SELECT COUNT(1) FROM SUIVITEMPSDIVERS WHERE numerosuivi = ?", (row[0],))
-                exists = cursor.fetchone()[0]
-                if not exists:
-                    # Insert into SUIVITEMPSDIVERS table
-                    cursor.execute("""
-                    INSERT INTO SUIVITEMPSDIVERS (
-                        numerosuivi, company, quantite, quantiterejet, posterealise, 
-                        morealise, tempsreglage, tempsoperealise, message, dateimputation, Time_type, Time_unit
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    row[0], row[1], row[2], row[3], 
-                    row[4], row[5], row[6], row[7], 
-                    row[8], row[9], row[10], row[11]
-                ))
-                    rows_inserted += 1
+            def insert_rows(cursor):
+                rows_inserted = 0
+                key_indexes = []
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    # Find the tracking numbers not yet present in this folder of the SUIVITEMPSDIVERS table
+                    key_index = load_key_index(cursor, "SUIVITEMPSDIVERS", "numerosuivi", key_type="str", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
+
+                    inserted_keys = set()
+                    for row in folder_rows:
+                        print(f"Inserting row: {row}")  # Debugging line to check the row data
+                        if str(row[0]) in new_keys and str(row[0]) not in inserted_keys:
+                            # Insert into SUIVITEMPSDIVERS table
+                            cursor.execute("""
+                            INSERT INTO SUIVITEMPSDIVERS (
+                                numerosuivi, company, quantite, quantiterejet, posterealise, 
+                                morealise, tempsreglage, tempsoperealise, message, dateimputation, Time_type, Time_unit, dossier
+                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """, (
+                            row[0], row[1], row[2], row[3], 
+                            row[4], row[5], row[6], row[7], 
+                            row[8], row[9], row[10], row[11], row[12]
+                        ))
+                            inserted_keys.add(str(row[0]))
+                    key_index.add(inserted_keys, len(inserted_keys))
+                    key_indexes.append(key_index)
+                    rows_inserted += len(inserted_keys)
 
-            cnxn.commit()
+                return key_indexes, rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "SUIVITEMPSDIVERS insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -157,45 +158,46 @@ def insert_data_into_SUIVITEMPSDIVERS_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def synchronize_rows(cursor):
+                 # Iterate over the data and perform upsert
+                for row in data:
+                    cursor.execute("""
+                            MERGE INTO SUIVITEMPSDIVERS AS target
+                            USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)) AS source (
+                                numerosuivi, company, quantite, quantiterejet, posterealise, 
+                                morealise, tempsreglage, tempsoperealise, message, dateimputation, 
+                                Time_type, Time_unit, dossier
+                            )
+                            ON target.numerosuivi = source.numerosuivi AND target.dossier = source.dossier
+                            WHEN MATCHED THEN
+                                UPDATE SET
+                                    company = source.company,
+                                    quantite = source.quantite,
+                                    quantiterejet = source.quantiterejet,
+                                    posterealise = source.posterealise,
+                                    morealise = source.morealise,
+                                    tempsreglage = source.tempsreglage,
+                                    tempsoperealise = source.tempsoperealise,
+                                    message = source.message,
+                                    dateimputation = source.dateimputation,
+                                    Time_type = source.Time_type,  -- Added
+                                    Time_unit = source.Time_unit   -- Added
+                            WHEN NOT MATCHED BY TARGET THEN
+                                INSERT (numerosuivi, company, quantite, quantiterejet, posterealise, 
+                                        morealise, tempsreglage, tempsoperealise, message, dateimputation, 
+                                        Time_type, Time_unit, dossier)
+                                VALUES (source.numerosuivi, source.company, source.quantite, source.quantiterejet, 
+                                        source.posterealise, source.morealise, source.tempsreglage, source.tempsoperealise, 
+                                        source.message, source.dateimputation, 
+                                        source.Time_type, source.Time_unit, source.dossier);  
+                        """, (
+                            row[0], row[1], row[2], row[3], 
+                            row[4], row[5], row[6], row[7], 
+                            row[8], row[9], row[10], row[11], row[12]
+                        ))
 
-             # Iterate over the data and perform upsert
-            for row in data:
-                cursor.execute("""
-                        MERGE INTO SUIVITEMPSDIVERS AS target
-                        USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)) AS source (
-                            numerosuivi, company, quantite, quantiterejet, posterealise, 
-                            morealise, tempsreglage, tempsoperealise, message, dateimputation, 
-                            Time_type, Time_unit
-                        )
-                        ON target.numerosuivi = source.numerosuivi
-                        WHEN MATCHED THEN
-                            UPDATE SET
-                                company = source.company,
-                                quantite = source.quantite,
-                                quantiterejet = source.quantiterejet,
-                                posterealise = source.posterealise,
-                                morealise = source.morealise,
-                                tempsreglage = source.tempsreglage,
-                                tempsoperealise = source.tempsoperealise,
-                                message = source.message,
-                                dateimputation = source.dateimputation,
-                                Time_type = source.Time_type,  -- Added
-                                Time_unit = source.Time_unit   -- Added
-                        WHEN NOT MATCHED BY TARGET THEN
-                            INSERT (numerosuivi, company, quantite, quantiterejet, posterealise, 
-                                    morealise, tempsreglage, tempsoperealise, message, dateimputation, 
-                                    Time_type, Time_unit)
-                            VALUES (source.numerosuivi, source.company, source.quantite, source.quantiterejet, 
-                                    source.posterealise, source.morealise, source.tempsreglage, source.tempsoperealise, 
-                                    source.message, source.dateimputation, 
-                                    source.Time_type, source.Time_unit);  
-                    """, (
-                        row[0], row[1], row[2], row[3], 
-                        row[4], row[5], row[6], row[7], 
-                        row[8], row[9], row[10], row[11]
-                    ))
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "SUIVITEMPSDIVERS sync")
 
             print("Data synchronized successfully.")
             return True
@@ -219,7 +221,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT numerosuivi, company, quantite, quantiterejet, posterealise, morealise, tempsreglage, tempsopérealise, message, dateimputation, Time_type, Time_unit FROM SUIVITEMPSDIVERS;"
+            source_query = "SELECT numerosuivi, company, quantite, quantiterejet, posterealise, morealise, tempsreglage, tempsopérealise, message, dateimputation, Time_type, Time_unit, dossier FROM SUIVITEMPSDIVERS;"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -232,12 +234,14 @@ def retrieve_data_from_target():
         return None
 
 # Function to compare data between source and target databases and synchronize if needed
-def synchronize_data():
-    source_data = retrieve_data_from_sagex3()
+# (source_data can be given when the extract is shared with another table)
+def synchronize_data(source_data=None):
+    if source_data is None:
+        source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("SUIVITEMPSDIVERS", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -246,19 +250,27 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_SUIVITEMPSDIVERS_sync(source_data.values.tolist())
+        sync_result = insert_data_into_SUIVITEMPSDIVERS_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("SUIVITEMPSDIVERS", source_data)
+            invalidate_key_index("SUIVITEMPSDIVERS")
+        return sync_result
     
 @router.get("/sage/SUIVITEMPSDIVERS")
 async def retrieve_data_from_sage_SUIVITEMPSDIVERS(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, retrieve_data_from_sagex3)
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage SUIVITEMPSDIVERS.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag})
     
 @router.post("/madin/warehouse/create-table-SUIVITEMPSDIVERS")
 async def create_SUIVITEMPSDIVERS_table_handler(request: Request):
@@ -1,40 +1,21 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, scope_unique_key_to_folder, propagate_folder_deletes, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+# Columns the /sage readout can be filtered and paged on
+COMPANY_READOUT = {"key": "ROWID", "filters": {"company": "CPY_0"}, "folders": True,
+                   "columns": ["CPY_0", "CPYNAM_0", "ROWID"]}
 
 # Function to create COMPANY table in Madin Warehouse
 def create_COMPANY_table(db_config):
@@ -49,9 +30,11 @@ def create_COMPANY_table(db_config):
                 create_table_query = """
                 CREATE TABLE COMPANY (
                     ID INT PRIMARY KEY IDENTITY,
-                    CPY_0 VARCHAR(255) UNIQUE,
+                    CPY_0 VARCHAR(255),
                     CPYNAM_0 VARCHAR(255),
-                    ROWID INT
+                    ROWID INT,
+                    dossier VARCHAR(50),
+                    CONSTRAINT UQ_COMPANY_CPY_0_dossier UNIQUE (CPY_0, dossier)
                 )
                 """
                 # Execute the query
@@ -61,6 +44,11 @@ def create_COMPANY_table(db_config):
                 print("COMPANY table created successfully.")
             else:
                 print("COMPANY table already exists.")
+            # Tables created before multi-folder support get the folder column, and a company code is
+            # unique within a folder instead of across all of them
+            add_folder_column(cursor, "COMPANY")
+            scope_unique_key_to_folder(cursor, "COMPANY", "CPY_0")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -85,24 +73,21 @@ async def create_COMPANY_table_handler(request: Request):
 
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
-    # Load Sage X3 database connection config from JSON
+def retrieve_data_from_sagex3(readout=None):
     sagex3_db = load_sage_x3_db_config()
-
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "SELECT [CPY_0], [CPYNAM_0], [ROWID] FROM [x3v12src].[SEED].[COMPANY]"
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = "SELECT [CPY_0], [CPYNAM_0], [ROWID] FROM [x3v12src].[SEED].[COMPANY]"
+        params = None
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, COMPANY_READOUT, readout)
+            folders = readout["folders"]
+        # Read the companies of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "COMPANY extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
 
 def insert_data_into_COMPANY(data):
@@ -113,23 +98,31 @@ def insert_data_into_COMPANY(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-
-            # Get the current maximum ROWID in the COMPANY table
-            cursor.execute("SELECT MAX(ROWID) FROM COMPANY")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
-
-            # Insert new data into COMPANY table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[2] > max_rowid:  # Assuming ROWID is at index 2 in each row
-                    cursor.execute("INSERT INTO COMPANY (CPY_0, CPYNAM_0, ROWID) VALUES (?, ?, ?)",
-                                   (row[0], row[1], row[2]))
-                    rows_inserted += 1
-
-            cnxn.commit()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                key_indexes = []
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    # Find the rows whose ROWID is not yet present in this folder of the COMPANY table
+                    key_index = load_key_index(cursor, "COMPANY", "ROWID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[2] for row in folder_rows])
+
+                    # Insert new data into COMPANY table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[2] in new_keys:
+                            cursor.execute("INSERT INTO COMPANY (CPY_0, CPYNAM_0, ROWID, dossier) VALUES (?, ?, ?, ?)",
+                                           (row[0], row[1], row[2], row[3]))
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
+
+                return key_indexes, rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "COMPANY insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -155,17 +148,17 @@ def insert_data_into_COMPANY_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def synchronize_rows(cursor):
+                # Truncate COMPANY table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE COMPANY")
 
-            # Truncate COMPANY table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE COMPANY")
+                # Insert new data into COMPANY table
+                for row in data:
+                    cursor.execute("INSERT INTO COMPANY (CPY_0, CPYNAM_0, ROWID, dossier) VALUES (?, ?, ?, ?)",
+                                   (row[0], row[1], row[2], row[3]))
 
-            # Insert new data into COMPANY table
-            for row in data:
-                cursor.execute("INSERT INTO COMPANY (CPY_0, CPYNAM_0, ROWID) VALUES (?, ?, ?)",
-                               (row[0], row[1], row[2]))
-
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "COMPANY sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -187,7 +180,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT [CPY_0], [CPYNAM_0], [ROWID] FROM [dw_madin].[dbo].[COMPANY]"
+            source_query = "SELECT [CPY_0], [CPYNAM_0], [ROWID], [dossier] FROM [dw_madin].[dbo].[COMPANY]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -209,7 +202,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT [CPY_0], [CPYNAM_0], [ROWID] FROM [dw_madin].[dbo].[COMPANY]"
+            source_query = "SELECT [CPY_0], [CPYNAM_0], [ROWID], [dossier] FROM [dw_madin].[dbo].[COMPANY]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -226,7 +219,7 @@ def synchronize_data():
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("COMPANY", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -235,11 +228,21 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_COMPANY_sync(source_data.values.tolist())
+        sync_result = insert_data_into_COMPANY_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("COMPANY", source_data)
+            invalidate_key_index("COMPANY")
+        return sync_result
 
 
 
 
+# Function to delete from COMPANY the rows that no longer exist in Sage X3
+def delete_removed_rows_from_COMPANY():
+    source_from = "[x3v12src].[SEED].[COMPANY]"
+    return propagate_folder_deletes(source_from, "ROWID", "COMPANY", "ROWID")
+
 @router.post("/madin/warehouse/insert-data-company")
 async def insert_data_into_COMPANY_handler(request: Request):
     # Retrieve data from Sage X3
@@ -248,6 +251,9 @@ async def insert_data_into_COMPANY_handler(request: Request):
         return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
     
     if insert_data_into_COMPANY(sagex3_data.values.tolist()):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_COMPANY() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to COMPANY table.")
         return Response(status_code=201, content="Data inserted into COMPANY table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into COMPANY table.")
@@ -255,15 +261,23 @@ async def insert_data_into_COMPANY_handler(request: Request):
 
 @router.get("/sage/company")
 async def retrieve_data_from_sage_customers(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, COMPANY_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage customers.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, COMPANY_READOUT, readout)})
 
 
 @router.post("/madin/warehouse/synchronize_company")
@@ -1,10 +1,12 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from sqlalchemy import create_engine, text
 from datetime import datetime, timedelta
 import sqlalchemy
 import os
 import json
 from sqlalchemy import inspect
+from app.utils.etag import make_etag, etag_matches, not_modified_response
+from app.utils.retry import run_with_retry
 router = APIRouter()
 
 def generate_dates(start_year, end_year):
@@ -29,52 +31,63 @@ def create_date_table(engine_target):
                 Month INT,
                 Year INT,
                 Week INT,
-                Semester INT
+                Semester INT,
+                DateKey INT
             )
             """
             conn.execute(sqlalchemy.text(create_table_query))
             conn.commit()
         else:
             print("Table 'Date' already exists.")
+            # yyyymmdd key joined to the DateKey column of the fact tables
+            if 'DateKey' not in [column['name'] for column in inspector.get_columns('Date')]:
+                conn.execute(text("ALTER TABLE [Date] ADD DateKey INT"))
+                conn.execute(text("UPDATE [Date] SET DateKey = Year * 10000 + Month * 100 + Day"))
+                conn.commit()
 
 
 def insert_data_into_table(engine_target):
-    with engine_target.connect() as conn:
-        # Fetch existing dates from the table
-        existing_dates = set()
-        select_existing_query = """
-        SELECT Day, Month, Year FROM [Date]
-        """
-        existing_dates_result = conn.execute(text(select_existing_query))
-        for row in existing_dates_result:
-            existing_dates.add((row[0], row[1], row[2]))
-
-        # Generate and insert new dates
-        for date in generate_dates(2013, datetime.now().year):
-            day = date.day
-            month = date.month
-            year = date.year
-            week = date.isocalendar()[1]
-            semester = get_semester(month)
-
-            # Check if the date already exists in the table
-            if (day, month, year) not in existing_dates:
-                insert_query = """
-                INSERT INTO [Date] (Day, Month, Year, Week, Semester) 
-                VALUES (:day, :month, :year, :week, :semester)
-                """
-                bind_params = {
-                    "day": day,
-                    "month": month,
-                    "year": year,
-                    "week": week,
-                    "semester": semester
-                }
-
-                # Insert data into the table
-                conn.execute(text(insert_query), bind_params)
+    def insert_dates():
+        with engine_target.connect() as conn:
+            # Fetch existing dates from the table
+            existing_dates = set()
+            select_existing_query = """
+            SELECT Day, Month, Year FROM [Date]
+            """
+            existing_dates_result = conn.execute(text(select_existing_query))
+            for row in existing_dates_result:
+                existing_dates.add((row[0], row[1], row[2]))
+
+            # Generate and insert new dates
+            for date in generate_dates(2013, datetime.now().year):
+                day = date.day
+                month = date.month
+                year = date.year
+                week = date.isocalendar()[1]
+                semester = get_semester(month)
+
+                # Check if the date already exists in the table
+                if (day, month, year) not in existing_dates:
+                    insert_query = """
+                    INSERT INTO [Date] (Day, Month, Year, Week, Semester, DateKey) 
+                    VALUES (:day, :month, :year, :week, :semester, :date_key)
+                    """
+                    bind_params = {
+                        "day": day,
+                        "month": month,
+                        "year": year,
+                        "week": week,
+                        "semester": semester,
+                        "date_key": year * 10000 + month * 100 + day
+                    }
+
+                    # Insert data into the table
+                    conn.execute(text(insert_query), bind_params)
         
-        conn.commit()
+            conn.commit()
+
+    # Replayed after a deadlock, lock timeout or dropped connection (the dates already present are skipped)
+    run_with_retry(insert_dates, "Date insert")
 
 
 
@@ -99,11 +112,17 @@ async def generate_and_insert_dates(engine_target: sqlalchemy.engine.base.Engine
     return {"message": "Dates generated and inserted successfully."}
 
 @router.get("/get-dates")
-async def get_dates(engine_target: sqlalchemy.engine.base.Engine = Depends(get_engine_from_json)):
+async def get_dates(request: Request, response: Response, engine_target: sqlalchemy.engine.base.Engine = Depends(get_engine_from_json)):
     select_query = """
-    SELECT * FROM [Date]
+    SELECT id, Day, Month, Year, Week, Semester, DateKey FROM [Date]
     """
     with engine_target.connect() as conn:
+        # Rows are only ever appended to [Date]: the row count and last id identify its content
+        version = conn.execute(text("SELECT COUNT(*), MAX(id) FROM [Date]")).fetchone()
+        etag = make_etag("date", "DateKey", version[0], version[1])
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        response.headers["ETag"] = etag
         result = conn.execute(text(select_query))
         dates = []
         for row in result:
@@ -114,7 +133,8 @@ async def get_dates(engine_target: sqlalchemy.engine.base.Engine = Depends(get_e
                 "Month": row[2],
                 "Year": row[3],
                 "Week": row[4],
-                "Semester": row[5]
+                "Semester": row[5],
+                "DateKey": row[6]
             }
             dates.append(row_dict)
         return dates
@@ -1,40 +1,23 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.search import update_search_index, sync_search_index
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+# Columns the /sage readout can be filtered and paged on
+BPSUPPLIER_READOUT = {"key": "ROWID", "filters": {"supplier": "BPSNUM_0", "country": "CRY_0"}, "folders": True,
+                      "columns": ["ROWID", "BPSNUM_0", "BPSNAM_0", "BSGCOD_0", "BSGCOD_NAME_0", "TSSCOD_0", "TSCCOD_NAME_0", "TSSCOD_1", "TSCCOD_NAME_1",
+                                  "TSSCOD_2", "TSCCOD_NAME_2", "CRY_0", "PAYS_NAME"]}
 
 # Function to create BPSUPPLIER table in Madin Warehouse
 def create_BPSUPPLIER_table(db_config):
@@ -61,7 +44,8 @@ def create_BPSUPPLIER_table(db_config):
                     TSSCOD_2 VARCHAR(255),
                     TSSCOD_NAME_2 VARCHAR(255),
                     CRY_0 VARCHAR(255),
-                    PAYS_NAME VARCHAR(255)
+                    PAYS_NAME VARCHAR(255),
+                    dossier VARCHAR(50)
                 )
                 """
                 # Execute the query
@@ -71,6 +55,9 @@ def create_BPSUPPLIER_table(db_config):
                 print("BPSUPPLIER table created successfully.")
             else:
                 print("BPSUPPLIER table already exists.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "BPSUPPLIER")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -83,42 +70,38 @@ def create_BPSUPPLIER_table(db_config):
             cnxn.close()
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(readout=None):
+    sagex3_db = load_sage_x3_db_config()
     try:
-        # Load Sage X3 database connection config from JSON
-        sagex3_db = load_sage_x3_db_config()
+        source_query = """
+                       SELECT BPSUPPLIER.ROWID,
+                       BPSNUM_0,
+                       BPSNAM_0,
+                       BSGCOD_0,
+                       (SELECT TEXTE_0 from [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 = 'DESAXX' and CODFIC_0 ='BPCCATEG' AND LANGUE_0 ='FRA' AND IDENT1_0=BSGCOD_0) AS BSGCOD_NAME_0,
+                       TSSCOD_0,
+                       (SELECT TEXTE_0  from [x3v12src].[SEED].[ATEXTRA] where ZONE_0  like '%LNGDES%' AND CODFIC_0 ='ATABDIV' and LANGUE_0 ='FRA'and IDENT1_0 =40 AND IDENT2_0 =TSSCOD_0) AS TSCCOD_NAME_0,
+                       TSSCOD_1,
+                       (SELECT TEXTE_0  from [x3v12src].[SEED].[ATEXTRA] where ZONE_0  like '%LNGDES%' AND CODFIC_0 ='ATABDIV' and LANGUE_0 ='FRA'and IDENT1_0 =41 AND IDENT2_0 =TSSCOD_1) AS TSCCOD_NAME_1,
+                       TSSCOD_2,
+                       (SELECT TEXTE_0  from [x3v12src].[SEED].[ATEXTRA] where ZONE_0  like '%LNGDES%' AND CODFIC_0 ='ATABDIV' and LANGUE_0 ='FRA'and IDENT1_0 =42 AND IDENT2_0 =TSSCOD_2) AS TSCCOD_NAME_2,
+                       CRY_0,
+                       (SELECT TEXTE_0 from  [x3v12src].[SEED] .[ATEXTRA] where  CODFIC_0 ='TABCOUNTRY' and ZONE_0  like '%CRYDES%'  and LANGUE_0 ='FRA' and IDENT1_0=CRY_0) AS PAYS_NAME
+                       FROM [x3v12src].[SEED].[BPSUPPLIER] inner join  [x3v12src].[SEED].[BPARTNER] ON BPSUPPLIER.BPSNUM_0=BPARTNER.BPRNUM_0
 
-        # Establish connection to Sage X3 database
-        cnxn = get_connection(sagex3_db)
-        if cnxn:
-            source_query = """
-                           SELECT BPSUPPLIER.ROWID,
-                           BPSNUM_0,
-                           BPSNAM_0,
-                           BSGCOD_0,
-                           (SELECT TEXTE_0 from [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 = 'DESAXX' and CODFIC_0 ='BPCCATEG' AND LANGUE_0 ='FRA' AND IDENT1_0=BSGCOD_0) AS BSGCOD_NAME_0,
-                           TSSCOD_0,
-                           (SELECT TEXTE_0  from [x3v12src].[SEED].[ATEXTRA] where ZONE_0  like '%LNGDES%' AND CODFIC_0 ='ATABDIV' and LANGUE_0 ='FRA'and IDENT1_0 =40 AND IDENT2_0 =TSSCOD_0) AS TSCCOD_NAME_0,
-                           TSSCOD_1,
-                           (SELECT TEXTE_0  from [x3v12src].[SEED].[ATEXTRA] where ZONE_0  like '%LNGDES%' AND CODFIC_0 ='ATABDIV' and LANGUE_0 ='FRA'and IDENT1_0 =41 AND IDENT2_0 =TSSCOD_1) AS TSCCOD_NAME_1,
-                           TSSCOD_2,
-                           (SELECT TEXTE_0  from [x3v12src].[SEED].[ATEXTRA] where ZONE_0  like '%LNGDES%' AND CODFIC_0 ='ATABDIV' and LANGUE_0 ='FRA'and IDENT1_0 =42 AND IDENT2_0 =TSSCOD_2) AS TSCCOD_NAME_2,
-                           CRY_0,
-                           (SELECT TEXTE_0 from  [x3v12src].[SEED] .[ATEXTRA] where  CODFIC_0 ='TABCOUNTRY' and ZONE_0  like '%CRYDES%'  and LANGUE_0 ='FRA' and IDENT1_0=CRY_0) AS PAYS_NAME
-                           FROM [x3v12src].[SEED].[BPSUPPLIER] inner join  [x3v12src].[SEED].[BPARTNER] ON BPSUPPLIER.BPSNUM_0=BPARTNER.BPRNUM_0
-
-                           """
-            data = pd.read_sql(source_query, cnxn)
-            return data  # Return DataFrame directly
-        else:
-            print("Failed to connect to the source database.")
-            return None
+                       """
+        params = None
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, BPSUPPLIER_READOUT, readout)
+            folders = readout["folders"]
+        # Read the suppliers of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "BPSUPPLIER extract", params=params, folders=folders)
+        return data
     except Exception as e:
         print(f"Error retrieving data from Sage X3: {e}")
         return None
-    finally:
-        if cnxn:
-            cnxn.close()
 
 # Function to insert data into BPSUPPLIER table in Madin Warehouse
 def insert_data_into_BPSUPPLIER(data, clear_table=False):
@@ -129,23 +112,35 @@ def insert_data_into_BPSUPPLIER(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                new_suppliers = []
+                key_indexes = []
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    # Find the rows whose ROWID is not yet present in this folder of the BPSUPPLIER table
+                    key_index = load_key_index(cursor, "BPSUPPLIER", "ROWID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
 
-            # Get the current maximum ROWID in the BPSUPPLIER table
-            cursor.execute("SELECT MAX(ROWID) FROM BPSUPPLIER")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
+                    # Insert new data into BPSUPPLIER table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[0] in new_keys:
+                            cursor.execute("INSERT INTO BPSUPPLIER (ROWID,BPSNUM_0, BPSNAM_0, BSGCOD_0, BSGCOD_NAME_0,TSSCOD_0, TSSCOD_NAME_0, TSSCOD_1, TSSCOD_NAME_1,TSSCOD_2, TSSCOD_NAME_2, CRY_0, PAYS_NAME, dossier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?,?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8],row[9], row[10], row[11], row[12], row[13]))
+                            new_suppliers.append((row[1], row[2]))
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
 
-            # Insert new data into BPSUPPLIER table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[0] > max_rowid:  # Assuming ROWID is at index 2 in each row
-                    cursor.execute("INSERT INTO BPSUPPLIER (ROWID,BPSNUM_0, BPSNAM_0, BSGCOD_0, BSGCOD_NAME_0,TSSCOD_0, TSSCOD_NAME_0, TSSCOD_1, TSSCOD_NAME_1,TSSCOD_2, TSSCOD_NAME_2, CRY_0, PAYS_NAME) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8],row[9], row[10], row[11], row[12]))
-                    rows_inserted += 1
+                return key_indexes, new_suppliers, rows_inserted
 
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, new_suppliers, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "BPSUPPLIER insert")
+            for key_index in key_indexes:
+                key_index.save()
+            # Add the new rows to the fournisseurs search index
+            update_search_index("fournisseurs", new_suppliers)
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -170,17 +165,17 @@ def insert_data_into_BPSUPPLIER_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def synchronize_rows(cursor):
+                # Truncate BPSUPPLIER table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE BPSUPPLIER")
 
-            # Truncate BPSUPPLIER table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE BPSUPPLIER")
+                # Insert new data into BPSUPPLIER table
+                for _, row in data.iterrows():
+                    cursor.execute("INSERT INTO BPSUPPLIER (ROWID,BPSNUM_0, BPSNAM_0, BSGCOD_0, BSGCOD_NAME_0,TSSCOD_0, TSSCOD_NAME_0, TSSCOD_1, TSSCOD_NAME_1,TSSCOD_2, TSSCOD_NAME_2, CRY_0, PAYS_NAME, dossier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?,?)",
+                                   tuple(row))
 
-            # Insert new data into BPSUPPLIER table
-            for _, row in data.iterrows():
-                cursor.execute("INSERT INTO BPSUPPLIER (ROWID,BPSNUM_0, BPSNAM_0, BSGCOD_0, BSGCOD_NAME_0,TSSCOD_0, TSSCOD_NAME_0, TSSCOD_1, TSSCOD_NAME_1,TSSCOD_2, TSSCOD_NAME_2, CRY_0, PAYS_NAME) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?)",
-                               tuple(row))
-
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "BPSUPPLIER sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -202,7 +197,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT ROWID,BPSNUM_0, BPSNAM_0, BSGCOD_0, BSGCOD_NAME_0,TSSCOD_0, TSSCOD_NAME_0, TSSCOD_1, TSSCOD_NAME_1,TSSCOD_2, TSSCOD_NAME_2, CRY_0, PAYS_NAME FROM [dw_madin].[dbo].[BPSUPPLIER]"
+            source_query = "SELECT ROWID,BPSNUM_0, BPSNAM_0, BSGCOD_0, BSGCOD_NAME_0,TSSCOD_0, TSSCOD_NAME_0, TSSCOD_1, TSSCOD_NAME_1,TSSCOD_2, TSSCOD_NAME_2, CRY_0, PAYS_NAME, dossier FROM [dw_madin].[dbo].[BPSUPPLIER]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -221,7 +216,7 @@ def synchronize_data():
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("BPSUPPLIER", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -230,9 +225,25 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_BPSUPPLIER_sync(source_data)
+        sync_result = insert_data_into_BPSUPPLIER_sync(source_data)
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("BPSUPPLIER", source_data)
+            invalidate_key_index("BPSUPPLIER")
+            sync_search_index("fournisseurs", source_data)
+        return sync_result
 
     
+# Function to delete from BPSUPPLIER the rows that no longer exist in Sage X3
+def delete_removed_rows_from_BPSUPPLIER():
+    source_from = "[x3v12src].[SEED].[BPSUPPLIER] inner join [x3v12src].[SEED].[BPARTNER] ON BPSUPPLIER.BPSNUM_0=BPARTNER.BPRNUM_0"
+    # The codes of the deleted rows are removed from the search index once their deletes are committed
+    deleted_codes = set()
+    result = propagate_folder_deletes(source_from, "BPSUPPLIER.ROWID", "BPSUPPLIER", "ROWID", output_column="BPSNUM_0", before_commit=lambda cursor, codes: deleted_codes.update(codes))
+    if result is not None:
+        update_search_index("fournisseurs", removed=deleted_codes)
+    return result
+
 @router.post("/madin/warehouse/create-table-fournisseurs")
 async def create_BPSUPPLIER_table_handler(request: Request):
     # Load Madina Warehouse database connection config
@@ -256,6 +267,9 @@ async def insert_data_into_BPSUPPLIER_handler(request: Request):
     sagex3_data_tuples = [tuple(x) for x in sagex3_data.values]
 
     if insert_data_into_BPSUPPLIER(sagex3_data_tuples):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_BPSUPPLIER() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to BPSUPPLIER table.")
         return Response(status_code=201, content="Data inserted into BPSUPPLIER table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into BPSUPPLIER table.")
@@ -263,15 +277,23 @@ async def insert_data_into_BPSUPPLIER_handler(request: Request):
 
 @router.get("/sage/fournisseurs")
 async def retrieve_data_from_sage_fournisseurs(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, BPSUPPLIER_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage fournisseurs.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, BPSUPPLIER_READOUT, readout)})
 
 @router.post("/madin/warehouse/synchronize_fournisseurs")
 async def synchronize_fournisseurs_data(request: Request):
@@ -0,0 +1,77 @@
+import pandas as pd
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.etag import get_query_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters
+from app.utils.summary import FUNNEL_TABLE, FUNNEL_DIMENSIONS, get_funnel_measures, rebuild_funnel
+
+router = APIRouter()
+
+# Columns the funnel readout can be filtered on
+FUNNEL_READOUT = {"date": "mois", "filters": {"company": "societe", "customer": "codeClient", "item": "codeArticle", "dossier": "dossier"},
+                  "columns": ["mois"] + FUNNEL_DIMENSIONS + get_funnel_measures()}
+
+# Function to read the sales funnel table of Madin Warehouse.
+# The version of the requested rows is read first: data is None when the client already has it.
+def retrieve_funnel(readout, request):
+    source_query = f"SELECT * FROM {FUNNEL_TABLE}"
+    source_query, params = apply_readout_filters(source_query, FUNNEL_READOUT, readout)
+
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            etag = get_query_etag(cnxn.cursor(), FUNNEL_TABLE, source_query, params, readout["columns"])
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, pd.read_sql(source_query, cnxn, params=params)
+        except Exception as e:
+            print(f"Error reading {FUNNEL_TABLE}: {e}")
+            return None, None
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return None, None
+
+# Function to rebuild the sales funnel from the monthly summaries of the sales facts
+def rebuild_sales_funnel():
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            rebuild_funnel(cursor)
+            cnxn.commit()
+            return True
+        except Exception as e:
+            print(f"Error rebuilding {FUNNEL_TABLE}: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
+
+@router.get("/madin/warehouse/funnel")
+async def retrieve_funnel_handler(request: Request):
+    try:
+        readout = parse_readout_filters(request, FUNNEL_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+
+    etag, funnel_data = await run_in_threadpool(retrieve_funnel, readout, request)
+    if etag is None:
+        return Response(status_code=500, content="Failed to retrieve the sales funnel.")
+    # Answer 304 when the client already has this version of the funnel
+    if funnel_data is None:
+        return not_modified_response(etag)
+    return dataframe_response(funnel_data, headers={"ETag": etag})
+
+@router.post("/madin/warehouse/funnel/rebuild")
+async def rebuild_funnel_handler(request: Request):
+    if await run_in_threadpool(rebuild_sales_funnel):
+        return Response(status_code=200, content=f"{FUNNEL_TABLE} rebuilt successfully.")
+    else:
+        return Response(status_code=500, content=f"Internal Server Error - Failed to rebuild {FUNNEL_TABLE}.")
@@ -0,0 +1,50 @@
+import orjson
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
+from app.utils.etag import make_etag, etag_matches, not_modified_response
+from app.utils.hierarchy import HIERARCHY_LEVELS, get_item_hierarchy, refresh_item_hierarchy
+
+router = APIRouter()
+
+@router.get("/madin/warehouse/item-hierarchy")
+async def retrieve_item_hierarchy(request: Request):
+    # node: subtree of one node ("A/B" path of group codes, "/" in a code escaped as "%2F"),
+    # level: flat list of the nodes of a level, depth: number of levels returned below the node
+    # (children is then empty), items=true: item codes under each node
+    query_params = request.query_params
+    try:
+        depth = int(query_params["depth"]) if query_params.get("depth") else None
+        level = int(query_params["level"]) if query_params.get("level") else None
+    except ValueError:
+        return Response(status_code=400, content="depth and level must be integers.")
+    if level is not None and not 0 <= level < HIERARCHY_LEVELS:
+        return Response(status_code=400, content=f"level must be between 0 and {HIERARCHY_LEVELS - 1}.")
+    with_items = query_params.get("items", "").lower() in ("1", "true", "yes")
+
+    try:
+        hierarchy = await run_in_threadpool(get_item_hierarchy)
+    except Exception as e:
+        print(f"Error loading the item hierarchy: {e}")
+        return Response(status_code=500, content="Failed to load the item hierarchy.")
+    node_id = query_params.get("node")
+    if node_id is not None and node_id not in hierarchy.nodes:
+        return Response(status_code=404, content=f"Unknown hierarchy node {node_id}.")
+
+    # The tree only changes when the classification signature changes
+    etag = make_etag("item-hierarchy", hierarchy.signature, node_id, depth, level, with_items)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    if level is not None:
+        content = hierarchy.get_level(level)
+    else:
+        content = hierarchy.get_tree(node_id, depth, with_items)
+    return Response(content=orjson.dumps(content), media_type="application/json", headers={"ETag": etag})
+
+@router.post("/madin/warehouse/item-hierarchy/rebuild")
+async def rebuild_item_hierarchy_handler(request: Request):
+    # Reads the classification from the ITMMASTER table, rebuilds only when it changed
+    rebuilt = await run_in_threadpool(refresh_item_hierarchy)
+    if rebuilt is None:
+        return Response(status_code=500, content="Internal Server Error - Failed to rebuild the item hierarchy.")
+    return Response(status_code=200, content="Item hierarchy rebuilt successfully." if rebuilt else "Item classification unchanged, hierarchy kept.")
@@ -1,40 +1,24 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.search import update_search_index, sync_search_index
+from app.utils.hierarchy import refresh_item_hierarchy
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+# Columns the /sage readout can be filtered and paged on
+ITMMASTER_READOUT = {"key": "ROWID", "filters": {"item": "ITMREF_0"}, "folders": True,
+                     "columns": ["ITMREF_0", "ITMDES_0", "TCLCOD_0"] + [f"TSICOD_{level}" for level in range(5)] +
+                                [f"TSICOD_NAME_{level}" for level in range(5)] + ["ROWID"]}
 
 # Function to create ITMMASTER table in Madin Warehouse
 def create_ITMMASTER_table(db_config):
@@ -62,7 +46,8 @@ def create_ITMMASTER_table(db_config):
                     TSICOD_NAME_3 VARCHAR(255),
                     TSICOD_4 VARCHAR(255), 
                     TSICOD_NAME_4 VARCHAR(255),
-                    ROWID INT
+                    ROWID INT,
+                    dossier VARCHAR(50)
                 )
                 """
                 # Execute the query
@@ -72,6 +57,9 @@ def create_ITMMASTER_table(db_config):
                 print("ITMMASTER table created successfully.")
             else:
                 print("ITMMASTER table already exists.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "ITMMASTER")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -88,42 +76,39 @@ def create_ITMMASTER_table(db_config):
 
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
-    # Load Sage X3 database connection config from JSON
+def retrieve_data_from_sagex3(readout=None):
     sagex3_db = load_sage_x3_db_config()
-
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = """  
-                           SELECT ITMREF_0, 
-                           ITMDES1_0 + ' , ' + ITMDES2_0 + ' , ' + ITMDES3_0 AS ITMDES_0, 
-                           TCLCOD_0,
-                           TSICOD_0,
-                           (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 20 AND IDENT2_0 = TSICOD_0) AS TSICOD_NAME_0,
-                           TSICOD_1,
-                           (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 21 AND IDENT2_0 = TSICOD_1) AS TSICOD_NAME_1,
-                           TSICOD_2,
-                           (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 22 AND IDENT2_0 = TSICOD_2) AS TSICOD_NAME_2,
-                           TSICOD_3,
-                           (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 23 AND IDENT2_0 = TSICOD_3) AS TSICOD_NAME_3,
-                           TSICOD_4,
-                           (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 24 AND IDENT2_0 = TSICOD_4) AS TSICOD_NAME_4,
-                           ROWID
-                           FROM [x3v12src].[SEED].[ITMMASTER]
-                          """
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = """  
+                       SELECT ITMREF_0, 
+                       ITMDES1_0 + ' , ' + ITMDES2_0 + ' , ' + ITMDES3_0 AS ITMDES_0, 
+                       TCLCOD_0,
+                       TSICOD_0,
+                       (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 20 AND IDENT2_0 = TSICOD_0) AS TSICOD_NAME_0,
+                       TSICOD_1,
+                       (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 21 AND IDENT2_0 = TSICOD_1) AS TSICOD_NAME_1,
+                       TSICOD_2,
+                       (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 22 AND IDENT2_0 = TSICOD_2) AS TSICOD_NAME_2,
+                       TSICOD_3,
+                       (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 23 AND IDENT2_0 = TSICOD_3) AS TSICOD_NAME_3,
+                       TSICOD_4,
+                       (SELECT TEXTE_0 FROM [x3v12src].[SEED].[ATEXTRA] WHERE ZONE_0 LIKE '%LNGDES%' AND CODFIC_0 = 'ATABDIV' AND LANGUE_0 = 'FRA' AND IDENT1_0 = 24 AND IDENT2_0 = TSICOD_4) AS TSICOD_NAME_4,
+                       ROWID
+                       FROM [x3v12src].[SEED].[ITMMASTER]
+                      """
+        params = None
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, ITMMASTER_READOUT, readout)
+            folders = readout["folders"]
+        # Read the items of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "ITMMASTER extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
-    
+
 # Function to insert data into ITMMASTER table in Madin Warehouse
 def insert_data_into_ITMMASTER(data, clear_table=False):
     # Load Madina Warehouse database connection config
@@ -133,23 +118,35 @@ def insert_data_into_ITMMASTER(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-
-            # Get the current maximum ROWID in the ITMMASTER table
-            cursor.execute("SELECT MAX(ROWID) FROM ITMMASTER")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
-
-            # Insert new data into ITMMASTER table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[13] > max_rowid:  
-                    cursor.execute("INSERT INTO ITMMASTER (ITMREF_0, ITMDES_0, TCLCOD_0, TSICOD_0, TSICOD_NAME_0, TSICOD_1, TSICOD_NAME_1, TSICOD_2, TSICOD_NAME_2, TSICOD_3, TSICOD_NAME_3, TSICOD_4, TSICOD_NAME_4, ROWID) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8],row[9], row[10], row[11],row[12], row[13]))
-                    rows_inserted += 1
-
-            cnxn.commit()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                new_items = []
+                key_indexes = []
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    # Find the rows whose ROWID is not yet present in this folder of the ITMMASTER table
+                    key_index = load_key_index(cursor, "ITMMASTER", "ROWID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[13] for row in folder_rows])
+
+                    # Insert new data into ITMMASTER table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[13] in new_keys:
+                            cursor.execute("INSERT INTO ITMMASTER (ITMREF_0, ITMDES_0, TCLCOD_0, TSICOD_0, TSICOD_NAME_0, TSICOD_1, TSICOD_NAME_1, TSICOD_2, TSICOD_NAME_2, TSICOD_3, TSICOD_NAME_3, TSICOD_4, TSICOD_NAME_4, ROWID, dossier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8],row[9], row[10], row[11],row[12], row[13], row[14]))
+                            new_items.append((row[0], row[1]))
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
+
+                return key_indexes, new_items, rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, new_items, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "ITMMASTER insert")
+            for key_index in key_indexes:
+                key_index.save()
+            # Add the new rows to the itmmaster search index
+            update_search_index("itmmaster", new_items)
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -175,17 +172,17 @@ def insert_data_into_ITMMASTER_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def synchronize_rows(cursor):
+                # Truncate ITMMASTER table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE ITMMASTER")
 
-            # Truncate ITMMASTER table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE ITMMASTER")
+                # Insert new data into ITMMASTER table
+                for row in data:
+                    cursor.execute("INSERT INTO ITMMASTER (ITMREF_0, ITMDES_0, TCLCOD_0, TSICOD_0, TSICOD_NAME_0, TSICOD_1, TSICOD_NAME_1, TSICOD_2, TSICOD_NAME_2, TSICOD_3, TSICOD_NAME_3, TSICOD_4, TSICOD_NAME_4, ROWID, dossier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                       (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8],row[9], row[10], row[11],row[12], row[13], row[14]))
 
-            # Insert new data into ITMMASTER table
-            for row in data:
-                cursor.execute("INSERT INTO ITMMASTER (ITMREF_0, ITMDES_0, TCLCOD_0, TSICOD_0, TSICOD_NAME_0, TSICOD_1, TSICOD_NAME_1, TSICOD_2, TSICOD_NAME_2, TSICOD_3, TSICOD_NAME_3, TSICOD_4, TSICOD_NAME_4, ROWID) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8],row[9], row[10], row[11],row[12], row[13]))
-
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "ITMMASTER sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -207,7 +204,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT ITMREF_0, ITMDES_0, TCLCOD_0, TSICOD_0, TSICOD_NAME_0, TSICOD_1, TSICOD_NAME_1, TSICOD_2, TSICOD_NAME_2, TSICOD_3, TSICOD_NAME_3, TSICOD_4, TSICOD_NAME_4, ROWID FROM [dw_madin].[dbo].[ITMMASTER]"
+            source_query = "SELECT ITMREF_0, ITMDES_0, TCLCOD_0, TSICOD_0, TSICOD_NAME_0, TSICOD_1, TSICOD_NAME_1, TSICOD_2, TSICOD_NAME_2, TSICOD_3, TSICOD_NAME_3, TSICOD_4, TSICOD_NAME_4, ROWID, dossier FROM [dw_madin].[dbo].[ITMMASTER]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -225,7 +222,7 @@ def synchronize_data():
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("ITMMASTER", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -234,10 +231,29 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_ITMMASTER_sync(source_data.values.tolist())
+        sync_result = insert_data_into_ITMMASTER_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("ITMMASTER", source_data)
+            invalidate_key_index("ITMMASTER")
+            sync_search_index("itmmaster", source_data)
+            # Rebuild the item hierarchy only when the classification of the items changed
+            if refresh_item_hierarchy(source_data) is None:
+                return False
+        return sync_result
     
 
 
+# Function to delete from ITMMASTER the rows that no longer exist in Sage X3
+def delete_removed_rows_from_ITMMASTER():
+    source_from = "[x3v12src].[SEED].[ITMMASTER]"
+    # The codes of the deleted rows are removed from the search index once their deletes are committed
+    deleted_codes = set()
+    result = propagate_folder_deletes(source_from, "ROWID", "ITMMASTER", "ROWID", output_column="ITMREF_0", before_commit=lambda cursor, codes: deleted_codes.update(codes))
+    if result is not None:
+        update_search_index("itmmaster", removed=deleted_codes)
+    return result
+
 @router.post("/madin/warehouse/create-table-itmmaster")
 async def create_ITMMASTER_table_handler(request: Request):
     # Load Madina Warehouse database connection config
@@ -257,6 +273,12 @@ async def insert_data_into_ITMMASTER_handler(request: Request):
         return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
     
     if insert_data_into_ITMMASTER(sagex3_data.values.tolist()):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_ITMMASTER() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to ITMMASTER table.")
+        # Rebuild the item hierarchy if new or removed items changed the classification
+        if refresh_item_hierarchy() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to refresh the item hierarchy.")
         return Response(status_code=201, content="Data inserted into ITMMASTER table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into ITMMASTER table.")
@@ -264,15 +286,23 @@ async def insert_data_into_ITMMASTER_handler(request: Request):
 
 @router.get("/sage/itmmaster")
 async def retrieve_data_from_sage_ITMMASTER(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, ITMMASTER_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage ITMMASTER.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, ITMMASTER_READOUT, readout)})
 
 
 @router.post("/madin/warehouse/synchronize-itmmaster")
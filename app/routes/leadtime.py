@@ -0,0 +1,78 @@
+import pandas as pd
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.etag import get_query_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters
+from app.utils.leadtime import LEADTIME_TABLE, LEADTIME_COLUMNS, rebuild_lead_times
+
+router = APIRouter()
+
+# Columns the lead-time readout can be filtered on
+LEADTIME_READOUT = {"date": "dateCommande", "filters": {"supplier": "codeFournisseur", "item": "codeArticle", "order": "numCommande", "dossier": "dossier"},
+                    "columns": LEADTIME_COLUMNS}
+
+# Function to read the purchase lead-time table of Madin Warehouse.
+# The version of the requested rows is read first: data is None when the client already has it.
+def retrieve_lead_times(readout, request):
+    source_query = f"SELECT * FROM {LEADTIME_TABLE}"
+    source_query, params = apply_readout_filters(source_query, LEADTIME_READOUT, readout)
+
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            etag = get_query_etag(cnxn.cursor(), LEADTIME_TABLE, source_query, params, readout["columns"])
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, pd.read_sql(source_query, cnxn, params=params)
+        except Exception as e:
+            print(f"Error reading {LEADTIME_TABLE}: {e}")
+            return None, None
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return None, None
+
+# Function to rebuild the purchase lead times from PORDER and PRECEIPT
+def rebuild_purchase_lead_times():
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            rows_written = rebuild_lead_times(cursor)
+            cnxn.commit()
+            print(f"{rows_written} rows written into {LEADTIME_TABLE}.")
+            return True
+        except Exception as e:
+            print(f"Error rebuilding {LEADTIME_TABLE}: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
+
+@router.get("/madin/warehouse/purchase-leadtime")
+async def retrieve_lead_times_handler(request: Request):
+    try:
+        readout = parse_readout_filters(request, LEADTIME_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+
+    etag, lead_time_data = await run_in_threadpool(retrieve_lead_times, readout, request)
+    if etag is None:
+        return Response(status_code=500, content="Failed to retrieve purchase lead times.")
+    # Answer 304 when the client already has this version of the lead times
+    if lead_time_data is None:
+        return not_modified_response(etag)
+    return dataframe_response(lead_time_data, headers={"ETag": etag})
+
+@router.post("/madin/warehouse/purchase-leadtime/rebuild")
+async def rebuild_lead_times_handler(request: Request):
+    if await run_in_threadpool(rebuild_purchase_lead_times):
+        return Response(status_code=200, content=f"{LEADTIME_TABLE} rebuilt successfully.")
+    else:
+        return Response(status_code=500, content=f"Internal Server Error - Failed to rebuild {LEADTIME_TABLE}.")
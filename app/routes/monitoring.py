@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Request
+from app.utils.retry import get_retry_counts
+from app.utils.cache import get_query_result_cache
+
+router = APIRouter()
+
+@router.get("/madin/warehouse/retry-stats")
+async def retrieve_retry_stats(request: Request):
+    # Number of transient-error retries per extract/load operation since startup
+    return get_retry_counts()
+
+@router.get("/madin/warehouse/cache-stats")
+async def retrieve_cache_stats(request: Request):
+    # Hits, misses, coalesced requests, evictions and hit rate of each cached readout endpoint
+    return get_query_result_cache().get_stats()
+
+@router.post("/madin/warehouse/cache-clear")
+async def clear_cache(request: Request):
+    # Drop the cached Sage X3 extracts, the next readouts query Sage X3 again
+    get_query_result_cache().clear()
+    return {"cleared": True}
@@ -1,40 +1,26 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot, invalidate_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.ddl import apply_table_design, add_missing_column
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.shards import company_sharding_enabled, synchronize_by_company
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, FOLDER_COLUMN
+from app.utils.leadtime import refresh_lead_time_orders, refresh_lead_times, get_changed_orders
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+PORDER_COLUMNS = ["ROWID", "CRY_0", "numCommande", "ligneCommande", "codeFournisseur", "dateCommande", "codeArticle", "quantite", "montantHT", "dossier"]
+
+# Columns the /sage readout can be filtered and paged on
+PORDER_READOUT = {"key": "ROWID", "date": "dateCommande", "filters": {"company": "CPY_0", "supplier": "codeFournisseur", "item": "codeArticle"}, "folders": True,
+                  "columns": ["ROWID", "CPY_0", "numCommande", "ligneCommande", "codeFournisseur", "dateCommande", "codeArticle", "quantite", "montantHT"]}
 
 # Function to create PORDER table in Madin Warehouse
 def create_PORDER_table(db_config):
@@ -52,11 +38,13 @@ def create_PORDER_table(db_config):
                     ROWID INT,
                     CRY_0 VARCHAR(255),
                     numCommande VARCHAR(255),
+                    ligneCommande INT,
                     codeFournisseur VARCHAR(255),
                     dateCommande DATE,
                     codeArticle VARCHAR(255),
                     quantite INT,
                     montantHT FLOAT,
+                    dossier VARCHAR(50)
 
 
                 )
@@ -68,6 +56,18 @@ def create_PORDER_table(db_config):
                 print("PORDER table created successfully.")
             else:
                 print("PORDER table already exists.")
+                # Orders are now extracted one row per order line: the rows loaded at the old grain
+                # are dropped and reloaded by the next synchronization
+                if add_missing_column(cursor, "PORDER", "ligneCommande", "INT"):
+                    cursor.execute("TRUNCATE TABLE PORDER")
+                    invalidate_snapshot("PORDER")
+                    invalidate_key_index("PORDER")
+                    print("PORDER migrated to the order line grain, synchronize it to reload the data.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "PORDER")
+            # Create the clustered key and indexes, or migrate an existing table in place
+            apply_table_design(cursor, "PORDER")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -80,37 +80,38 @@ def create_PORDER_table(db_config):
             cnxn.close()
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(company=None, readout=None):
+    sagex3_db = load_sage_x3_db_config()
     try:
-        # Load Sage X3 database connection config from JSON
-        sagex3_db = load_sage_x3_db_config()
-
-        # Establish connection to Sage X3 database
-        cnxn = get_connection(sagex3_db)
-        if cnxn:
-            source_query = """
-                            select PORDER.ROWID,
+        source_query = """
+                            select PORDERQ.ROWID,
                                PORDER.CPY_0 ,
                                PORDER. POHNUM_0 as numCommande,
+                               PORDERQ.POPLIN_0 as ligneCommande,
                                PORDER .BPSNUM_0  as codeFournisseur ,
                                PORDER.ORDDAT_0 as dateCommande,
                                PORDERQ.ITMREF_0 as codeArticle,
                                QTYSTU_0 as quantite,
                                NETPRI_0*CHGCOE_0*QTYSTU_0 as montantHT  
-	                           from [x3v12src].[SEED].[PORDER] inner join [x3v12src].[SEED].[PORDERQ] ON PORDERQ .POHNUM_0=PORDER .POHNUM_0 inner join [x3v12src].[SEED].[PORDERP] ON PORDER.POHNUM_0 =PORDERP .POHNUM_0  
+	                           from [x3v12src].[SEED].[PORDER] inner join [x3v12src].[SEED].[PORDERQ] ON PORDERQ .POHNUM_0=PORDER .POHNUM_0 inner join [x3v12src].[SEED].[PORDERP] ON PORDERQ.POHNUM_0 =PORDERP .POHNUM_0 and PORDERQ.POPLIN_0 =PORDERP .POPLIN_0
 
                            """
-            data = pd.read_sql(source_query, cnxn)
-            return data  # Return DataFrame directly
-        else:
-            print("Failed to connect to the source database.")
-            return None
+        params = None
+        if company is not None:
+            # Only extract the slice of one company (sharded sync)
+            source_query = f"SELECT * FROM ({source_query}) AS company_extract WHERE company_extract.CPY_0 = ?"
+            params = [company]
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, PORDER_READOUT, readout, params)
+            folders = readout["folders"]
+        # Read headers and lines in one snapshot transaction of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "PORDER extract", params=params, folders=folders)
+        return data
     except Exception as e:
         print(f"Error retrieving data from Sage X3: {e}")
         return None
-    finally:
-        if cnxn:
-            cnxn.close()
 
 # Function to insert data into PORDER table in Madin Warehouse
 def insert_data_into_PORDER(data, clear_table=False):
@@ -121,23 +122,35 @@ def insert_data_into_PORDER(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-
-            # Get the current maximum ROWID in the PORDER table
-            cursor.execute("SELECT MAX(ROWID) FROM PORDER")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
-
-            # Insert new data into PORDER table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[0] > max_rowid:  # Assuming ROWID is at index 2 in each row
-                    cursor.execute("INSERT INTO PORDER (ROWID,CRY_0,numCommande,codeFournisseur,dateCommande,codeArticle,quantite,montantHT) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7]))
-                    rows_inserted += 1
-
-            cnxn.commit()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                key_indexes = []
+                inserted_orders = []
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    # Find the rows whose ROWID is not yet present in this folder of the PORDER table
+                    key_index = load_key_index(cursor, "PORDER", "ROWID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
+
+                    # Insert new data into PORDER table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[0] in new_keys:
+                            cursor.execute("INSERT INTO PORDER (ROWID,CRY_0,numCommande,ligneCommande,codeFournisseur,dateCommande,codeArticle,quantite,montantHT,dossier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8], row[9]))
+                            folder_rows_inserted += 1
+                            inserted_orders.append(row[2])
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
+
+                # Recompute the purchase lead times of the orders of the new lines
+                refresh_lead_time_orders(cursor, inserted_orders)
+                return key_indexes, rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "PORDER insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -154,7 +167,8 @@ def insert_data_into_PORDER(data, clear_table=False):
         return False
 
 # Function to insert data into PORDER table in Madin Warehouse
-def insert_data_into_PORDER_sync(data):
+# (changed_orders are the orders whose purchase lead times are recomputed with the load)
+def insert_data_into_PORDER_sync(data, changed_orders=None):
     # Load Madina Warehouse database connection config
     madin_warehouse_db = load_madin_warehouse_db_config()
 
@@ -162,17 +176,19 @@ def insert_data_into_PORDER_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def synchronize_rows(cursor):
+                # Truncate PORDER table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE PORDER")
 
-            # Truncate PORDER table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE PORDER")
+                # Insert new data into PORDER table
+                for _, row in data.iterrows():
+                    cursor.execute("INSERT INTO PORDER (ROWID,CRY_0,numCommande,ligneCommande,codeFournisseur,dateCommande,codeArticle,quantite,montantHT,dossier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   tuple(row))
 
-            # Insert new data into PORDER table
-            for _, row in data.iterrows():
-                cursor.execute("INSERT INTO PORDER (ROWID,CRY_0,numCommande,codeFournisseur,dateCommande,codeArticle,quantite,montantHT) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                               tuple(row))
+                refresh_lead_time_orders(cursor, changed_orders if changed_orders is not None else data["numCommande"])
 
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "PORDER sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -194,7 +210,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT ROWID,CRY_0,numCommande,codeFournisseur,dateCommande,codeArticle,quantite,montantHT FROM [dw_madin].[dbo].[PORDER]"
+            source_query = "SELECT ROWID,CRY_0,numCommande,ligneCommande,codeFournisseur,dateCommande,codeArticle,quantite,montantHT,dossier FROM [dw_madin].[dbo].[PORDER]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -209,11 +225,18 @@ def retrieve_data_from_target():
     
 # Function to compare data between source and target databases and synchronize if needed
 def synchronize_data():
+    # Sync company by company, each company slice on its own, when sharding is enabled for PORDER
+    if company_sharding_enabled("PORDER"):
+        if not synchronize_by_company("PORDER", PORDER_COLUMNS, "CRY_0", lambda company: retrieve_data_from_sagex3(company=company)):
+            return False
+        # The slices commit on their own, the lead times are recomputed once they are all loaded
+        return refresh_lead_times()
+
     source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("PORDER", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -222,9 +245,21 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_PORDER_sync(source_data)
+        sync_result = insert_data_into_PORDER_sync(source_data, get_changed_orders(source_data, target_data))
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("PORDER", source_data)
+            invalidate_key_index("PORDER")
+        return sync_result
 
     
+# Function to delete from PORDER the rows that no longer exist in Sage X3
+def delete_removed_rows_from_PORDER():
+    source_from = "[x3v12src].[SEED].[PORDER] inner join [x3v12src].[SEED].[PORDERQ] ON PORDERQ.POHNUM_0=PORDER.POHNUM_0"
+    # The lead times of the orders of the deleted lines are recomputed with each delete batch
+    return propagate_folder_deletes(source_from, "PORDERQ.ROWID", "PORDER", "ROWID", output_column="numCommande",
+                                    before_commit=refresh_lead_time_orders)
+
 @router.post("/madin/warehouse/create-table-porder")
 async def create_PORDER_table_handler(request: Request):
     # Load Madina Warehouse database connection config
@@ -248,6 +283,9 @@ async def insert_data_into_PORDER_handler(request: Request):
     sagex3_data_tuples = [tuple(x) for x in sagex3_data.values]
 
     if insert_data_into_PORDER(sagex3_data_tuples):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_PORDER() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to PORDER table.")
         return Response(status_code=201, content="Data inserted into PORDER table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into PORDER table.")
@@ -255,15 +293,23 @@ async def insert_data_into_PORDER_handler(request: Request):
 
 @router.get("/sage/porder")
 async def retrieve_data_from_sage_porder(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, PORDER_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage porder.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, PORDER_READOUT, readout)})
 
 @router.post("/madin/warehouse/synchronize_porder")
 async def synchronize_porder_data(request: Request):
@@ -1,40 +1,28 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot, invalidate_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.ddl import apply_table_design, add_missing_column
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.shards import company_sharding_enabled, synchronize_by_company, clear_watermarks
+from app.utils.checkpoint import clear_checkpoint
+from app.utils.dimkeys import load_dimension_keys, append_dimension_keys, add_dimension_key_columns
+from app.utils.summary import refresh_summary_days, rebuild_summaries
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+SDELIVERY_COLUMNS = ["rowID", "societe", "numBL", "ligneBL", "codeClient", "dateLivraison", "codeArticle", "quantite", "montantTTc", "MontantPrixRevi", "dossier"]
+
+# Columns the /sage readout can be filtered and paged on (ROWID of the delivery line, unique in a folder)
+SDELIVERY_READOUT = {"key": "ROWID", "date": "datelivraison", "filters": {"company": "societe", "customer": "CODECLIENT", "item": "codearticle"}, "folders": True,
+                     "columns": ["ROWID", "societe", "numBL", "ligneBL", "CODECLIENT", "datelivraison", "codearticle", "quantite", "montantTTc", "MontantPrixRevi"]}
 
 # Function to create SDELIVERY table in Madin Warehouse
 def create_SDELIVERY_table(db_config):
@@ -52,12 +40,18 @@ def create_SDELIVERY_table(db_config):
                     rowID INT,
                     societe VARCHAR(255),
                     numBL VARCHAR(255),
+                    ligneBL INT,
                     codeClient VARCHAR(255),
                     dateLivraison DATE,
                     codeArticle VARCHAR(255),
                     quantite FLOAT,
                     montantTTc FLOAT,
-                    MontantPrixRevi FLOAT
+                    MontantPrixRevi FLOAT,
+                    dossier VARCHAR(50),
+                    DateKey INT,
+                    customerKey INT,
+                    itemKey INT,
+                    companyKey INT
                     
                 )
                 """
@@ -68,6 +62,25 @@ def create_SDELIVERY_table(db_config):
                 print("SDELIVERY table created successfully.")
             else:
                 print("SDELIVERY table already exists.")
+                # Deliveries were keyed on the ROWID of the header, shared by all its lines: they are now
+                # keyed on the ROWID of the delivery line, the rows loaded before are dropped and reloaded.
+                # The saved sync state goes with them, or the company watermarks would skip the reload.
+                if add_missing_column(cursor, "SDELIVERY", "ligneBL", "INT"):
+                    cursor.execute("TRUNCATE TABLE SDELIVERY")
+                    clear_watermarks(cursor, "SDELIVERY")
+                    clear_checkpoint(cursor, "SDELIVERY")
+                    invalidate_snapshot("SDELIVERY")
+                    invalidate_key_index("SDELIVERY")
+                    print("SDELIVERY migrated to the delivery line grain, synchronize it to reload the data.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "SDELIVERY")
+            # Integer date and dimension keys, filled for the rows already loaded
+            add_dimension_key_columns(cursor, "SDELIVERY")
+            # Create the clustered key and indexes, or migrate an existing table in place
+            apply_table_design(cursor, "SDELIVERY")
+            # Create the daily and monthly summary tables, rebuilt from the fact rows
+            rebuild_summaries(cursor, "SDELIVERY")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -81,23 +94,25 @@ def create_SDELIVERY_table(db_config):
 
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(company=None, readout=None):
     sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "select SDELIVERY .ROWID,SDELIVERY.CPY_0 AS societe,SDELIVERY. SDHNUM_0 AS numBL,SDELIVERY.BPCORD_0  as CODECLIENT ,SDELIVERY.SHIDAT_0 as datelivraison,SDELIVERYD.ITMREF_0 AS codearticle,(QTY_0-RTNQTY_0) AS quantite,NETPRI_0*CHGRAT_0*(QTY_0-RTNQTY_0) AS montantTTc ,CPRPRI_0*CHGRAT_0 *(QTY_0-RTNQTY_0) as MontantPrixRevi from [x3v12src].[SEED].[SDELIVERY]  inner join [x3v12src].[SEED].[SDELIVERYD] ON SDELIVERY .SDHNUM_0=SDELIVERYD .SDHNUM_0"
-
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = "select SDELIVERYD.ROWID,SDELIVERY.CPY_0 AS societe,SDELIVERY. SDHNUM_0 AS numBL,SDELIVERYD.SDDLIN_0 AS ligneBL,SDELIVERY.BPCORD_0  as CODECLIENT ,SDELIVERY.SHIDAT_0 as datelivraison,SDELIVERYD.ITMREF_0 AS codearticle,(QTY_0-RTNQTY_0) AS quantite,NETPRI_0*CHGRAT_0*(QTY_0-RTNQTY_0) AS montantTTc ,CPRPRI_0*CHGRAT_0 *(QTY_0-RTNQTY_0) as MontantPrixRevi from [x3v12src].[SEED].[SDELIVERY]  inner join [x3v12src].[SEED].[SDELIVERYD] ON SDELIVERY .SDHNUM_0=SDELIVERYD .SDHNUM_0"
+        params = None
+        if company is not None:
+            # Only extract the slice of one company (sharded sync)
+            source_query = f"SELECT * FROM ({source_query}) AS company_extract WHERE company_extract.societe = ?"
+            params = [company]
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, SDELIVERY_READOUT, readout, params)
+            folders = readout["folders"]
+        # Read headers and lines in one snapshot transaction of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "SDELIVERY extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
 
 # Function to insert data into SDELIVERY table in Madina Warehouse
@@ -108,23 +123,38 @@ def insert_data_into_SDELIVERY(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
-
-            # Get the current maximum ROWID in the SDELIVERY table
-            cursor.execute("SELECT MAX(rowID) FROM SDELIVERY")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
-
-            # Insert new data into SDELIVERY table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[0] > max_rowid:
-                    cursor.execute("INSERT INTO SDELIVERY (rowID,societe,numBL,codeClient,dateLivraison,codeArticle,quantite,montantTTc,MontantPrixRevi) VALUES (?, ?, ?, ?, ?, ?, ?, ?,?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6],row[7],row[8]))
-                    rows_inserted += 1
-
-            cnxn.commit()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                inserted_dates = []
+                key_indexes = []
+                # Surrogate key maps loaded once, the keys of each folder batch are looked up in one pass
+                dimension_keys = load_dimension_keys()
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    folder_rows = append_dimension_keys(folder_rows, SDELIVERY_COLUMNS, "SDELIVERY", dimension_keys)
+                    # Find the rows whose rowID is not yet present in this folder of the SDELIVERY table
+                    key_index = load_key_index(cursor, "SDELIVERY", "rowID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
+
+                    # Insert new data into SDELIVERY table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[0] in new_keys:
+                            cursor.execute("INSERT INTO SDELIVERY (rowID,societe,numBL,ligneBL,codeClient,dateLivraison,codeArticle,quantite,montantTTc,MontantPrixRevi,dossier,DateKey,customerKey,itemKey,companyKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6],row[7],row[8], row[9], row[10], row[11], row[12], row[13], row[14]))
+                            inserted_dates.append(row[5])
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
+
+                # Adjust the summaries of the days of the new rows, committed with them
+                refresh_summary_days(cursor, "SDELIVERY", inserted_dates)
+                return key_indexes, rows_inserted
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "SDELIVERY insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -150,7 +180,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT rowID,societe,numBL,codeClient,dateLivraison,codeArticle,quantite,montantTTc,MontantPrixRevi FROM [dw_madin].[dbo].[SDELIVERY]"
+            source_query = "SELECT rowID,societe,numBL,ligneBL,codeClient,dateLivraison,codeArticle,quantite,montantTTc,MontantPrixRevi,dossier FROM [dw_madin].[dbo].[SDELIVERY]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -172,17 +202,23 @@ def insert_data_into_SDELIVERY_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            # The date and dimension keys are appended once, outside the replayed transaction
+            data = append_dimension_keys(data, SDELIVERY_COLUMNS, "SDELIVERY", load_dimension_keys())
 
-            # Truncate SDELIVERY table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE SDELIVERY")
+            def synchronize_rows(cursor):
+                # Truncate SDELIVERY table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE SDELIVERY")
 
-            # Insert new data into SDELIVERY table
-            for row in data:
-                cursor.execute("INSERT INTO SDELIVERY (rowID,societe,numBL,codeClient,dateLivraison,codeArticle,quantite,montantTTc,MontantPrixRevi) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                   (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8]))
+                # Insert new data into SDELIVERY table, with its date and dimension keys
+                for row in data:
+                    cursor.execute("INSERT INTO SDELIVERY (rowID,societe,numBL,ligneBL,codeClient,dateLivraison,codeArticle,quantite,montantTTc,MontantPrixRevi,dossier,DateKey,customerKey,itemKey,companyKey) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                       (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], row[14]))
 
-            cnxn.commit()
+                # Rebuild the summaries from the reloaded table in the same transaction
+                rebuild_summaries(cursor, "SDELIVERY")
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "SDELIVERY sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -196,11 +232,15 @@ def insert_data_into_SDELIVERY_sync(data):
 
 # Function to compare data between source and target databases and synchronize if needed
 def synchronize_data():
+    # Sync company by company, each company slice on its own, when sharding is enabled for SDELIVERY
+    if company_sharding_enabled("SDELIVERY"):
+        return synchronize_by_company("SDELIVERY", SDELIVERY_COLUMNS, "societe", lambda company: retrieve_data_from_sagex3(company=company))
+
     source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("SDELIVERY", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -209,11 +249,23 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_SDELIVERY_sync(source_data.values.tolist())
+        sync_result = insert_data_into_SDELIVERY_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("SDELIVERY", source_data)
+            invalidate_key_index("SDELIVERY")
+        return sync_result
 
 
 
 
+# Function to delete from SDELIVERY the rows that no longer exist in Sage X3
+def delete_removed_rows_from_SDELIVERY():
+    source_from = "[x3v12src].[SEED].[SDELIVERY] inner join [x3v12src].[SEED].[SDELIVERYD] ON SDELIVERY.SDHNUM_0=SDELIVERYD.SDHNUM_0"
+    # The summaries of the days of the deleted rows are adjusted in each delete transaction
+    return propagate_folder_deletes(source_from, "SDELIVERYD.ROWID", "SDELIVERY", "rowID",
+                                    output_column="dateLivraison", before_commit=lambda cursor, dates: refresh_summary_days(cursor, "SDELIVERY", dates))
+
 @router.post("/madin/warehouse/insert-data-salesdelivery")
 async def insert_data_into_SDELIVERY_handler(request: Request):
     # Retrieve data from Sage X3
@@ -222,6 +274,9 @@ async def insert_data_into_SDELIVERY_handler(request: Request):
         return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
     
     if insert_data_into_SDELIVERY(sagex3_data.values.tolist()):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_SDELIVERY() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to SDELIVERY table.")
         return Response(status_code=201, content="Data inserted into SDELIVERY table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into SDELIVERY table.")
@@ -229,15 +284,23 @@ async def insert_data_into_SDELIVERY_handler(request: Request):
 
 @router.get("/sage/salesdelivery")
 async def retrieve_data_from_sage_customers(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, SDELIVERY_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage customers.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, SDELIVERY_READOUT, readout)})
 
 @router.post("/madin/warehouse/create-table-salesdelivery")
 async def create_SDELIVERY_table_handler(request: Request):
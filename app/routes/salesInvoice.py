@@ -1,40 +1,32 @@
-import pyodbc
 import pandas as pd
-import os
-import json
+from datetime import date, timedelta
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot, invalidate_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.ddl import apply_table_design, create_staging_table, switch_period_into_table
+from app.utils.checkpoint import retrieve_checkpoint, load_checkpoint, start_checkpoint, save_checkpoint, complete_checkpoint
+from app.utils.config import get_sync_setting
+from app.utils.retry import run_batch_with_retry, get_retry_counts, run_transaction_with_retry
+from app.utils.folders import get_folders, run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, make_folder_key, parse_folder_key, FOLDER_COLUMN
+from app.utils.bulkload import get_row_writer
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.shards import company_sharding_enabled, synchronize_by_company
+from app.utils.dimkeys import load_dimension_keys, append_dimension_keys, add_dimension_key_columns, get_dimension_key_columns
+from app.utils.summary import refresh_summary_days, rebuild_summaries, refresh_summary_period
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+SALESINVOICE_COLUMNS = ["rowID", "societe", "numFacture", "ligneFacture", "codeClient", "dateFacture", "codeArticle", "quantite", "montantHT", "montantTTC", "representant", "montantPrixRevi", "marge", "dossier"]
+
+# Columns the /sage readout can be filtered and paged on
+SALESINVOICE_READOUT = {"key": "rowID", "date": "dateFacture", "filters": {"company": "societe", "customer": "codeClient", "item": "codeArticle", "representative": "representant"}, "folders": True,
+                        "columns": ["rowID", "societe", "numFacture", "ligneFacture", "codeClient", "dateFacture", "codeArticle", "quantite", "montantHT", "montantTTC",
+                                    "representant", "MontantPrixRevi", "marge"]}
 
 # Function to create SINVOICE table in Madin Warehouse
 def create_SALESINVOICE_table(db_config):
@@ -61,7 +53,12 @@ def create_SALESINVOICE_table(db_config):
                     montantTTC FLOAT,
                     representant VARCHAR(255),
                     montantPrixRevi FLOAT,
-                    marge FLOAT
+                    marge FLOAT,
+                    dossier VARCHAR(50),
+                    DateKey INT,
+                    customerKey INT,
+                    itemKey INT,
+                    companyKey INT
                     
                 )
                 """
@@ -72,6 +69,15 @@ def create_SALESINVOICE_table(db_config):
                 print("SALESINVOICE table created successfully.")
             else:
                 print("SALESINVOICE table already exists.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "SALESINVOICE")
+            # Integer date and dimension keys, filled for the rows already loaded
+            add_dimension_key_columns(cursor, "SALESINVOICE")
+            # Create the clustered key and indexes, or migrate an existing table in place
+            apply_table_design(cursor, "SALESINVOICE")
+            # Create the daily and monthly summary tables, rebuilt from the fact rows
+            rebuild_summaries(cursor, "SALESINVOICE")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -85,22 +91,36 @@ def create_SALESINVOICE_table(db_config):
 
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(min_rowid=None, date_from=None, date_to=None, folders=None, company=None, readout=None):
     sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "select SINVOICED.ROWID as rowID,SINVOICE.CPY_0 as societe,SINVOICE.NUM_0 as numFacture,SINVOICED .SIDLIN_0 as ligneFacture,SINVOICE.BPR_0  as codeClient ,SINVOICE.ACCDAT_0 as dateFacture,SINVOICED.ITMREF_0 as codeArticle,QTY_0 as quantite,NETPRI_0 *QTY_0*SNS_0 *RATMLT_0 as montantHT ,NETPRIATI_0 *SNS_0 *QTY_0*RATMLT_0 as montantTTC,(select YREP_0 from [x3v12src].[dbo].YREPRE where YBPCNUM_0=BPR_0 and YCPY_0 =SINVOICE.CPY_0 ) as representant,CPRPRI_0 *SNS_0 *RATMLT_0*QTY_0 as MontantPrixRevi,NETPRI_0 *QTY_0*SNS_0 *RATMLT_0 - CPRPRI_0 *SNS_0 *RATMLT_0*QTY_0 as marge  from [x3v12src].[SEED].[SINVOICE] inner join [x3v12src].[SEED].[SINVOICED] ON SINVOICE .NUM_0=SINVOICED .NUM_0" 
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = "select SINVOICED.ROWID as rowID,SINVOICE.CPY_0 as societe,SINVOICE.NUM_0 as numFacture,SINVOICED .SIDLIN_0 as ligneFacture,SINVOICE.BPR_0  as codeClient ,SINVOICE.ACCDAT_0 as dateFacture,SINVOICED.ITMREF_0 as codeArticle,QTY_0 as quantite,NETPRI_0 *QTY_0*SNS_0 *RATMLT_0 as montantHT ,NETPRIATI_0 *SNS_0 *QTY_0*RATMLT_0 as montantTTC,(select YREP_0 from [x3v12src].[dbo].YREPRE where YBPCNUM_0=BPR_0 and YCPY_0 =SINVOICE.CPY_0 ) as representant,CPRPRI_0 *SNS_0 *RATMLT_0*QTY_0 as MontantPrixRevi,NETPRI_0 *QTY_0*SNS_0 *RATMLT_0 - CPRPRI_0 *SNS_0 *RATMLT_0*QTY_0 as marge  from [x3v12src].[SEED].[SINVOICE] inner join [x3v12src].[SEED].[SINVOICED] ON SINVOICE .NUM_0=SINVOICED .NUM_0" 
+        conditions = []
+        params = []
+        if min_rowid is not None:
+            # Only extract the lines after the last committed checkpoint
+            conditions.append("SINVOICED.ROWID > ?")
+            params.append(min_rowid)
+        if date_from is not None and date_to is not None:
+            # Only extract the invoices of the period being reloaded
+            conditions.append("SINVOICE.ACCDAT_0 >= ? AND SINVOICE.ACCDAT_0 < ?")
+            params.extend([date_from, date_to + timedelta(days=1)])
+        if company is not None:
+            # Only extract the invoices of one company (sharded sync)
+            conditions.append("SINVOICE.CPY_0 = ?")
+            params.append(company)
+        if conditions:
+            source_query += " WHERE " + " AND ".join(conditions)
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, SALESINVOICE_READOUT, readout, params)
+            folders = readout["folders"] or folders
+        params = params or None
+        # Read headers and lines in one snapshot transaction of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "SALESINVOICE extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error executing query: {e}")
         return None
 
 # Function to insert data into SALESINVOICE table in Madina Warehouse
@@ -111,23 +131,38 @@ def insert_data_into_SALESINVOICE(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                inserted_dates = []
+                key_indexes = []
+                # Surrogate key maps loaded once, the keys of each folder batch are looked up in one pass
+                dimension_keys = load_dimension_keys()
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    folder_rows = append_dimension_keys(folder_rows, SALESINVOICE_COLUMNS, "SALESINVOICE", dimension_keys)
+                    # Find the rows whose rowID is not yet present in this folder of the SALESINVOICE table
+                    key_index = load_key_index(cursor, "SALESINVOICE", "rowID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
 
-            # Get the current maximum ROWID in the SINVOICE table
-            cursor.execute("SELECT MAX(rowID) FROM SALESINVOICE")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
+                    # Insert new data into SALESINVOICE table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[0] in new_keys:
+                            cursor.execute("INSERT INTO SALESINVOICE (rowID,societe,numFacture,ligneFacture,codeClient,dateFacture,codeArticle,quantite,montantHT,montantTTC,representant,montantPrixRevi,marge,dossier,DateKey,customerKey,itemKey,companyKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?,?,?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6],row[7],row[8],row[9],row[10],row[11],row[12], row[13], row[14], row[15], row[16], row[17]))
+                            inserted_dates.append(row[5])
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
 
-            # Insert new data into SALESINVOICE table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[0] > max_rowid:
-                    cursor.execute("INSERT INTO SALESINVOICE (rowID,societe,numFacture,ligneFacture,codeClient,dateFacture,codeArticle,quantite,montantHT,montantTTC,representant,montantPrixRevi,marge) VALUES (?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?,?,?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6],row[7],row[8],row[9],row[10],row[11],row[12]))
-                    rows_inserted += 1
+                # Adjust the summaries of the days of the new rows, committed with them
+                refresh_summary_days(cursor, "SALESINVOICE", inserted_dates)
+                return key_indexes, rows_inserted
 
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "SALESINVOICE insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -153,7 +188,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT rowID,societe,numFacture,ligneFacture,codeClient,dateFacture,codeArticle,quantite,montantHT,montantTTC,representant,montantPrixRevi,marge FROM [dw_madin].[dbo].[SALESINVOICE]"
+            source_query = "SELECT rowID,societe,numFacture,ligneFacture,codeClient,dateFacture,codeArticle,quantite,montantHT,montantTTC,representant,montantPrixRevi,marge,dossier FROM [dw_madin].[dbo].[SALESINVOICE]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -167,7 +202,9 @@ def retrieve_data_from_target():
     
 
 # Function to insert data into SALESINVOICE table in Madin Warehouse
-def insert_data_into_SALESINVOICE_sync(data):
+def insert_data_into_SALESINVOICE_sync(data, resume=False):
+    batch_size = get_sync_setting("checkpoint", "batch_size", 5000)
+
     # Load Madina Warehouse database connection config
     madin_warehouse_db = load_madin_warehouse_db_config()
 
@@ -175,18 +212,47 @@ def insert_data_into_SALESINVOICE_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def start_load(cursor):
+                if resume:
+                    # Continue after the rows already committed by the interrupted load
+                    checkpoint = load_checkpoint(cursor, "SALESINVOICE")
+                    return checkpoint["rows_loaded"] if checkpoint else 0
+                # Truncate SALESINVOICE table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE SALESINVOICE")
+                start_checkpoint(cursor, "SALESINVOICE")
+                return 0
 
-            # Truncate SALESINVOICE table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE SALESINVOICE")
+            cnxn, rows_loaded = run_transaction_with_retry(cnxn, madin_warehouse_db, start_load, "SALESINVOICE load")
 
-            # Insert new data into SALESINVOICE table
-            for row in data:
-                cursor.execute("INSERT INTO SALESINVOICE (rowID,societe,numFacture,ligneFacture,codeClient,dateFacture,codeArticle,quantite,montantHT,montantTTC,representant,montantPrixRevi,marge) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                   (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12]))
+            # Insert new data into SALESINVOICE table by batches ordered on folder then rowID,
+            # each batch being committed together with its checkpoint
+            # The date and dimension keys of each batch are appended with maps loaded once for the load
+            key_columns = get_dimension_key_columns("SALESINVOICE")
+            dimension_keys = load_dimension_keys()
+            writer = get_row_writer("SALESINVOICE", SALESINVOICE_COLUMNS + key_columns)
+            folder_order = {folder["name"]: position for position, folder in enumerate(get_folders())}
+            data = sorted(data, key=lambda row: (folder_order.get(row[13], len(folder_order)), row[0]))
+            for start in range(0, len(data), batch_size):
+                batch = data[start:start + batch_size]
+                rows_loaded += len(batch)
 
-            cnxn.commit()
-            print("Data synchronized successfully.")
+                def load_batch(batch_cnxn, batch=batch, rows_loaded=rows_loaded):
+                    batch_cursor = batch_cnxn.cursor()
+                    writer.write(batch_cursor, append_dimension_keys(batch, SALESINVOICE_COLUMNS, "SALESINVOICE", dimension_keys))
+                    save_checkpoint(batch_cursor, "SALESINVOICE", make_folder_key(batch[-1][13], batch[-1][0]), rows_loaded)
+                    batch_cnxn.commit()
+
+                # Replay only this batch after a deadlock, lock timeout or dropped connection
+                cnxn = run_batch_with_retry(cnxn, madin_warehouse_db, load_batch, "SALESINVOICE load")
+
+            def complete_load(cursor):
+                # Rebuild the summaries from the reloaded table when the load completes
+                rebuild_summaries(cursor, "SALESINVOICE")
+                complete_checkpoint(cursor, "SALESINVOICE")
+
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, complete_load, "SALESINVOICE load")
+            retries = get_retry_counts().get("SALESINVOICE load", 0)
+            print(f"Data synchronized successfully. {rows_loaded} rows loaded, {retries} batch retries since startup.")
             return True
         except Exception as e:
             print(f"Error inserting data into target database: {e}")
@@ -197,13 +263,106 @@ def insert_data_into_SALESINVOICE_sync(data):
         print("Failed to connect to the target database.")
         return False
 
+# Function to reload one period of SALESINVOICE: the period is loaded into a staging table,
+# then swapped into SALESINVOICE (whole years by partition switch, partial years by DELETE/INSERT)
+def reload_SALESINVOICE_period(data, date_from, date_to):
+    batch_size = get_sync_setting("checkpoint", "batch_size", 5000)
+
+    # Load Madina Warehouse database connection config
+    madin_warehouse_db = load_madin_warehouse_db_config()
+
+    # Establish connection to Madin Warehouse database
+    cnxn = get_connection(madin_warehouse_db)
+    if cnxn:
+        try:
+            cnxn, staging_name = run_transaction_with_retry(cnxn, madin_warehouse_db, lambda cursor: create_staging_table(cursor, "SALESINVOICE"), "SALESINVOICE period load")
+
+            # Load the period into the staging table by batches
+            key_columns = get_dimension_key_columns("SALESINVOICE")
+            dimension_keys = load_dimension_keys()
+            writer = get_row_writer(staging_name, SALESINVOICE_COLUMNS + key_columns)
+            for start in range(0, len(data), batch_size):
+                batch = data[start:start + batch_size]
+
+                def load_batch(batch_cnxn, batch=batch):
+                    batch_cursor = batch_cnxn.cursor()
+                    writer.write(batch_cursor, append_dimension_keys(batch, SALESINVOICE_COLUMNS, "SALESINVOICE", dimension_keys))
+                    batch_cnxn.commit()
+
+                cnxn = run_batch_with_retry(cnxn, madin_warehouse_db, load_batch, "SALESINVOICE period load")
+
+            # Swap the period in a single transaction, replayed as a whole after a transient error
+            swap_result = {}
+
+            def swap_period(swap_cnxn):
+                swap_cursor = swap_cnxn.cursor()
+                swap_result["switched_years"], swap_result["spans"] = switch_period_into_table(swap_cursor, "SALESINVOICE", staging_name, SALESINVOICE_COLUMNS + key_columns, date_from, date_to)
+                refresh_summary_period(swap_cursor, "SALESINVOICE", date_from, date_to)
+                swap_cursor.execute(f"DROP TABLE {staging_name}")
+                swap_cnxn.commit()
+
+            cnxn = run_batch_with_retry(cnxn, madin_warehouse_db, swap_period, "SALESINVOICE period swap")
+            print(f"SALESINVOICE period {date_from} to {date_to} reloaded: {len(data)} rows, "
+                  f"{len(swap_result['switched_years'])} partitions switched, {len(swap_result['spans'])} ranges rewritten.")
+            return True
+        except Exception as e:
+            print(f"Error reloading SALESINVOICE period: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
+
+# Function to synchronize only the invoices dated within a period
+def synchronize_period(date_from, date_to):
+    # An interrupted full load is finished first, the period is then reloaded on top of it
+    if retrieve_checkpoint("SALESINVOICE") is not None and not synchronize_data():
+        return False
+
+    source_data = retrieve_data_from_sagex3(date_from=date_from, date_to=date_to)
+    if source_data is None:
+        return False
+
+    sync_result = reload_SALESINVOICE_period(source_data.values.tolist(), date_from, date_to)
+    if sync_result:
+        # The snapshot and key index only cover the whole table, the next sync rebuilds them
+        invalidate_snapshot("SALESINVOICE")
+        invalidate_key_index("SALESINVOICE")
+    return sync_result
+
 # Function to compare data between source and target databases and synchronize if needed
 def synchronize_data():
+    # Resume an interrupted load from its last committed batch instead of starting over
+    checkpoint = retrieve_checkpoint("SALESINVOICE")
+    if checkpoint is not None:
+        folder_name, last_rowid = parse_folder_key(checkpoint["last_key"])
+        print(f"Resuming SALESINVOICE load after rowID {last_rowid} of folder {folder_name} ({checkpoint['rows_loaded']} rows already loaded).")
+        # The folders before the checkpoint folder are fully loaded, the following ones are not started
+        folders = get_folders()
+        position = next((index for index, folder in enumerate(folders) if folder["name"] == folder_name), 0)
+        source_data = retrieve_data_from_sagex3(min_rowid=last_rowid, folders=folders[position:position + 1])
+        if source_data is not None and position + 1 < len(folders):
+            remaining_data = retrieve_data_from_sagex3(folders=folders[position + 1:])
+            source_data = None if remaining_data is None else pd.concat([source_data, remaining_data], ignore_index=True)
+        if source_data is None:
+            return False
+        sync_result = insert_data_into_SALESINVOICE_sync(source_data.values.tolist(), resume=True)
+        if sync_result:
+            # The snapshot does not hold the resumed state, the next sync reads the target
+            invalidate_snapshot("SALESINVOICE")
+            invalidate_key_index("SALESINVOICE")
+        return sync_result
+
+    # Sync company by company, each company slice on its own, when sharding is enabled for SALESINVOICE
+    if company_sharding_enabled("SALESINVOICE"):
+        return synchronize_by_company("SALESINVOICE", SALESINVOICE_COLUMNS, "societe", lambda company: retrieve_data_from_sagex3(company=company))
+
     source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("SALESINVOICE", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -212,10 +371,22 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_SALESINVOICE_sync(source_data.values.tolist())
+        sync_result = insert_data_into_SALESINVOICE_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("SALESINVOICE", source_data)
+            invalidate_key_index("SALESINVOICE")
+        return sync_result
+
 
 
 
+# Function to delete from SALESINVOICE the rows that no longer exist in Sage X3
+def delete_removed_rows_from_SALESINVOICE():
+    source_from = "[x3v12src].[SEED].[SINVOICE] inner join [x3v12src].[SEED].[SINVOICED] ON SINVOICE.NUM_0=SINVOICED.NUM_0"
+    # The summaries of the days of the deleted rows are adjusted in each delete transaction
+    return propagate_folder_deletes(source_from, "SINVOICED.ROWID", "SALESINVOICE", "rowID",
+                                    output_column="dateFacture", before_commit=lambda cursor, dates: refresh_summary_days(cursor, "SALESINVOICE", dates))
 
 @router.post("/madin/warehouse/insert-data-salesinvoice")
 async def insert_data_into_SALESINVOICE_handler(request: Request):
@@ -225,6 +396,9 @@ async def insert_data_into_SALESINVOICE_handler(request: Request):
         return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
     
     if insert_data_into_SALESINVOICE(sagex3_data.values.tolist()):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_SALESINVOICE() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to SALESINVOICE table.")
         return Response(status_code=201, content="Data inserted into SALESINVOICE table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into SALESINVOICE table.")
@@ -232,15 +406,23 @@ async def insert_data_into_SALESINVOICE_handler(request: Request):
 
 @router.get("/sage/salesinvoice")
 async def retrieve_data_from_sage_customers(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, SALESINVOICE_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage customers.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, SALESINVOICE_READOUT, readout)})
 
 @router.post("/madin/warehouse/create-table-salesinvoice")
 async def create_SALESINVOICE_table_handler(request: Request):
@@ -255,6 +437,22 @@ async def create_SALESINVOICE_table_handler(request: Request):
 
 @router.post("/madin/warehouse/synchronize_salesinvoice")
 async def synchronize_SALESINVOICE_data(request: Request):
+    # Optional period, e.g. ?from=2024-01-01&to=2024-03-31, to reload only the invoices of that period
+    date_from = request.query_params.get("from")
+    date_to = request.query_params.get("to")
+    if date_from is not None or date_to is not None:
+        try:
+            date_from = date.fromisoformat(date_from)
+            date_to = date.fromisoformat(date_to)
+        except (TypeError, ValueError):
+            return Response(status_code=400, content="Both from and to must be dates in YYYY-MM-DD format.")
+        if date_from > date_to:
+            return Response(status_code=400, content="from must not be after to.")
+        if synchronize_period(date_from, date_to):
+            return Response(status_code=200, content=f"Period {date_from} to {date_to} synchronized successfully.")
+        else:
+            return Response(status_code=500, content="Internal Server Error - Period synchronization failed.")
+
     if synchronize_data():
         return Response(status_code=200, content="Data synchronized successfully.")
     else:
@@ -1,40 +1,27 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot, invalidate_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.ddl import apply_table_design, add_missing_column
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.shards import company_sharding_enabled, synchronize_by_company
+from app.utils.dimkeys import load_dimension_keys, append_dimension_keys, add_dimension_key_columns
+from app.utils.summary import refresh_summary_days, rebuild_summaries
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+SALESORDER_COLUMNS = ["rowID", "societe", "numCommande", "ligneCommande", "codeClient", "dateCommande", "codeArticle", "quantite", "montantHT", "montantTTC", "montantPrixRevi", "dossier"]
+
+# Columns the /sage readout can be filtered and paged on
+SALESORDER_READOUT = {"key": "rowID", "date": "dateCommande", "filters": {"company": "societe", "customer": "codeClient", "item": "codeArticle"}, "folders": True,
+                      "columns": ["rowID", "societe", "numCommande", "ligneCommande", "codeClient", "dateCommande", "codeArticle", "quantite", "montantHT", "montantTTC", "montantPrixRevi"]}
 
 # Function to create SALESORDER table in Madin Warehouse
 def create_SALESORDER_table(db_config):
@@ -52,13 +39,19 @@ def create_SALESORDER_table(db_config):
                     rowID INT,
                     societe VARCHAR(255),
                     numCommande VARCHAR(255),
+                    ligneCommande INT,
                     codeClient VARCHAR(255),
                     dateCommande DATE,
                     codeArticle VARCHAR(255),
                     quantite INT,
                     montantHT FLOAT,
                     montantTTC FLOAT,
-                    montantPrixRevi FLOAT
+                    montantPrixRevi FLOAT,
+                    dossier VARCHAR(50),
+                    DateKey INT,
+                    customerKey INT,
+                    itemKey INT,
+                    companyKey INT
                     
                 )
                 """
@@ -69,6 +62,22 @@ def create_SALESORDER_table(db_config):
                 print("SALESORDER table created successfully.")
             else:
                 print("SALESORDER table already exists.")
+                # Orders are now extracted one row per order line: the rows loaded at the old grain
+                # are dropped and reloaded by the next synchronization
+                if add_missing_column(cursor, "SALESORDER", "ligneCommande", "INT"):
+                    cursor.execute("TRUNCATE TABLE SALESORDER")
+                    invalidate_snapshot("SALESORDER")
+                    invalidate_key_index("SALESORDER")
+                    print("SALESORDER migrated to the order line grain, synchronize it to reload the data.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "SALESORDER")
+            # Integer date and dimension keys, filled for the rows already loaded
+            add_dimension_key_columns(cursor, "SALESORDER")
+            # Create the clustered key and indexes, or migrate an existing table in place
+            apply_table_design(cursor, "SALESORDER")
+            # Create the daily and monthly summary tables, rebuilt from the fact rows
+            rebuild_summaries(cursor, "SALESORDER")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -82,22 +91,25 @@ def create_SALESORDER_table(db_config):
 
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(company=None, readout=None):
     sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "select SORDER.ROWID as rowID,SORDER.CPY_0 as societe,SORDER. SOHNUM_0 as numCommande,SORDER .BPCORD_0 as codeClient,SORDER.ORDDAT_0 as dateCommande,SORDERQ.ITMREF_0 as codeArticle,QTY_0 as quantite,NETPRI_0*CHGRAT_0*QTY_0 as montantHT,NETPRIATI_0*CHGRAT_0*QTY_0 as montantTTC,CPRPRI_0*CHGRAT_0 *QTY_0 as montantPrixRevi from [x3v12src].[SEED].[SORDER] inner join [x3v12src].[SEED].SORDERQ ON SORDERQ .SOHNUM_0=SORDER .SOHNUM_0 inner join [x3v12src].[SEED].SORDERP ON SORDER.SOHNUM_0 =SORDERP .SOHNUM_0"
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = "select SORDERQ.ROWID as rowID,SORDER.CPY_0 as societe,SORDER. SOHNUM_0 as numCommande,SORDERQ.SOPLIN_0 as ligneCommande,SORDER .BPCORD_0 as codeClient,SORDER.ORDDAT_0 as dateCommande,SORDERQ.ITMREF_0 as codeArticle,QTY_0 as quantite,NETPRI_0*CHGRAT_0*QTY_0 as montantHT,NETPRIATI_0*CHGRAT_0*QTY_0 as montantTTC,CPRPRI_0*CHGRAT_0 *QTY_0 as montantPrixRevi from [x3v12src].[SEED].[SORDER] inner join [x3v12src].[SEED].SORDERQ ON SORDERQ .SOHNUM_0=SORDER .SOHNUM_0 inner join [x3v12src].[SEED].SORDERP ON SORDERQ.SOHNUM_0 =SORDERP .SOHNUM_0 and SORDERQ.SOPLIN_0 =SORDERP .SOPLIN_0"
+        params = None
+        if company is not None:
+            # Only extract the slice of one company (sharded sync)
+            source_query = f"SELECT * FROM ({source_query}) AS company_extract WHERE company_extract.societe = ?"
+            params = [company]
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, SALESORDER_READOUT, readout, params)
+            folders = readout["folders"]
+        # Read headers and lines in one snapshot transaction of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "SALESORDER extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
 
 # Function to insert data into SALESORDER table in Madina Warehouse
@@ -108,23 +120,38 @@ def insert_data_into_SALESORDER(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                inserted_dates = []
+                key_indexes = []
+                # Surrogate key maps loaded once, the keys of each folder batch are looked up in one pass
+                dimension_keys = load_dimension_keys()
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    folder_rows = append_dimension_keys(folder_rows, SALESORDER_COLUMNS, "SALESORDER", dimension_keys)
+                    # Find the rows whose rowID is not yet present in this folder of the SALESORDER table
+                    key_index = load_key_index(cursor, "SALESORDER", "rowID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
 
-            # Get the current maximum ROWID in the SALESORDER table
-            cursor.execute("SELECT MAX(rowID) FROM SALESORDER")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
+                    # Insert new data into SALESORDER table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[0] in new_keys:
+                            cursor.execute("INSERT INTO SALESORDER (rowID,societe,numCommande,ligneCommande,codeClient,dateCommande,codeArticle,quantite,montantHT,montantTTC,montantPrixRevi,dossier,DateKey,customerKey,itemKey,companyKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], row[14], row[15]))
+                            inserted_dates.append(row[5])
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
 
-            # Insert new data into SALESORDER table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[0] > max_rowid:
-                    cursor.execute("INSERT INTO SALESORDER (rowID,societe,numCommande,codeClient,dateCommande,codeArticle,quantite,montantHT,montantTTC,montantPrixRevi) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8], row[9]))
-                    rows_inserted += 1
+                # Adjust the summaries of the days of the new rows, committed with them
+                refresh_summary_days(cursor, "SALESORDER", inserted_dates)
+                return key_indexes, rows_inserted
 
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "SALESORDER insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -150,7 +177,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT rowID,societe,numCommande,codeClient,dateCommande,codeArticle,quantite,montantHT,montantTTC,montantPrixRevi FROM [dw_madin].[dbo].[SALESORDER]"
+            source_query = "SELECT rowID,societe,numCommande,ligneCommande,codeClient,dateCommande,codeArticle,quantite,montantHT,montantTTC,montantPrixRevi,dossier FROM [dw_madin].[dbo].[SALESORDER]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -172,17 +199,23 @@ def insert_data_into_SALESORDER_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            # The date and dimension keys are appended once, outside the replayed transaction
+            data = append_dimension_keys(data, SALESORDER_COLUMNS, "SALESORDER", load_dimension_keys())
 
-            # Truncate SALESORDER table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE SALESORDER")
+            def synchronize_rows(cursor):
+                # Truncate SALESORDER table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE SALESORDER")
 
-            # Insert new data into SALESORDER table
-            for row in data:
-                cursor.execute("INSERT INTO SALESORDER (rowID,societe,numCommande,codeClient,dateCommande,codeArticle,quantite,montantHT,montantTTC,montantPrixRevi) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?)",
-                                   (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
+                # Insert new data into SALESORDER table, with its date and dimension keys
+                for row in data:
+                    cursor.execute("INSERT INTO SALESORDER (rowID,societe,numCommande,ligneCommande,codeClient,dateCommande,codeArticle,quantite,montantHT,montantTTC,montantPrixRevi,dossier,DateKey,customerKey,itemKey,companyKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?)",
+                                       (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], row[14], row[15]))
 
-            cnxn.commit()
+                # Rebuild the summaries from the reloaded table in the same transaction
+                rebuild_summaries(cursor, "SALESORDER")
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "SALESORDER sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -196,11 +229,15 @@ def insert_data_into_SALESORDER_sync(data):
 
 # Function to compare data between source and target databases and synchronize if needed
 def synchronize_data():
+    # Sync company by company, each company slice on its own, when sharding is enabled for SALESORDER
+    if company_sharding_enabled("SALESORDER"):
+        return synchronize_by_company("SALESORDER", SALESORDER_COLUMNS, "societe", lambda company: retrieve_data_from_sagex3(company=company))
+
     source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("SALESORDER", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -209,11 +246,23 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_SALESORDER_sync(source_data.values.tolist())
+        sync_result = insert_data_into_SALESORDER_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("SALESORDER", source_data)
+            invalidate_key_index("SALESORDER")
+        return sync_result
 
 
 
 
+# Function to delete from SALESORDER the rows that no longer exist in Sage X3
+def delete_removed_rows_from_SALESORDER():
+    source_from = "[x3v12src].[SEED].[SORDER] inner join [x3v12src].[SEED].[SORDERQ] ON SORDERQ.SOHNUM_0=SORDER.SOHNUM_0"
+    # The summaries of the days of the deleted rows are adjusted in each delete transaction
+    return propagate_folder_deletes(source_from, "SORDERQ.ROWID", "SALESORDER", "rowID",
+                                    output_column="dateCommande", before_commit=lambda cursor, dates: refresh_summary_days(cursor, "SALESORDER", dates))
+
 @router.post("/madin/warehouse/insert-data-salesorder")
 async def insert_data_into_SALESORDER_handler(request: Request):
     # Retrieve data from Sage X3
@@ -222,6 +271,9 @@ async def insert_data_into_SALESORDER_handler(request: Request):
         return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
     
     if insert_data_into_SALESORDER(sagex3_data.values.tolist()):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_SALESORDER() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to SALESORDER table.")
         return Response(status_code=201, content="Data inserted into SALESORDER table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into SALESORDER table.")
@@ -229,15 +281,23 @@ async def insert_data_into_SALESORDER_handler(request: Request):
 
 @router.get("/sage/salesorder")
 async def retrieve_data_from_sage_customers(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, SALESORDER_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage customers.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, SALESORDER_READOUT, readout)})
 
 @router.post("/madin/warehouse/create-table-salesorder")
 async def create_SALESORDER_table_handler(request: Request):
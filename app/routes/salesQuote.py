@@ -1,40 +1,27 @@
-import pyodbc
 import pandas as pd
-import os
-import json
 from fastapi.responses import Response
 from fastapi import APIRouter, Request
+from app.utils.snapshot import load_target_state, save_snapshot
+from app.utils.keyindex import load_key_index, invalidate_key_index
+from app.utils.ddl import apply_table_design
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.retry import run_transaction_with_retry
+from app.utils.cache import get_cached_extract
+from app.utils.etag import get_data_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters, get_next_page_headers
+from app.utils.shards import company_sharding_enabled, synchronize_by_company
+from app.utils.dimkeys import load_dimension_keys, append_dimension_keys, add_dimension_key_columns
+from app.utils.summary import refresh_summary_days, rebuild_summaries
+from app.utils.folders import run_folder_extraction, group_rows_by_folder, add_folder_column, propagate_folder_deletes, FOLDER_COLUMN
 
 router = APIRouter()
 
-# Function to establish database connection
-def get_connection(db_config):
-    conn = None
-    try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={db_config['DB_HOST']};"
-            f"DATABASE={db_config['DB_CONNECTION']};"
-            f"UID={db_config['DB_USERNAME']};"
-            f"PWD={db_config['DB_PASSWORD']}"
-        )
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-    return conn
-
-# Function to load the Madin Warehouse database connection configuration from a JSON file
-def load_madin_warehouse_db_config():
-    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
-    with open(madin_warehouse_db_config_path) as file:
-        madin_warehouse_db_config = json.load(file)
-    return madin_warehouse_db_config
-
-# Function to load sagex3 database connection configuration from a JSON file
-def load_sage_x3_db_config():
-    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
-    with open(sage_db_connection_path) as file:
-        sagex3_db_config = json.load(file)
-    return sagex3_db_config
+SALESQUOTE_COLUMNS = ["rowID", "societe", "numDevis", "dateDevis", "codeClient", "codeArticle", "quantite", "montantHT", "montantTTC", "representant", "dossier"]
+
+# Columns the /sage readout can be filtered and paged on
+SALESQUOTE_READOUT = {"key": "rowID", "date": "dateDevis", "filters": {"company": "societe", "customer": "codeClient", "item": "codeArticle", "representative": "representant"}, "folders": True,
+                      "columns": ["rowID", "societe", "numDevis", "dateDevis", "codeClient", "codeArticle", "quantite", "montantHT", "montantTTC", "representant"]}
 
 # Function to create SALESQUOTE table in Madin Warehouse
 def create_SALESQUOTE_table(db_config):
@@ -58,7 +45,12 @@ def create_SALESQUOTE_table(db_config):
                     quantite INT,
                     montantHT FLOAT,
                     montantTTC FLOAT,
-                    representant VARCHAR(255)
+                    representant VARCHAR(255),
+                    dossier VARCHAR(50),
+                    DateKey INT,
+                    customerKey INT,
+                    itemKey INT,
+                    companyKey INT
                     
                 )
                 """
@@ -69,6 +61,15 @@ def create_SALESQUOTE_table(db_config):
                 print("SALESQUOTE table created successfully.")
             else:
                 print("SALESQUOTE table already exists.")
+            # Tables created before multi-folder support get the folder column
+            add_folder_column(cursor, "SALESQUOTE")
+            # Integer date and dimension keys, filled for the rows already loaded
+            add_dimension_key_columns(cursor, "SALESQUOTE")
+            # Create the clustered key and indexes, or migrate an existing table in place
+            apply_table_design(cursor, "SALESQUOTE")
+            # Create the daily and monthly summary tables, rebuilt from the fact rows
+            rebuild_summaries(cursor, "SALESQUOTE")
+            cnxn.commit()
             return True
         else:
             print("Failed to connect to the database.")
@@ -82,22 +83,25 @@ def create_SALESQUOTE_table(db_config):
 
 
 # Function to retrieve data from Sage X3
-def retrieve_data_from_sagex3():
+def retrieve_data_from_sagex3(company=None, readout=None):
     sagex3_db = load_sage_x3_db_config()
-    # Establish connection to Sage X3 database
-    cnxn = get_connection(sagex3_db)
-    if cnxn:
-        try:
-            source_query = "select SQUOTED.ROWID as rowID,SQUOTE.CPY_0 as societe,SQUOTE.SQHNUM_0 as numDevis,SQUOTE.QUODAT_0 as dateDevis,SQUOTE.BPCORD_0 as codeClient,SQUOTED.ITMREF_0 as codeArticle,QTY_0 as quantite,NETPRI_0 *QTY_0*CHGRAT_0 as montantHT,NETPRIATI_0 * QTY_0 *CHGRAT_0  as montantTTC,(select YREP_0 from [x3v12src].[dbo].[YREPRE] where YBPCNUM_0=SQUOTE.BPCORD_0 and YCPY_0 =SQUOTE.CPY_0 )  as representant from [x3v12src].[SEED].[SQUOTE] inner join [x3v12src].[SEED].[SQUOTED] on SQUOTE .SQHNUM_0=SQUOTED .SQHNUM_0"
-            data = pd.read_sql(source_query, cnxn)
-            return data
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return None
-        finally:
-            cnxn.close()
-    else:
-        print("Failed to connect to the source database.")
+    try:
+        source_query = "select SQUOTED.ROWID as rowID,SQUOTE.CPY_0 as societe,SQUOTE.SQHNUM_0 as numDevis,SQUOTE.QUODAT_0 as dateDevis,SQUOTE.BPCORD_0 as codeClient,SQUOTED.ITMREF_0 as codeArticle,QTY_0 as quantite,NETPRI_0 *QTY_0*CHGRAT_0 as montantHT,NETPRIATI_0 * QTY_0 *CHGRAT_0  as montantTTC,(select YREP_0 from [x3v12src].[dbo].[YREPRE] where YBPCNUM_0=SQUOTE.BPCORD_0 and YCPY_0 =SQUOTE.CPY_0 )  as representant from [x3v12src].[SEED].[SQUOTE] inner join [x3v12src].[SEED].[SQUOTED] on SQUOTE .SQHNUM_0=SQUOTED .SQHNUM_0"
+        params = None
+        if company is not None:
+            # Only extract the slice of one company (sharded sync)
+            source_query = f"SELECT * FROM ({source_query}) AS company_extract WHERE company_extract.societe = ?"
+            params = [company]
+        folders = None
+        if readout is not None:
+            # Push the readout filters, projection and page down into the query
+            source_query, params = apply_readout_filters(source_query, SALESQUOTE_READOUT, readout, params)
+            folders = readout["folders"]
+        # Read headers and lines in one snapshot transaction of each Sage X3 folder, in parallel
+        data = run_folder_extraction(sagex3_db, source_query, "SALESQUOTE extract", params=params, folders=folders)
+        return data
+    except Exception as e:
+        print(f"Error retrieving data from Sage X3: {e}")
         return None
 
 # Function to insert data into SALESQUOTE table in Madina Warehouse
@@ -108,23 +112,38 @@ def insert_data_into_SALESQUOTE(data, clear_table=False):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            def insert_rows(cursor):
+                rows_inserted = 0
+                inserted_dates = []
+                key_indexes = []
+                # Surrogate key maps loaded once, the keys of each folder batch are looked up in one pass
+                dimension_keys = load_dimension_keys()
+                for folder_name, folder_rows in group_rows_by_folder(data).items():
+                    folder_rows = append_dimension_keys(folder_rows, SALESQUOTE_COLUMNS, "SALESQUOTE", dimension_keys)
+                    # Find the rows whose rowID is not yet present in this folder of the SALESQUOTE table
+                    key_index = load_key_index(cursor, "SALESQUOTE", "rowID", scope=(FOLDER_COLUMN, folder_name))
+                    new_keys = key_index.find_new_keys(cursor, [row[0] for row in folder_rows])
 
-            # Get the current maximum ROWID in the SALESQUOTE table
-            cursor.execute("SELECT MAX(rowID) FROM SALESQUOTE")
-            max_rowid_result = cursor.fetchone()[0]
-            max_rowid = max_rowid_result if max_rowid_result is not None else 0
+                    # Insert new data into SALESQUOTE table
+                    folder_rows_inserted = 0
+                    for row in folder_rows:
+                        if row[0] in new_keys:
+                            cursor.execute("INSERT INTO SALESQUOTE (rowID,societe ,numDevis ,dateDevis,codeClient ,codeArticle ,quantite,montantHT,montantTTC,representant ,dossier,DateKey,customerKey,itemKey,companyKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?)",
+                                           (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], row[14]))
+                            inserted_dates.append(row[3])
+                            folder_rows_inserted += 1
+                    key_index.add(new_keys, folder_rows_inserted)
+                    key_indexes.append(key_index)
+                    rows_inserted += folder_rows_inserted
 
-            # Insert new data into SALESQUOTE table starting from the next ROWID
-            starting_rowid = max_rowid + 1
-            rows_inserted = 0
-            for row in data:
-                if row[0] > max_rowid:
-                    cursor.execute("INSERT INTO SALESQUOTE (rowID,societe ,numDevis ,dateDevis,codeClient ,codeArticle ,quantite,montantHT,montantTTC,representant ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?)",
-                                   (row[0], row[1], row[2],row[3], row[4], row[5],row[6], row[7], row[8], row[9]))
-                    rows_inserted += 1
+                # Adjust the summaries of the days of the new rows, committed with them
+                refresh_summary_days(cursor, "SALESQUOTE", inserted_dates)
+                return key_indexes, rows_inserted
 
-            cnxn.commit()
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, (key_indexes, rows_inserted) = run_transaction_with_retry(cnxn, madin_warehouse_db, insert_rows, "SALESQUOTE insert")
+            for key_index in key_indexes:
+                key_index.save()
             
             if rows_inserted == 0:
                 print("No modifications exist. No rows were inserted.")
@@ -150,7 +169,7 @@ def retrieve_data_from_target():
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            source_query = "SELECT rowID,societe ,numDevis ,dateDevis,codeClient ,codeArticle ,quantite,montantHT,montantTTC,representant FROM [dw_madin].[dbo].[SALESQUOTE]"
+            source_query = "SELECT rowID,societe ,numDevis ,dateDevis,codeClient ,codeArticle ,quantite,montantHT,montantTTC,representant,dossier FROM [dw_madin].[dbo].[SALESQUOTE]"
             data = pd.read_sql(source_query, cnxn)
             return data
         except Exception as e:
@@ -172,17 +191,23 @@ def insert_data_into_SALESQUOTE_sync(data):
     cnxn = get_connection(madin_warehouse_db)
     if cnxn:
         try:
-            cursor = cnxn.cursor()
+            # The date and dimension keys are appended once, outside the replayed transaction
+            data = append_dimension_keys(data, SALESQUOTE_COLUMNS, "SALESQUOTE", load_dimension_keys())
 
-            # Truncate SALESQUOTE table before inserting new data to ensure synchronization
-            cursor.execute("TRUNCATE TABLE SALESQUOTE")
+            def synchronize_rows(cursor):
+                # Truncate SALESQUOTE table before inserting new data to ensure synchronization
+                cursor.execute("TRUNCATE TABLE SALESQUOTE")
 
-            # Insert new data into SALESQUOTE table
-            for row in data:
-                cursor.execute("INSERT INTO SALESQUOTE (rowID,societe ,numDevis ,dateDevis,codeClient ,codeArticle ,quantite,montantHT,montantTTC,representant) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?)",
-                                   (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
+                # Insert new data into SALESQUOTE table, with its date and dimension keys
+                for row in data:
+                    cursor.execute("INSERT INTO SALESQUOTE (rowID,societe ,numDevis ,dateDevis,codeClient ,codeArticle ,quantite,montantHT,montantTTC,representant,dossier,DateKey,customerKey,itemKey,companyKey) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?)",
+                                       (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], row[14]))
 
-            cnxn.commit()
+                # Rebuild the summaries from the reloaded table in the same transaction
+                rebuild_summaries(cursor, "SALESQUOTE")
+
+            # The transaction is replayed as a whole after a deadlock, lock timeout or dropped connection
+            cnxn, _ = run_transaction_with_retry(cnxn, madin_warehouse_db, synchronize_rows, "SALESQUOTE sync")
             print("Data synchronized successfully.")
             return True
         except Exception as e:
@@ -196,11 +221,15 @@ def insert_data_into_SALESQUOTE_sync(data):
 
 # Function to compare data between source and target databases and synchronize if needed
 def synchronize_data():
+    # Sync company by company, each company slice on its own, when sharding is enabled for SALESQUOTE
+    if company_sharding_enabled("SALESQUOTE"):
+        return synchronize_by_company("SALESQUOTE", SALESQUOTE_COLUMNS, "societe", lambda company: retrieve_data_from_sagex3(company=company))
+
     source_data = retrieve_data_from_sagex3()
     if source_data is None:
         return False
     
-    target_data = retrieve_data_from_target()
+    target_data = load_target_state("SALESQUOTE", retrieve_data_from_target)
     if target_data is None:
         return False
 
@@ -209,11 +238,23 @@ def synchronize_data():
         return True
     else:
         print("Data in target database does not match data in source database. Synchronizing...")
-        return insert_data_into_SALESQUOTE_sync(source_data.values.tolist())
+        sync_result = insert_data_into_SALESQUOTE_sync(source_data.values.tolist())
+        if sync_result:
+            # Keep the local snapshot in line with the state applied to the target
+            save_snapshot("SALESQUOTE", source_data)
+            invalidate_key_index("SALESQUOTE")
+        return sync_result
 
 
 
 
+# Function to delete from SALESQUOTE the rows that no longer exist in Sage X3
+def delete_removed_rows_from_SALESQUOTE():
+    source_from = "[x3v12src].[SEED].[SQUOTE] inner join [x3v12src].[SEED].[SQUOTED] ON SQUOTE.SQHNUM_0=SQUOTED.SQHNUM_0"
+    # The summaries of the days of the deleted rows are adjusted in each delete transaction
+    return propagate_folder_deletes(source_from, "SQUOTED.ROWID", "SALESQUOTE", "rowID",
+                                    output_column="dateDevis", before_commit=lambda cursor, dates: refresh_summary_days(cursor, "SALESQUOTE", dates))
+
 @router.post("/madin/warehouse/insert-data-salesquote")
 async def insert_data_into_SALESQUOTE_handler(request: Request):
     # Retrieve data from Sage X3
@@ -222,6 +263,9 @@ async def insert_data_into_SALESQUOTE_handler(request: Request):
         return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
     
     if insert_data_into_SALESQUOTE(sagex3_data.values.tolist()):
+        # Remove the rows deleted in Sage X3 since the last load
+        if delete_removed_rows_from_SALESQUOTE() is None:
+            return Response(status_code=500, content="Internal Server Error - Failed to propagate deletes to SALESQUOTE table.")
         return Response(status_code=201, content="Data inserted into SALESQUOTE table successfully.")
     else:
         return Response(status_code=500, content="Internal Server Error - Failed to insert data into SALESQUOTE table.")
@@ -229,15 +273,23 @@ async def insert_data_into_SALESQUOTE_handler(request: Request):
 
 @router.get("/sage/salesquote")
 async def retrieve_data_from_sage_customers(request: Request):
-    # Retrieve data from Sage X3
-    sagex3_data = retrieve_data_from_sagex3()  
+    # Filters, projection and page given as query parameters are pushed down into the Sage X3 query
+    try:
+        readout = parse_readout_filters(request, SALESQUOTE_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+    # Retrieve data from Sage X3 (cached, identical concurrent requests share one query)
+    sagex3_data = await get_cached_extract(request, lambda: retrieve_data_from_sagex3(readout=readout))
 
     if sagex3_data is None:
         return Response(status_code=500, content="Failed to retrieve data from Sage customers.")
     else:
-        # Convert data to dictionary format
-        data_dict = sagex3_data.to_dict(orient="records")
-        return data_dict
+        # Answer 304 when the client already has this version of the data
+        etag = get_data_etag(sagex3_data)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        # Serialize the rows with orjson, by batches for large extracts
+        return dataframe_response(sagex3_data, headers={"ETag": etag, **get_next_page_headers(sagex3_data, SALESQUOTE_READOUT, readout)})
 
 @router.post("/madin/warehouse/create-table-salesquote")
 async def create_SALESQUOTE_table_handler(request: Request):
@@ -0,0 +1,44 @@
+import time
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
+from app.utils.config import get_sync_setting
+from app.utils.search import SEARCH_ENTITIES, resolve_search_entity, get_search_index, rebuild_search_index
+
+router = APIRouter()
+
+@router.get("/search/{entity}")
+async def search_entity(entity: str, request: Request):
+    entity_name = resolve_search_entity(entity)
+    if entity_name is None:
+        return Response(status_code=404, content=f"No search index for {entity}. Available: {', '.join(SEARCH_ENTITIES)}.")
+    query = request.query_params.get("q", "")
+    try:
+        limit = int(request.query_params.get("limit", get_sync_setting("search", "default_limit", 20)))
+    except ValueError:
+        return Response(status_code=400, content="limit must be an integer.")
+    max_limit = get_sync_setting("search", "max_limit", 100)
+    if not 0 < limit <= max_limit:
+        return Response(status_code=400, content=f"limit must be between 1 and {max_limit}.")
+
+    try:
+        # The index is built from the warehouse table on the first search, then kept up to date by the syncs
+        index = await run_in_threadpool(get_search_index, entity_name)
+    except Exception as e:
+        print(f"Error building the {entity_name} search index: {e}")
+        return Response(status_code=500, content=f"Failed to build the {entity_name} search index.")
+    start = time.perf_counter()
+    matches = index.search(query, limit)
+    return {"entity": entity_name, "query": query, "took_ms": round((time.perf_counter() - start) * 1000, 3), "matches": matches}
+
+@router.post("/madin/warehouse/search/{entity}/rebuild")
+async def rebuild_search_index_handler(entity: str, request: Request):
+    entity_name = resolve_search_entity(entity)
+    if entity_name is None:
+        return Response(status_code=404, content=f"No search index for {entity}.")
+    try:
+        entries = await run_in_threadpool(rebuild_search_index, entity_name)
+    except Exception as e:
+        print(f"Error rebuilding the {entity_name} search index: {e}")
+        return Response(status_code=500, content=f"Internal Server Error - Failed to rebuild the {entity_name} search index.")
+    return {"entity": entity_name, "entries": entries}
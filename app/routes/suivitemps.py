@@ -0,0 +1,36 @@
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from app.utils.timetracking import retrieve_time_tracking_from_sagex3, split_time_tracking_by_table
+from app.routes import SuivitempsOF, Suivitempsdivers
+
+router = APIRouter()
+
+@router.post("/madin/warehouse/insert-data-SUIVITEMPS")
+async def insert_data_into_SUIVITEMPS_handler(request: Request):
+    # Read MFGOPETRK once and insert the new lines of both time tracking tables
+    sagex3_data = retrieve_time_tracking_from_sagex3()
+    if sagex3_data is None:
+        return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
+    data_by_table = split_time_tracking_by_table(sagex3_data)
+
+    of_result = SuivitempsOF.insert_data_into_SUIVITEMPSOF(data_by_table["SUIVITEMPSOF"].values.tolist())
+    divers_result = Suivitempsdivers.insert_data_into_SUIVITEMPSDIVERS(data_by_table["SUIVITEMPSDIVERS"].values.tolist())
+    if of_result and divers_result:
+        return Response(status_code=201, content="Data inserted into SUIVITEMPSOF and SUIVITEMPSDIVERS tables successfully.")
+    else:
+        return Response(status_code=500, content="Internal Server Error - Failed to insert data into SUIVITEMPSOF or SUIVITEMPSDIVERS table.")
+
+@router.post("/madin/warehouse/synchronize_SUIVITEMPS")
+async def synchronize_SUIVITEMPS_data(request: Request):
+    # Read MFGOPETRK once and synchronize both time tracking tables from the same extract
+    sagex3_data = retrieve_time_tracking_from_sagex3()
+    if sagex3_data is None:
+        return Response(status_code=500, content="Failed to retrieve data from Sage X3.")
+    data_by_table = split_time_tracking_by_table(sagex3_data)
+
+    of_result = SuivitempsOF.synchronize_data(data_by_table["SUIVITEMPSOF"])
+    divers_result = Suivitempsdivers.synchronize_data(data_by_table["SUIVITEMPSDIVERS"])
+    if of_result and divers_result:
+        return Response(status_code=200, content="Data synchronized successfully.")
+    else:
+        return Response(status_code=500, content="Internal Server Error - Data synchronization failed.")
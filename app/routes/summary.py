@@ -0,0 +1,102 @@
+import pandas as pd
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.etag import get_query_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters
+from app.utils.summary import SUMMARY_DESIGNS, get_summary_tables, rebuild_summaries
+
+router = APIRouter()
+
+# Fact names used in the summary URLs
+SUMMARY_FACTS = {
+    "salesinvoice": "SALESINVOICE",
+    "salesorder": "SALESORDER",
+    "salesdelivery": "SDELIVERY",
+    "salesquote": "SALESQUOTE",
+}
+
+# Function to get the readout spec of a summary table: its period column and grouping columns
+def get_summary_readout(fact_table, grain):
+    dimensions = SUMMARY_DESIGNS[fact_table]["dimensions"]
+    filters = {"company": "societe", "customer": "codeClient", "item": "codeArticle", "representative": "representant", "dossier": "dossier"}
+    measures = SUMMARY_DESIGNS[fact_table]["measures"]
+    period_column = "jour" if grain == "daily" else "mois"
+    return {"date": period_column,
+            "filters": {param_name: column for param_name, column in filters.items() if column in dimensions},
+            "columns": [period_column] + dimensions + ["nbLignes"] + measures}
+
+# Function to read a summary table of Madin Warehouse.
+# The version of the requested rows is read first: data is None when the client already has it.
+def retrieve_summary(fact_table, grain, readout, request):
+    daily_table, monthly_table = get_summary_tables(fact_table)
+    summary_table = daily_table if grain == 'daily' else monthly_table
+    source_query = f"SELECT * FROM [{summary_table}]"
+    source_query, params = apply_readout_filters(source_query, get_summary_readout(fact_table, grain), readout)
+
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            etag = get_query_etag(cnxn.cursor(), summary_table, source_query, params, readout["columns"])
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, pd.read_sql(source_query, cnxn, params=params)
+        except Exception as e:
+            print(f"Error reading {fact_table} summary: {e}")
+            return None, None
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return None, None
+
+# Function to rebuild the summaries of a fact table from its rows
+def rebuild_fact_summaries(fact_table):
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            rebuild_summaries(cursor, fact_table)
+            cnxn.commit()
+            return True
+        except Exception as e:
+            print(f"Error rebuilding {fact_table} summaries: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
+
+@router.get("/madin/warehouse/summary/{fact}")
+async def retrieve_summary_handler(fact: str, request: Request):
+    fact_table = SUMMARY_FACTS.get(fact.lower())
+    if fact_table is None:
+        return Response(status_code=404, content=f"No summary for {fact}.")
+    grain = request.query_params.get("grain", "daily")
+    if grain not in ("daily", "monthly"):
+        return Response(status_code=400, content="grain must be daily or monthly.")
+    try:
+        readout = parse_readout_filters(request, get_summary_readout(fact_table, grain))
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+
+    etag, summary_data = await run_in_threadpool(retrieve_summary, fact_table, grain, readout, request)
+    if etag is None:
+        return Response(status_code=500, content=f"Failed to retrieve {fact_table} summary.")
+    # Answer 304 when the client already has this version of the summary
+    if summary_data is None:
+        return not_modified_response(etag)
+    return dataframe_response(summary_data, headers={"ETag": etag})
+
+@router.post("/madin/warehouse/summary/{fact}/rebuild")
+async def rebuild_summary_handler(fact: str, request: Request):
+    fact_table = SUMMARY_FACTS.get(fact.lower())
+    if fact_table is None:
+        return Response(status_code=404, content=f"No summary for {fact}.")
+    if await run_in_threadpool(rebuild_fact_summaries, fact_table):
+        return Response(status_code=200, content=f"{fact_table} summaries rebuilt successfully.")
+    else:
+        return Response(status_code=500, content=f"Internal Server Error - Failed to rebuild {fact_table} summaries.")
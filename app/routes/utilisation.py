@@ -0,0 +1,78 @@
+import pandas as pd
+from fastapi.responses import Response
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.etag import get_query_etag, etag_matches, not_modified_response
+from app.utils.serialization import dataframe_response
+from app.utils.readout import parse_readout_filters, apply_readout_filters
+from app.utils.utilisation import UTILISATION_TABLE, UTILISATION_COLUMNS, rebuild_utilisation
+
+router = APIRouter()
+
+# Columns the utilisation readout can be filtered on
+UTILISATION_READOUT = {"date": "jour", "filters": {"company": "company", "workstation": "poste"},
+                       "columns": UTILISATION_COLUMNS}
+
+# Function to read the workstation utilisation table of Madin Warehouse.
+# The version of the requested rows is read first: data is None when the client already has it.
+def retrieve_utilisation(readout, request):
+    source_query = f"SELECT * FROM {UTILISATION_TABLE}"
+    source_query, params = apply_readout_filters(source_query, UTILISATION_READOUT, readout)
+
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            etag = get_query_etag(cnxn.cursor(), UTILISATION_TABLE, source_query, params, readout["columns"])
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, pd.read_sql(source_query, cnxn, params=params)
+        except Exception as e:
+            print(f"Error reading {UTILISATION_TABLE}: {e}")
+            return None, None
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return None, None
+
+# Function to rebuild the workstation utilisation from POSTEDECHARGE and SUIVITEMPSOF
+def rebuild_workstation_utilisation():
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            rows_written = rebuild_utilisation(cursor)
+            cnxn.commit()
+            print(f"{rows_written} rows written into {UTILISATION_TABLE}.")
+            return True
+        except Exception as e:
+            print(f"Error rebuilding {UTILISATION_TABLE}: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
+
+@router.get("/madin/warehouse/utilisation")
+async def retrieve_utilisation_handler(request: Request):
+    try:
+        readout = parse_readout_filters(request, UTILISATION_READOUT)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+
+    etag, utilisation_data = await run_in_threadpool(retrieve_utilisation, readout, request)
+    if etag is None:
+        return Response(status_code=500, content="Failed to retrieve workstation utilisation.")
+    # Answer 304 when the client already has this version of the utilisation
+    if utilisation_data is None:
+        return not_modified_response(etag)
+    return dataframe_response(utilisation_data, headers={"ETag": etag})
+
+@router.post("/madin/warehouse/utilisation/rebuild")
+async def rebuild_utilisation_handler(request: Request):
+    if await run_in_threadpool(rebuild_workstation_utilisation):
+        return Response(status_code=200, content=f"{UTILISATION_TABLE} rebuilt successfully.")
+    else:
+        return Response(status_code=500, content=f"Internal Server Error - Failed to rebuild {UTILISATION_TABLE}.")
@@ -0,0 +1,112 @@
+import os
+import re
+import uuid
+import threading
+import pyodbc
+
+from app.utils.config import get_sync_setting, resolve_app_path
+
+# SQL Server errors raised when BULK INSERT cannot be used: no bulk permission, or the staging
+# file or format file does not exist or cannot be opened/read from the server
+BULK_UNAVAILABLE_ERROR_CODES = {4834, 4860, 4861, 4862, 12704}
+
+_bulk_unavailable = threading.Event()
+
+# Writer inserting batches of rows with pyodbc parameterized inserts
+class PyodbcRowWriter:
+    def __init__(self, table_name, columns):
+        self.table_name = table_name
+        self.columns = columns
+
+    def write(self, cursor, rows):
+        column_list = ",".join(self.columns)
+        placeholders = ", ".join("?" for _ in self.columns)
+        cursor.executemany(f"INSERT INTO {self.table_name} ({column_list}) VALUES ({placeholders})",
+                           [tuple(row[:len(self.columns)]) for row in rows])
+
+
+# Writer loading batches of rows with BULK INSERT from a staging file (TABLOCK, so the load is
+# minimally logged into an empty or heap table). Falls back to pyodbc inserts when the server
+# cannot read the staging location.
+class BulkInsertWriter(PyodbcRowWriter):
+    def write(self, cursor, rows):
+        if _bulk_unavailable.is_set():
+            return super().write(cursor, rows)
+
+        local_dir = get_staging_dir()
+        server_dir = get_sync_setting("bulk_load", "server_directory", "") or local_dir
+        file_name = f"{self.table_name}_{uuid.uuid4().hex}"
+        data_path = os.path.join(local_dir, file_name + ".dat")
+        format_path = os.path.join(local_dir, file_name + ".fmt")
+        try:
+            write_format_file(cursor, self.table_name, self.columns, format_path)
+            write_staging_file(rows, len(self.columns), data_path)
+            try:
+                cursor.execute(f"""
+                    BULK INSERT {self.table_name}
+                    FROM '{_server_path(server_dir, file_name + ".dat")}'
+                    WITH (FORMATFILE = '{_server_path(server_dir, file_name + ".fmt")}',
+                          CODEPAGE = '65001', KEEPNULLS, TABLOCK, ROWS_PER_BATCH = {len(rows)})
+                """)
+            except pyodbc.Error as e:
+                if not is_bulk_unavailable_error(e):
+                    raise
+                print(f"BULK INSERT unavailable, falling back to row inserts: {e}")
+                _bulk_unavailable.set()
+                return super().write(cursor, rows)
+        finally:
+            for path in (data_path, format_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+# Function to get the local directory where the staging files are written
+def get_staging_dir():
+    staging_dir = resolve_app_path(get_sync_setting("bulk_load", "local_directory", "cache/bulk"))
+    os.makedirs(staging_dir, exist_ok=True)
+    return staging_dir
+
+def _server_path(server_dir, file_name):
+    separator = "\\" if "\\" in server_dir else "/"
+    return server_dir.rstrip("\\/") + separator + file_name
+
+# Function to check if a BULK INSERT error means the bulk path cannot be used at all
+def is_bulk_unavailable_error(error):
+    message = " ".join(str(arg) for arg in error.args)
+    return any(int(code) in BULK_UNAVAILABLE_ERROR_CODES for code in re.findall(r"\((-?\d+)\)", message))
+
+def _format_value(value):
+    if value is None or value != value:
+        # Empty field, loaded as NULL thanks to KEEPNULLS
+        return ""
+    if isinstance(value, float):
+        return repr(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat(sep=" ") if hasattr(value, "hour") else value.isoformat()
+    # Tabs and line breaks would be read as field or row terminators
+    return str(value).replace("\t", " ").replace("\r", " ").replace("\n", " ")
+
+# Function to write rows to a tab separated UTF-8 staging file
+def write_staging_file(rows, column_count, path):
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        for row in rows:
+            file.write("\t".join(_format_value(value) for value in row[:column_count]) + "\r\n")
+
+# Function to write the non-XML format file mapping the staging file fields to the table columns
+# (the identity column is not in the file and is skipped)
+def write_format_file(cursor, table_name, columns, path):
+    cursor.execute("SELECT name FROM sys.columns WHERE object_id = OBJECT_ID(?) ORDER BY column_id", (table_name,))
+    server_columns = [row[0].lower() for row in cursor.fetchall()]
+    lines = ["10.0", str(len(columns))]
+    for position, column in enumerate(columns, start=1):
+        terminator = "\\r\\n" if position == len(columns) else "\\t"
+        server_position = server_columns.index(column.lower()) + 1
+        lines.append(f'{position}\tSQLCHAR\t0\t0\t"{terminator}"\t{server_position}\t{column}\t""')
+    with open(path, "w", newline="\r\n") as file:
+        file.write("\n".join(lines) + "\n")
+
+# Function to get the writer used for bulk loads: BULK INSERT when enabled, pyodbc inserts otherwise
+def get_row_writer(table_name, columns):
+    if get_sync_setting("bulk_load", "enabled", False) and not _bulk_unavailable.is_set():
+        return BulkInsertWriter(table_name, columns)
+    return PyodbcRowWriter(table_name, columns)
@@ -0,0 +1,116 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+
+from app.utils.config import get_sync_setting
+
+# In-memory cache of the Sage X3 extracts served by the /sage/* readout endpoints, keyed by endpoint
+# and query parameters. Entries expire after a TTL and the least recently used ones are evicted past
+# the entry and memory bounds. Identical requests arriving while the extract runs wait for it
+# (single-flight) instead of scanning the production database again.
+class QueryResultCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.stats = {}
+
+    def _count(self, endpoint, counter):
+        endpoint_stats = self.stats.setdefault(endpoint, {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0})
+        endpoint_stats[counter] += 1
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["stored_at"] > get_sync_setting("response_cache", "ttl_seconds", 300):
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry["data"]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["bytes"]
+
+    def _store(self, key, endpoint, data):
+        size = int(data.memory_usage(index=True, deep=True).sum())
+        max_bytes = get_sync_setting("response_cache", "max_bytes", 536870912)
+        if size > max_bytes:
+            # Larger than the whole cache, served without being kept
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = {"data": data, "bytes": size, "stored_at": time.monotonic(), "endpoint": endpoint}
+        self.total_bytes += size
+        max_entries = get_sync_setting("response_cache", "max_entries", 64)
+        while len(self.entries) > max_entries or self.total_bytes > max_bytes:
+            evicted_key = next(iter(self.entries))
+            self._count(self.entries[evicted_key]["endpoint"], "evictions")
+            self._remove(evicted_key)
+
+    # Function to get the cached result of an extract, or run it once for all the identical requests
+    async def get_or_retrieve(self, endpoint, key, retrieve):
+        with self.lock:
+            data = self._lookup(key)
+            if data is not None:
+                self._count(endpoint, "hits")
+                return data
+            task = self.in_flight.get(key)
+            if task is not None:
+                self._count(endpoint, "coalesced")
+            else:
+                self._count(endpoint, "misses")
+                # The extract is blocking, it runs off the event loop in a task that no request owns: a
+                # request cancelled while waiting (client gone) cancels neither the extract nor the others
+                task = asyncio.ensure_future(run_in_threadpool(retrieve))
+                task.add_done_callback(lambda done: self._complete(key, endpoint, done))
+                self.in_flight[key] = task
+        return await asyncio.shield(task)
+
+    # Function to store the result of a finished extract, errors being raised to the waiting requests
+    def _complete(self, key, endpoint, task):
+        with self.lock:
+            self.in_flight.pop(key, None)
+            # Reading the exception marks it as retrieved when no request waits anymore
+            if task.cancelled() or task.exception() is not None:
+                return
+            data = task.result()
+            if data is not None:
+                self._store(key, endpoint, data)
+
+    # Function to drop the cached results (all of them, or the ones of one endpoint)
+    def clear(self, endpoint=None):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if endpoint is None or entry["endpoint"] == endpoint]:
+                self._remove(key)
+
+    # Function to get the hit/miss counters and hit rate of each endpoint, and the cache size
+    def get_stats(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, counters in self.stats.items():
+                requests = counters["hits"] + counters["misses"] + counters["coalesced"]
+                served_without_query = counters["hits"] + counters["coalesced"]
+                endpoints[endpoint] = dict(counters, hit_rate=round(served_without_query / requests, 4) if requests else 0.0)
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "endpoints": endpoints}
+
+
+_query_result_cache = QueryResultCache()
+
+# Function to get the query result cache shared by the readout endpoints
+def get_query_result_cache():
+    return _query_result_cache
+
+# Function to build the cache key of a request: endpoint path and sorted query parameters
+def make_cache_key(request):
+    return (request.url.path, tuple(sorted(request.query_params.multi_items())))
+
+# Function to retrieve the data of a readout request through the cache (or directly when disabled)
+async def get_cached_extract(request, retrieve):
+    if not get_sync_setting("response_cache", "enabled", True):
+        return await run_in_threadpool(retrieve)
+    return await _query_result_cache.get_or_retrieve(request.url.path, make_cache_key(request), retrieve)
@@ -0,0 +1,77 @@
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+
+# Checkpoints are written with the cursor of the load itself, so that a batch and its
+# checkpoint are committed in the same transaction.
+
+# Function to create the SYNC_STATE table in Madin Warehouse if it does not exist
+def ensure_sync_state_table(cursor):
+    cursor.execute("""
+        IF OBJECT_ID('SYNC_STATE', 'U') IS NULL
+            CREATE TABLE SYNC_STATE (
+                table_name VARCHAR(128) PRIMARY KEY,
+                status VARCHAR(20),
+                last_key NVARCHAR(400),
+                rows_loaded INT,
+                started_at DATETIME,
+                updated_at DATETIME
+            )
+    """)
+
+# Function to get the checkpoint of an unfinished load, returns None when there is nothing to resume
+def load_checkpoint(cursor, table_name):
+    ensure_sync_state_table(cursor)
+    cursor.execute("SELECT last_key, rows_loaded, started_at FROM SYNC_STATE WHERE table_name = ? AND status = 'running'", (table_name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return {"last_key": row[0], "rows_loaded": row[1] or 0, "started_at": row[2]}
+
+# Function to mark the start of a checkpointed load
+def start_checkpoint(cursor, table_name):
+    ensure_sync_state_table(cursor)
+    cursor.execute("""
+        MERGE INTO SYNC_STATE AS target
+        USING (VALUES (?)) AS source (table_name)
+        ON target.table_name = source.table_name
+        WHEN MATCHED THEN
+            UPDATE SET status = 'running', last_key = NULL, rows_loaded = 0, started_at = GETDATE(), updated_at = GETDATE()
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (table_name, status, last_key, rows_loaded, started_at, updated_at)
+            VALUES (source.table_name, 'running', NULL, 0, GETDATE(), GETDATE());
+    """, (table_name,))
+
+# Function to record the last key of a batch that is about to be committed
+def save_checkpoint(cursor, table_name, last_key, rows_loaded):
+    cursor.execute("UPDATE SYNC_STATE SET last_key = ?, rows_loaded = ?, updated_at = GETDATE() WHERE table_name = ?",
+                   (str(last_key), rows_loaded, table_name))
+
+# Function to mark a checkpointed load as completed
+def complete_checkpoint(cursor, table_name):
+    cursor.execute("UPDATE SYNC_STATE SET status = 'completed', updated_at = GETDATE() WHERE table_name = ?", (table_name,))
+
+# Function to drop the checkpoint of a table, so that its next load does not resume an older one
+def clear_checkpoint(cursor, table_name):
+    ensure_sync_state_table(cursor)
+    cursor.execute("DELETE FROM SYNC_STATE WHERE table_name = ?", (table_name,))
+
+# Function to get the checkpoint of an interrupted load using its own connection
+def retrieve_checkpoint(table_name):
+    # Load Madina Warehouse database connection config
+    madin_warehouse_db = load_madin_warehouse_db_config()
+
+    # Establish connection to Madin Warehouse database
+    cnxn = get_connection(madin_warehouse_db)
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            checkpoint = load_checkpoint(cursor, table_name)
+            cnxn.commit()
+            return checkpoint
+        except Exception as e:
+            print(f"Error reading {table_name} checkpoint: {e}")
+            return None
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return None
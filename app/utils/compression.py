@@ -0,0 +1,80 @@
+import anyio.to_thread
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+
+from app.utils.serialization import zstandard
+
+# ASGI application wrapping the send channel of a request to compress the response body (whole or
+# streamed) with zstd. Only the public ASGI messages are used: the response start is held until the
+# first body chunk tells whether the response is large enough (or streamed) to be compressed.
+class ZstdResponder:
+    def __init__(self, app, minimum_size, level=3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        self.send = None
+        self.start_message = None
+        self.started = False
+        self.compressing = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            headers = Headers(raw=self.start_message["headers"])
+            # Already encoded responses and small complete bodies are sent as they are
+            self.compressing = "content-encoding" not in headers and (more_body or len(body) >= self.minimum_size)
+            if self.compressing:
+                headers = MutableHeaders(raw=self.start_message["headers"])
+                headers["Content-Encoding"] = "zstd"
+                headers.add_vary_header("Accept-Encoding")
+                body = await self.compress(body, more_body)
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(body))
+            await self.send(self.start_message)
+            await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+            return
+
+        if self.compressing:
+            body = await self.compress(body, more_body)
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    # Function to compress a body chunk, off the event loop for large bodies; each streamed chunk is
+    # flushed as a complete block so that the client can decode it as soon as it arrives
+    async def compress(self, body, more_body):
+        return await anyio.to_thread.run_sync(self._compress_body, body, more_body)
+
+    def _compress_body(self, body, more_body):
+        if more_body:
+            return self.compressor.compress(body) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self.compressor.compress(body) + self.compressor.flush()
+
+
+# Middleware negotiating the response encoding from Accept-Encoding: zstd when the client accepts it
+# and zstandard is installed, gzip otherwise
+class CompressionMiddleware(GZipMiddleware):
+    def __init__(self, app, minimum_size=1000, gzip_level=6, zstd_level=3):
+        super().__init__(app, minimum_size=minimum_size, compresslevel=gzip_level)
+        self.zstd_level = zstd_level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and zstandard is not None:
+            accepted = [encoding.split(";")[0].strip().lower() for encoding in Headers(scope=scope).get("Accept-Encoding", "").split(",")]
+            if "zstd" in accepted:
+                await ZstdResponder(self.app, self.minimum_size, level=self.zstd_level)(scope, receive, send)
+                return
+        await super().__call__(scope, receive, send)
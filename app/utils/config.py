@@ -0,0 +1,21 @@
+import os
+import json
+
+# Function to load the synchronisation engine settings from a JSON file
+def load_sync_config():
+    sync_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sync_config.json')
+    if not os.path.exists(sync_config_path):
+        return {}
+    with open(sync_config_path) as file:
+        sync_config = json.load(file)
+    return sync_config
+
+# Function to read a single setting from a section of the synchronisation settings
+def get_sync_setting(section, key, default=None):
+    return load_sync_config().get(section, {}).get(key, default)
+
+# Function to resolve a directory from the settings, relative paths being taken from the app folder
+def resolve_app_path(path):
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(__file__), '..', path)
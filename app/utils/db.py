@@ -0,0 +1,50 @@
+import pyodbc
+import os
+import json
+
+# ODBC connection attribute for the network packet size, it has to be set before connecting
+SQL_ATTR_PACKET_SIZE = 112
+
+# Function to establish database connection. The optional keys of the connection file tune it:
+# DB_READ_HOST (read replica used for read-only connections), PACKET_SIZE (bytes),
+# QUERY_TIMEOUT (seconds, 0 = no timeout) and SNAPSHOT_READS (snapshot isolation for read-only connections)
+def get_connection(db_config, read_only=False):
+    conn = None
+    try:
+        host = db_config['DB_HOST']
+        connection_string = (
+            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
+            f"DATABASE={db_config['DB_CONNECTION']};"
+            f"UID={db_config['DB_USERNAME']};"
+            f"PWD={db_config['DB_PASSWORD']};"
+        )
+        if read_only:
+            # Routed to a readable secondary by an availability group listener, or sent to the replica directly
+            host = db_config.get('DB_READ_HOST') or host
+            connection_string += "ApplicationIntent=ReadOnly;"
+        connect_options = {}
+        if db_config.get('PACKET_SIZE'):
+            connect_options['attrs_before'] = {SQL_ATTR_PACKET_SIZE: int(db_config['PACKET_SIZE'])}
+        conn = pyodbc.connect(f"SERVER={host};" + connection_string, **connect_options)
+        if db_config.get('QUERY_TIMEOUT'):
+            conn.timeout = int(db_config['QUERY_TIMEOUT'])
+        if read_only and db_config.get('SNAPSHOT_READS'):
+            # Extracts see a consistent state without taking shared locks on Sage X3 tables
+            conn.execute("SET TRANSACTION ISOLATION LEVEL SNAPSHOT")
+    except Exception as e:
+        print(f"Error connecting to database: {e}")
+    return conn
+
+# Function to load the Madin Warehouse database connection configuration from a JSON file
+def load_madin_warehouse_db_config():
+    madin_warehouse_db_config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'madinWdb_Connection.json')
+    with open(madin_warehouse_db_config_path) as file:
+        madin_warehouse_db_config = json.load(file)
+    return madin_warehouse_db_config
+
+# Function to load sagex3 database connection configuration from a JSON file
+def load_sage_x3_db_config():
+    sage_db_connection_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'sageX3db_Connection.json')
+    with open(sage_db_connection_path) as file:
+        sagex3_db_config = json.load(file)
+    return sagex3_db_config
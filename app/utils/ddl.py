@@ -0,0 +1,231 @@
+from datetime import date
+
+from app.utils.config import get_sync_setting
+
+# Physical design of the warehouse fact tables: clustered key on the business key,
+# nonclustered indexes on dates and codes, and the date column used for yearly partitioning.
+# Tables synced by company slices have an index led by their company column, so that each slice
+# deletes and reads only the rows of its company (no scan locking the other slices' rows).
+TABLE_DESIGNS = {
+    "SALESINVOICE": {
+        "clustered": ["numFacture", "ligneFacture"],
+        "indexes": [["dateFacture"], ["codeClient"], ["codeArticle"], ["rowID"], ["dossier"], ["societe", "dateFacture"]],
+        "partition_column": "dateFacture",
+    },
+    "SALESORDER": {
+        "clustered": ["numCommande", "ligneCommande"],
+        "indexes": [["dateCommande"], ["codeClient"], ["codeArticle"], ["rowID"], ["dossier"], ["societe", "dateCommande"]],
+        "partition_column": "dateCommande",
+    },
+    "SDELIVERY": {
+        "clustered": ["numBL", "ligneBL"],
+        "indexes": [["dateLivraison"], ["codeClient"], ["codeArticle"], ["rowID"], ["dossier"], ["societe", "dateLivraison"]],
+        "partition_column": "dateLivraison",
+    },
+    "SALESQUOTE": {
+        "clustered": ["numDevis"],
+        "indexes": [["dateDevis"], ["codeClient"], ["codeArticle"], ["rowID"], ["dossier"], ["societe", "dateDevis"]],
+        "partition_column": "dateDevis",
+    },
+    "PORDER": {
+        "clustered": ["numCommande", "ligneCommande"],
+        "indexes": [["dateCommande"], ["codeFournisseur"], ["codeArticle"], ["ROWID"], ["dossier"], ["CRY_0", "dateCommande"]],
+        "partition_column": "dateCommande",
+    },
+    "PRECEIPT": {
+        "clustered": ["numReception"],
+        "indexes": [["dateReception"], ["codeFournisseur"], ["codeArticle"], ["ROWID"], ["dossier"], ["numCommande", "ligneCommande"], ["CRY_0", "dateReception"]],
+        "partition_column": "dateReception",
+    },
+    "POSTEDECHARGE": {
+        "clustered": ["dossier", "poste", "schema", "dateschema"],
+        "indexes": [["dateschema"], ["company"]],
+        "partition_column": "dateschema",
+    },
+}
+
+PARTITION_FUNCTION = "PF_YEARLY_DATE"
+PARTITION_SCHEME = "PS_YEARLY_DATE"
+
+# Function to create the yearly partition function and scheme if they do not exist
+def ensure_yearly_partition_scheme(cursor):
+    first_year = get_sync_setting("ddl", "first_partition_year", 2013)
+    last_year = get_sync_setting("ddl", "last_partition_year", 2030)
+    boundaries = ", ".join(f"'{year}-01-01'" for year in range(first_year, last_year + 1))
+    cursor.execute(f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.partition_functions WHERE name = '{PARTITION_FUNCTION}')
+            CREATE PARTITION FUNCTION {PARTITION_FUNCTION} (DATE) AS RANGE RIGHT FOR VALUES ({boundaries})
+    """)
+    cursor.execute(f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.partition_schemes WHERE name = '{PARTITION_SCHEME}')
+            CREATE PARTITION SCHEME {PARTITION_SCHEME} AS PARTITION {PARTITION_FUNCTION} ALL TO ([PRIMARY])
+    """)
+
+def _get_index(cursor, table_name, index_name):
+    cursor.execute("""
+        SELECT i.type_desc, ds.type
+        FROM sys.indexes i
+        INNER JOIN sys.data_spaces ds ON ds.data_space_id = i.data_space_id
+        WHERE i.object_id = OBJECT_ID(?) AND i.name = ?
+    """, (table_name, index_name))
+    return cursor.fetchone()
+
+# Function to get the key columns of an index (lower case, in key order), empty if it does not exist
+def get_index_columns(cursor, table_name, index_name):
+    cursor.execute("""
+        SELECT c.name
+        FROM sys.indexes i
+        INNER JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+        INNER JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE i.object_id = OBJECT_ID(?) AND i.name = ? AND ic.key_ordinal > 0
+        ORDER BY ic.key_ordinal
+    """, (table_name, index_name))
+    return [row[0].lower() for row in cursor.fetchall()]
+
+def _column_list(columns):
+    return ", ".join(f"[{column}]" for column in columns)
+
+# Function to move the primary key created on the ID column by the original DDL out of the way:
+# it becomes nonclustered, or an aligned plain index when the table is partitioned
+def _release_clustered_primary_key(cursor, table_name, storage):
+    cursor.execute("""
+        SELECT kc.name, i.type_desc
+        FROM sys.key_constraints kc
+        INNER JOIN sys.indexes i ON i.object_id = kc.parent_object_id AND i.index_id = kc.unique_index_id
+        WHERE kc.parent_object_id = OBJECT_ID(?) AND kc.type = 'PK'
+    """, (table_name,))
+    primary_key = cursor.fetchone()
+    if primary_key is None or (primary_key[1] == "NONCLUSTERED" and not storage):
+        return
+    cursor.execute(f"ALTER TABLE [{table_name}] DROP CONSTRAINT [{primary_key[0]}]")
+    if storage:
+        # A unique key would have to contain the partition column, so a plain aligned index
+        # is used instead and partitions stay switchable
+        cursor.execute(f"CREATE INDEX [IX_{table_name}_ID] ON [{table_name}] ([ID]){storage}")
+    else:
+        cursor.execute(f"ALTER TABLE [{table_name}] ADD CONSTRAINT [PK_{table_name}] PRIMARY KEY NONCLUSTERED ([ID])")
+
+# Function to create or migrate in place the indexes (and optional partitioning/columnstore) of a table.
+# design_name selects the design of another table, e.g. for the staging copy of a fact table.
+def apply_table_design(cursor, table_name, design_name=None):
+    design = TABLE_DESIGNS.get(design_name or table_name)
+    if design is None:
+        return
+    partitioned = get_sync_setting("ddl", "partition_by_year", False)
+    columnstore = get_sync_setting("ddl", "clustered_columnstore", False)
+    storage = f" ON {PARTITION_SCHEME}([{design['partition_column']}])" if partitioned else ""
+    if partitioned:
+        ensure_yearly_partition_scheme(cursor)
+
+    _release_clustered_primary_key(cursor, table_name, storage)
+
+    clustered_name = f"CIX_{table_name}"
+    existing = _get_index(cursor, table_name, clustered_name)
+    wanted_type = "CLUSTERED COLUMNSTORE" if columnstore else "CLUSTERED"
+    is_partitioned = existing is not None and existing[1] == "PS"
+    if existing is None:
+        if columnstore:
+            cursor.execute(f"CREATE CLUSTERED COLUMNSTORE INDEX [{clustered_name}] ON [{table_name}]{storage}")
+        else:
+            cursor.execute(f"CREATE CLUSTERED INDEX [{clustered_name}] ON [{table_name}] ({_column_list(design['clustered'])}){storage}")
+        print(f"{wanted_type} index created on {table_name}.")
+    elif (existing[0] != wanted_type or is_partitioned != bool(partitioned)
+          or (not columnstore and get_index_columns(cursor, table_name, clustered_name) != [column.lower() for column in design["clustered"]])):
+        # Rebuild the clustered index in place to switch rowstore/columnstore, partitioning or key columns
+        if columnstore:
+            cursor.execute(f"CREATE CLUSTERED COLUMNSTORE INDEX [{clustered_name}] ON [{table_name}] WITH (DROP_EXISTING = ON){storage}")
+        else:
+            cursor.execute(f"CREATE CLUSTERED INDEX [{clustered_name}] ON [{table_name}] ({_column_list(design['clustered'])}) WITH (DROP_EXISTING = ON){storage}")
+        print(f"{wanted_type} index of {table_name} rebuilt.")
+
+    for columns in design["indexes"]:
+        _apply_index(cursor, table_name, columns, storage, partitioned)
+
+def _apply_index(cursor, table_name, columns, storage, partitioned):
+    index_name = f"IX_{table_name}_{'_'.join(columns)}"
+    existing = _get_index(cursor, table_name, index_name)
+    if existing is None:
+        cursor.execute(f"CREATE INDEX [{index_name}] ON [{table_name}] ({_column_list(columns)}){storage}")
+    elif (existing[1] == "PS") != bool(partitioned):
+        cursor.execute(f"CREATE INDEX [{index_name}] ON [{table_name}] ({_column_list(columns)}) WITH (DROP_EXISTING = ON){storage}")
+
+# Function to create the index led by the company column of a table synced by company slices when
+# it is missing (tables created before it was part of their design)
+def ensure_company_index(cursor, table_name, company_column):
+    design = TABLE_DESIGNS.get(table_name)
+    if design is None:
+        return
+    for columns in design["indexes"]:
+        if columns[0] == company_column:
+            partitioned = get_sync_setting("ddl", "partition_by_year", False)
+            storage = f" ON {PARTITION_SCHEME}([{design['partition_column']}])" if partitioned else ""
+            if partitioned:
+                ensure_yearly_partition_scheme(cursor)
+            _apply_index(cursor, table_name, columns, storage, partitioned)
+
+# Function to add a column to an existing table, returns True if the column was missing
+def add_missing_column(cursor, table_name, column_name, column_type):
+    cursor.execute("SELECT COL_LENGTH(?, ?)", (table_name, column_name))
+    if cursor.fetchone()[0] is not None:
+        return False
+    cursor.execute(f"ALTER TABLE [{table_name}] ADD [{column_name}] {column_type}")
+    return True
+
+# Function to (re)create an empty staging copy of a table with the same columns, storage and indexes,
+# so that its partitions can be switched into the table
+def create_staging_table(cursor, table_name):
+    staging_name = f"{table_name}_STAGING"
+    cursor.execute(f"IF OBJECT_ID('{staging_name}', 'U') IS NOT NULL DROP TABLE [{staging_name}]")
+    cursor.execute(f"SELECT TOP 0 * INTO [{staging_name}] FROM [{table_name}]")
+    # Continue the identity of the table so that switched rows keep distinct IDs
+    cursor.execute(f"""
+        DECLARE @next_id BIGINT = IDENT_CURRENT('{table_name}') + 1;
+        DBCC CHECKIDENT ('{staging_name}', RESEED, @next_id) WITH NO_INFOMSGS;
+    """)
+    if get_sync_setting("ddl", "partition_by_year", False):
+        partition_column = TABLE_DESIGNS[table_name]["partition_column"]
+        cursor.execute(f"CREATE INDEX [IX_{staging_name}_ID] ON [{staging_name}] ([ID]) ON {PARTITION_SCHEME}([{partition_column}])")
+    apply_table_design(cursor, staging_name, design_name=table_name)
+    return staging_name
+
+# Function to split a date window on the yearly partition boundaries: the years fully covered by the
+# window are switched in as whole partitions, the remaining spans are reloaded with DELETE/INSERT
+def split_period_by_year(date_from, date_to):
+    partitioned = get_sync_setting("ddl", "partition_by_year", False)
+    first_year = get_sync_setting("ddl", "first_partition_year", 2013)
+    last_year = get_sync_setting("ddl", "last_partition_year", 2030)
+    switched_years = []
+    spans = []
+    for year in range(date_from.year, date_to.year + 1):
+        start = max(date_from, date(year, 1, 1))
+        end = min(date_to, date(year, 12, 31))
+        # The partitions before the first and from the last boundary hold several years
+        if partitioned and first_year <= year < last_year and start == date(year, 1, 1) and end == date(year, 12, 31):
+            switched_years.append(year)
+        else:
+            spans.append((start, end))
+    return switched_years, spans
+
+# Function to replace the rows of a date window by the rows of the staging table.
+# Runs in the caller's transaction, so the window is swapped atomically.
+def switch_period_into_table(cursor, table_name, staging_name, columns, date_from, date_to):
+    partition_column = TABLE_DESIGNS[table_name]["partition_column"]
+    switched_years, spans = split_period_by_year(date_from, date_to)
+
+    for year in switched_years:
+        cursor.execute(f"SELECT $PARTITION.{PARTITION_FUNCTION}(?)", (date(year, 1, 1),))
+        partition_number = cursor.fetchone()[0]
+        cursor.execute(f"TRUNCATE TABLE [{table_name}] WITH (PARTITIONS ({partition_number}))")
+        cursor.execute(f"ALTER TABLE [{staging_name}] SWITCH PARTITION {partition_number} TO [{table_name}] PARTITION {partition_number}")
+    if switched_years:
+        # Move the identity of the table past the IDs of the switched rows
+        cursor.execute(f"DBCC CHECKIDENT ('{table_name}', RESEED) WITH NO_INFOMSGS")
+
+    column_list = _column_list(columns)
+    for start, end in spans:
+        cursor.execute(f"DELETE FROM [{table_name}] WHERE [{partition_column}] >= ? AND [{partition_column}] <= ?", (start, end))
+        cursor.execute(f"""
+            INSERT INTO [{table_name}] ({column_list})
+            SELECT {column_list} FROM [{staging_name}] WHERE [{partition_column}] >= ? AND [{partition_column}] <= ?
+        """, (start, end))
+    return switched_years, spans
@@ -0,0 +1,182 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.ddl import add_missing_column
+
+# Integer keys written next to the natural columns of the fact tables, so that the model joins
+# the facts to its dimensions on integers: yyyymmdd DateKey (same value as [Date].DateKey) and
+# surrogate keys of the customers, items, workstations and companies kept in DIMENSION_KEY
+DIMENSION_KEY_DESIGNS = {
+    "SALESINVOICE": {"date": "dateFacture", "customer": "codeClient", "item": "codeArticle", "company": "societe"},
+    "SALESORDER": {"date": "dateCommande", "customer": "codeClient", "item": "codeArticle", "company": "societe"},
+    "SDELIVERY": {"date": "dateLivraison", "customer": "codeClient", "item": "codeArticle", "company": "societe"},
+    "SALESQUOTE": {"date": "dateDevis", "customer": "codeClient", "item": "codeArticle", "company": "societe"},
+    "SUIVITEMPSOF": {"date": "dateimputation", "workstation": "posterealise", "company": "company"},
+    "POSTEDECHARGE": {"date": "dateschema", "workstation": "poste", "company": "company"},
+}
+
+# Key column of each dimension, in the order the key columns follow the fact columns
+DIMENSION_KEY_COLUMNS = {"date": "DateKey", "customer": "customerKey", "item": "itemKey", "workstation": "workstationKey", "company": "companyKey"}
+
+SURROGATE_DIMENSIONS = ["customer", "item", "workstation", "company"]
+
+_assign_lock = threading.Lock()
+
+# Function to create the DIMENSION_KEY table (natural key -> surrogate key of each dimension) if it does not exist
+def ensure_dimension_key_table(cursor):
+    cursor.execute("""
+        IF OBJECT_ID('DIMENSION_KEY', 'U') IS NULL
+            CREATE TABLE DIMENSION_KEY (
+                dimension VARCHAR(20),
+                naturalKey VARCHAR(255),
+                surrogateKey INT,
+                PRIMARY KEY (dimension, naturalKey),
+                UNIQUE (dimension, surrogateKey)
+            )
+    """)
+
+# Function to get the names of the key columns added to the rows of a fact table
+def get_dimension_key_columns(fact_table):
+    return [DIMENSION_KEY_COLUMNS[dimension] for dimension in DIMENSION_KEY_DESIGNS[fact_table]]
+
+# Function to compute the yyyymmdd integer keys of date values in one vectorized pass (None for missing dates)
+def compute_date_keys(values):
+    dates = pd.to_datetime(pd.Series(values), errors="coerce")
+    keys = (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).to_numpy()
+    result = np.where(np.isnan(keys), 0, keys).astype(np.int64).astype(object)
+    result[np.isnan(keys)] = None
+    return result
+
+
+# In-memory hash map of the surrogate keys of one dimension, loaded once per load and applied
+# to whole batches. Natural keys met for the first time get the next keys, persisted right away
+# in their own transaction so that a key is never handed out twice.
+class DimensionKeyMap:
+    def __init__(self, dimension, keys):
+        self.dimension = dimension
+        self._set_keys(keys)
+
+    def _set_keys(self, keys):
+        # Index and keys are swapped together, parallel loads (company shards) may share the map
+        self.state = (pd.Index(list(keys.keys()), dtype=object), np.array(list(keys.values()), dtype=np.int64))
+        self.keys = keys
+
+    # Function to get the surrogate keys of a batch of natural key values (None for missing values)
+    def lookup(self, values):
+        natural = pd.Series(values, dtype=object)
+        present = natural.notna().to_numpy()
+        natural = natural.where(~present, natural.astype(str))
+        index, surrogates = self.state
+        positions = index.get_indexer(natural)
+        unknown = present & (positions < 0)
+        if unknown.any():
+            self.assign(natural[unknown].unique().tolist())
+            index, surrogates = self.state
+            positions = index.get_indexer(natural)
+        if len(surrogates) == 0:
+            return np.full(len(natural), None, dtype=object)
+        result = surrogates[np.where(positions < 0, 0, positions)].astype(object)
+        result[~present] = None
+        return result
+
+    # Function to give surrogate keys to new natural keys and persist them in DIMENSION_KEY
+    def assign(self, natural_keys):
+        with _assign_lock:
+            natural_keys = [key for key in natural_keys if key not in self.keys]
+            if not natural_keys:
+                return
+            cnxn = get_connection(load_madin_warehouse_db_config())
+            if not cnxn:
+                raise RuntimeError("Failed to connect to the target database.")
+            try:
+                cursor = cnxn.cursor()
+                ensure_dimension_key_table(cursor)
+                # The table lock makes the read of the last key and the inserts atomic across processes
+                cursor.execute("SELECT naturalKey, surrogateKey FROM DIMENSION_KEY WITH (TABLOCKX, HOLDLOCK) WHERE dimension = ?", (self.dimension,))
+                stored = {row[0]: row[1] for row in cursor.fetchall()}
+                next_key = max(stored.values(), default=0) + 1
+                new_rows = []
+                for key in natural_keys:
+                    if key not in stored:
+                        stored[key] = next_key
+                        new_rows.append((self.dimension, key, next_key))
+                        next_key += 1
+                if new_rows:
+                    cursor.executemany("INSERT INTO DIMENSION_KEY (dimension, naturalKey, surrogateKey) VALUES (?, ?, ?)", new_rows)
+                cnxn.commit()
+            finally:
+                cnxn.close()
+            self._set_keys(stored)
+
+
+# Function to load the surrogate key maps of the customer, item, workstation and company dimensions
+def load_dimension_keys():
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if not cnxn:
+        raise RuntimeError("Failed to connect to the target database.")
+    try:
+        cursor = cnxn.cursor()
+        ensure_dimension_key_table(cursor)
+        cnxn.commit()
+        cursor.execute("SELECT dimension, naturalKey, surrogateKey FROM DIMENSION_KEY")
+        keys = {dimension: {} for dimension in SURROGATE_DIMENSIONS}
+        for dimension, natural_key, surrogate_key in cursor.fetchall():
+            if dimension in keys:
+                keys[dimension][natural_key] = surrogate_key
+        return {dimension: DimensionKeyMap(dimension, dimension_keys) for dimension, dimension_keys in keys.items()}
+    finally:
+        cnxn.close()
+
+# Function to add the key columns of a fact table to a batch of its rows (a copy, the batch is not modified).
+# dimension_keys are the maps of load_dimension_keys(), loaded once for all the batches of a load.
+def add_dimension_keys(data, fact_table, dimension_keys=None):
+    if dimension_keys is None:
+        dimension_keys = load_dimension_keys()
+    data = data.copy()
+    for dimension, column in DIMENSION_KEY_DESIGNS[fact_table].items():
+        if dimension == "date":
+            data[DIMENSION_KEY_COLUMNS[dimension]] = compute_date_keys(data[column].to_numpy())
+        else:
+            data[DIMENSION_KEY_COLUMNS[dimension]] = dimension_keys[dimension].lookup(data[column].to_numpy())
+    return data
+
+# Function to add the key columns to an existing fact table and fill them for its rows, in the caller's transaction
+# (returns True when the columns were added)
+def add_dimension_key_columns(cursor, fact_table):
+    added = False
+    for dimension in DIMENSION_KEY_DESIGNS[fact_table]:
+        added = add_missing_column(cursor, fact_table, DIMENSION_KEY_COLUMNS[dimension], "INT") or added
+    if added:
+        backfill_dimension_keys(cursor, fact_table)
+    return added
+
+# Function to fill the key columns of the rows already in a fact table
+def backfill_dimension_keys(cursor, fact_table):
+    design = DIMENSION_KEY_DESIGNS[fact_table]
+    date_column = design["date"]
+    cursor.execute(f"""
+        UPDATE [{fact_table}]
+        SET DateKey = YEAR([{date_column}]) * 10000 + MONTH([{date_column}]) * 100 + DAY([{date_column}])
+    """)
+    dimension_keys = load_dimension_keys()
+    for dimension, column in design.items():
+        if dimension == "date":
+            continue
+        cursor.execute(f"SELECT DISTINCT [{column}] FROM [{fact_table}] WHERE [{column}] IS NOT NULL")
+        # Give keys to the natural keys not met yet, then set the keys with one join
+        dimension_keys[dimension].lookup([row[0] for row in cursor.fetchall()])
+        cursor.execute(f"""
+            UPDATE fact SET [{DIMENSION_KEY_COLUMNS[dimension]}] = dimension_key.surrogateKey
+            FROM [{fact_table}] fact
+            INNER JOIN DIMENSION_KEY dimension_key ON dimension_key.dimension = ? AND dimension_key.naturalKey = fact.[{column}]
+        """, (dimension,))
+
+# Function to append the key values to a batch of fact rows given as lists (in the order of columns)
+def append_dimension_keys(rows, columns, fact_table, dimension_keys):
+    if not rows:
+        return []
+    key_rows = add_dimension_keys(pd.DataFrame(rows, columns=columns), fact_table, dimension_keys)[get_dimension_key_columns(fact_table)].values.tolist()
+    return [list(row) + key_row for row, key_row in zip(rows, key_rows)]
@@ -0,0 +1,41 @@
+from fastapi.responses import Response
+
+from app.utils.snapshot import compute_checksum
+
+# Function to build a strong ETag from a version tag (checksum, row count and max key, ...)
+def make_etag(*version):
+    return '"' + "-".join(str(part) for part in version) + '"'
+
+# Function to get the ETag of an extract: the checksum of its data, computed once per DataFrame
+# (the cached extracts are served many times)
+def get_data_etag(data):
+    if "etag" not in data.attrs:
+        data.attrs["etag"] = make_etag(compute_checksum(data)[:32])
+    return data.attrs["etag"]
+
+# Function to check if the If-None-Match header of a request matches the current ETag
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # A list of tags, weak tags compare equal to their strong form for GET requests
+    client_etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in client_etags
+
+# Function to build the 304 answer sent when the client already has the current version
+def not_modified_response(etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
+# Function to get the ETag of the rows returned by a warehouse query from their row count and an aggregate
+# checksum computed by SQL Server, so that a 304 is answered without transferring and hashing the rows
+def get_query_etag(cursor, name, query, params=None, columns=None):
+    version_query = f"SELECT COUNT_BIG(*), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM ({query}) AS version"
+    if params:
+        cursor.execute(version_query, params)
+    else:
+        cursor.execute(version_query)
+    row_count, checksum = cursor.fetchone()
+    # The projected column names are part of the representation, not of the checksum
+    return make_etag(name, row_count, checksum, *(columns or []))
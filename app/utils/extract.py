@@ -0,0 +1,76 @@
+import threading
+import pyodbc
+import pandas as pd
+
+from app.utils.config import get_sync_setting
+from app.utils.db import get_connection
+from app.utils.retry import run_batch_with_retry
+
+_connection_budget = None
+_connection_budget_lock = threading.Lock()
+
+# Function to get the semaphore bounding the number of extraction sessions open at the same time
+# on Sage X3, shared by every parallel extract (folders, shards)
+def get_connection_budget():
+    global _connection_budget
+    with _connection_budget_lock:
+        if _connection_budget is None:
+            _connection_budget = threading.BoundedSemaphore(get_sync_setting("source", "max_parallel_connections", 4))
+        return _connection_budget
+
+# Extraction session: one read-only connection and one snapshot isolation transaction shared by all
+# the queries of an extract, so that header and line tables (or several ranges of the same table)
+# are read as of the same point in time without taking shared locks on the Sage X3 tables.
+class ExtractionSession:
+    def __init__(self, db_config, cnxn=None):
+        self.db_config = db_config
+        self.cnxn = cnxn
+        self.snapshot = False
+
+    def __enter__(self):
+        if self.cnxn is None:
+            self.cnxn = get_connection(self.db_config, read_only=True)
+            if self.cnxn is None:
+                raise pyodbc.OperationalError("08001", "Failed to connect to the source database.")
+        cursor = self.cnxn.cursor()
+        cursor.execute("SELECT snapshot_isolation_state FROM sys.databases WHERE name = DB_NAME()")
+        row = cursor.fetchone()
+        # The isolation level can only be changed before the transaction starts
+        self.cnxn.commit()
+        if row is not None and row[0] == 1:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL SNAPSHOT")
+            self.snapshot = True
+        else:
+            print("Snapshot isolation is not allowed on the source database, extracting under the default isolation level.")
+        return self
+
+    # Function to run one query of the extract in the session transaction
+    def read_sql(self, query, params=None):
+        return pd.read_sql(query, self.cnxn, params=params)
+
+    # Function to stream the result of a query by chunks; a chunked result has to be fully
+    # consumed before the next query of the session is run
+    def read_sql_chunks(self, query, params=None, chunksize=50000):
+        return pd.read_sql(query, self.cnxn, params=params, chunksize=chunksize)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            # Nothing was written, ending the transaction releases the snapshot
+            self.cnxn.rollback()
+        finally:
+            self.cnxn.close()
+        return False
+
+
+# Function to run an extract function (taking the session) in one snapshot session. After a transient
+# error the whole session is replayed, so the queries never mix two points in time.
+def run_extraction(db_config, extract, operation_name):
+    result = {}
+
+    def run_session(cnxn):
+        with ExtractionSession(db_config, cnxn) as session:
+            result["data"] = extract(session)
+
+    with get_connection_budget():
+        run_batch_with_retry(None, db_config, run_session, operation_name, read_only=True)
+    return result["data"]
@@ -0,0 +1,118 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from app.utils.config import get_sync_setting
+from app.utils.ddl import add_missing_column
+from app.utils.extract import run_extraction
+from app.utils.reconcile import propagate_deletes
+
+# Column holding the Sage X3 folder of each row in the warehouse tables
+FOLDER_COLUMN = "dossier"
+
+# Folder the source queries are written against
+DEFAULT_FOLDER = {"name": "SEED", "database": "x3v12src", "schema": "SEED"}
+
+# Table references of the default folder in the source queries: [x3v12src].[SEED], [x3v12src].[dbo]
+# (custom tables such as YREPRE) and unqualified SEED.
+_FOLDER_REFERENCE = re.compile(r"\[x3v12src\]\.\[(SEED|dbo)\]|(?<![\w\].\[])SEED\.")
+
+# Function to get the Sage X3 folders to synchronize, in load order
+def get_folders():
+    return get_sync_setting("source", "folders", [DEFAULT_FOLDER])
+
+# Function to rewrite a source query written for the default folder so that it reads another folder
+def qualify_query(query, folder):
+    database = folder.get("database", DEFAULT_FOLDER["database"])
+
+    def replace(match):
+        if match.group(1) == "dbo":
+            return f"[{database}].[{folder.get('custom_schema', 'dbo')}]"
+        if match.group(1) == "SEED":
+            return f"[{database}].[{folder['schema']}]"
+        return f"[{database}].[{folder['schema']}]."
+
+    return _FOLDER_REFERENCE.sub(replace, query)
+
+# Function to run the same extract on several folders in parallel (within the connection budget)
+# and stack the results, with the folder name in a last dossier column
+def run_folder_extraction(db_config, source_query, operation_name, params=None, folders=None):
+    folders = get_folders() if folders is None else folders
+
+    def extract_folder(folder):
+        folder_query = qualify_query(source_query, folder)
+        data = run_extraction(db_config, lambda session: session.read_sql(folder_query, params), f"{operation_name} ({folder['name']})")
+        data[FOLDER_COLUMN] = folder["name"]
+        return data
+
+    if len(folders) == 1:
+        return extract_folder(folders[0])
+    with ThreadPoolExecutor(max_workers=len(folders)) as executor:
+        frames = list(executor.map(extract_folder, folders))
+    return pd.concat(frames, ignore_index=True)
+
+# Function to group extracted rows (lists ending with the folder name) by folder
+def group_rows_by_folder(data):
+    rows_by_folder = {}
+    for row in data:
+        rows_by_folder.setdefault(row[-1], []).append(row)
+    return rows_by_folder
+
+# Function to add the folder column to an existing warehouse table, the rows already loaded
+# coming from the default folder
+def add_folder_column(cursor, table_name):
+    if add_missing_column(cursor, table_name, FOLDER_COLUMN, "VARCHAR(50)"):
+        cursor.execute(f"UPDATE [{table_name}] SET [{FOLDER_COLUMN}] = ?", (get_folders()[0]["name"],))
+        print(f"{FOLDER_COLUMN} column added to {table_name}.")
+
+# Function to scope the single-column key (UNIQUE or PRIMARY KEY constraint) of a table created
+# before multi-folder support to the folder, a key value being unique within a folder only
+def scope_unique_key_to_folder(cursor, table_name, key_column):
+    cursor.execute("""
+        SELECT kc.name, kc.type
+        FROM sys.key_constraints kc
+        INNER JOIN sys.index_columns ic ON ic.object_id = kc.parent_object_id AND ic.index_id = kc.unique_index_id
+        INNER JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE kc.parent_object_id = OBJECT_ID(?) AND kc.type IN ('PK', 'UQ')
+        GROUP BY kc.name, kc.type
+        HAVING COUNT(*) = 1 AND MAX(c.name) = ?
+    """, (table_name, key_column))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    constraint_name, constraint_type = row[0], row[1].strip()
+    cursor.execute(f"ALTER TABLE [{table_name}] DROP CONSTRAINT [{constraint_name}]")
+    if constraint_type == "PK":
+        # The columns of a primary key cannot be nullable
+        cursor.execute(f"ALTER TABLE [{table_name}] ALTER COLUMN [{FOLDER_COLUMN}] VARCHAR(50) NOT NULL")
+        cursor.execute(f"ALTER TABLE [{table_name}] ADD CONSTRAINT [PK_{table_name}_{key_column}_{FOLDER_COLUMN}] PRIMARY KEY ([{key_column}], [{FOLDER_COLUMN}])")
+    else:
+        cursor.execute(f"ALTER TABLE [{table_name}] ADD CONSTRAINT [UQ_{table_name}_{key_column}_{FOLDER_COLUMN}] UNIQUE ([{key_column}], [{FOLDER_COLUMN}])")
+    print(f"{table_name} key migrated to ({key_column}, {FOLDER_COLUMN}).")
+    return True
+
+# Function to delete, folder by folder, the warehouse rows that no longer exist in Sage X3
+def propagate_folder_deletes(source_from, source_key, target_table, target_key, output_column=None, before_commit=None):
+    rows_deleted = 0
+    for folder in get_folders():
+        folder_rows_deleted = propagate_deletes(qualify_query(source_from, folder), source_key, target_table, target_key,
+                                                target_scope=(FOLDER_COLUMN, folder["name"]),
+                                                output_column=output_column, before_commit=before_commit)
+        if folder_rows_deleted is None:
+            return None
+        rows_deleted += folder_rows_deleted
+    return rows_deleted
+
+# Function to build the checkpoint key of a row in a load ordered by folder then ROWID
+def make_folder_key(folder_name, rowid):
+    return f"{folder_name}|{int(rowid)}"
+
+# Function to read a checkpoint key built by make_folder_key (keys saved before multi-folder
+# support only hold the ROWID and belong to the first folder)
+def parse_folder_key(folder_key):
+    if folder_key is None:
+        return get_folders()[0]["name"], None
+    if "|" not in folder_key:
+        return get_folders()[0]["name"], int(folder_key)
+    folder_name, rowid = folder_key.rsplit("|", 1)
+    return folder_name, int(rowid)
@@ -0,0 +1,217 @@
+import threading
+
+import pandas as pd
+
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.shards import compute_slice_watermark, load_watermarks, save_watermark
+from app.utils.snapshot import read_frame
+
+# Item classification hierarchy of ITMMASTER: the five statistical groups TSICOD_0..4 (with their
+# ATEXTRA names TSICOD_NAME_0..4) form the levels of the tree. A node is identified by the path
+# of the group codes from the first level ("A/B/C", with "%" and "/" of the codes escaped as "%25"
+# and "%2F" so that a code holding the separator cannot collide with a deeper node); an item hangs
+# under its deepest group.
+HIERARCHY_LEVELS = 5
+
+CLASSIFICATION_COLUMNS = ["ITMREF_0"] + [f"TSICOD_{level}" for level in range(HIERARCHY_LEVELS)] + \
+    [f"TSICOD_NAME_{level}" for level in range(HIERARCHY_LEVELS)]
+
+# Separator of the group codes in the node paths
+PATH_SEPARATOR = "/"
+
+# Version of the node id format, part of the classification signature so that a change of the
+# format rebuilds the stored hierarchy even when the classification did not change
+HIERARCHY_FORMAT = 2
+
+# Function to escape the group codes of a Series for the node paths ("%" first, then the separator)
+def escape_codes(codes):
+    return codes.str.replace("%", "%25", regex=False).str.replace(PATH_SEPARATOR, "%2F", regex=False)
+
+# Function to create the hierarchy tables if they do not exist: one row per node (parent/child),
+# and one row per item and ancestor node, so that the items under any node are an index seek
+def ensure_hierarchy_tables(cursor):
+    cursor.execute("""
+        IF OBJECT_ID('ITEM_HIERARCHY', 'U') IS NULL
+            CREATE TABLE ITEM_HIERARCHY (
+                nodeId VARCHAR(400) PRIMARY KEY,
+                parentId VARCHAR(400),
+                niveau INT,
+                code VARCHAR(255),
+                designation VARCHAR(255),
+                nbArticles INT
+            )
+    """)
+    cursor.execute("""
+        IF OBJECT_ID('ITEM_HIERARCHY_PATH', 'U') IS NULL
+        BEGIN
+            CREATE TABLE ITEM_HIERARCHY_PATH (
+                ancestorId VARCHAR(400),
+                niveau INT,
+                ITMREF_0 VARCHAR(255),
+                PRIMARY KEY (ancestorId, ITMREF_0)
+            );
+            CREATE INDEX IX_ITEM_HIERARCHY_PATH_ITMREF ON ITEM_HIERARCHY_PATH (ITMREF_0)
+        END
+    """)
+
+# Function to normalize the classification columns of the items (blank groups as empty strings)
+def get_classification(data):
+    classification = data[CLASSIFICATION_COLUMNS].copy()
+    for column in CLASSIFICATION_COLUMNS:
+        classification[column] = classification[column].fillna("").astype(str).str.strip()
+    return classification.sort_values("ITMREF_0").reset_index(drop=True)
+
+# Function to compute the nodes (one row per node) and item paths (one row per item and ancestor)
+# of a classification with group-bys over the code paths of each level
+def build_hierarchy_frames(classification):
+    nodes = []
+    paths = []
+    # An item stops at its first blank group, the deeper groups are ignored
+    present = pd.Series(True, index=classification.index)
+    node_path = pd.Series("", index=classification.index)
+    for level in range(HIERARCHY_LEVELS):
+        code_column = f"TSICOD_{level}"
+        present &= classification[code_column] != ""
+        if not present.any():
+            break
+        parent_path = node_path.copy()
+        node_path = node_path.where(~present, (parent_path + PATH_SEPARATOR).where(parent_path != "", "") + escape_codes(classification[code_column]))
+        level_items = pd.DataFrame({
+            "nodeId": node_path[present],
+            "parentId": parent_path[present],
+            "code": classification.loc[present, code_column],
+            "designation": classification.loc[present, f"TSICOD_NAME_{level}"],
+            "ITMREF_0": classification.loc[present, "ITMREF_0"],
+        })
+        level_nodes = level_items.groupby("nodeId", as_index=False).agg(
+            parentId=("parentId", "first"), code=("code", "first"), designation=("designation", "first"), nbArticles=("ITMREF_0", "nunique"))
+        level_nodes["niveau"] = level
+        nodes.append(level_nodes)
+        paths.append(level_items[["nodeId", "ITMREF_0"]].rename(columns={"nodeId": "ancestorId"}).assign(niveau=level))
+    if not nodes:
+        return (pd.DataFrame(columns=["nodeId", "parentId", "niveau", "code", "designation", "nbArticles"]),
+                pd.DataFrame(columns=["ancestorId", "niveau", "ITMREF_0"]))
+    nodes = pd.concat(nodes, ignore_index=True)
+    nodes["parentId"] = nodes["parentId"].where(nodes["parentId"] != "", None)
+    paths = pd.concat(paths, ignore_index=True).drop_duplicates(["ancestorId", "ITMREF_0"])
+    return nodes[["nodeId", "parentId", "niveau", "code", "designation", "nbArticles"]], paths[["ancestorId", "niveau", "ITMREF_0"]]
+
+
+# In-memory tree of the hierarchy: nodes by id with their children, and the items under each
+# node (direct and descendant), so that a roll-up by group is a dictionary lookup
+class ItemHierarchy:
+    def __init__(self, nodes, paths, signature):
+        self.signature = signature
+        self.nodes = {}
+        for node in nodes.itertuples(index=False):
+            parent = node.parentId if isinstance(node.parentId, str) and node.parentId else None
+            name = node.designation if isinstance(node.designation, str) else None
+            self.nodes[node.nodeId] = {"id": node.nodeId, "parent": parent, "level": int(node.niveau),
+                                       "code": node.code, "name": name, "itemCount": int(node.nbArticles), "children": []}
+        self.roots = []
+        for node in sorted(self.nodes.values(), key=lambda node: node["id"]):
+            parent = self.nodes.get(node["parent"]) if node["parent"] is not None else None
+            (parent["children"] if parent is not None else self.roots).append(node["id"])
+        self.items = {node_id: sorted(group) for node_id, group in paths.groupby("ancestorId")["ITMREF_0"]} if len(paths) else {}
+        self.levels = {}
+        for node in self.nodes.values():
+            self.levels.setdefault(node["level"], []).append(node["id"])
+
+    # Function to get the items classified under a node (at any depth)
+    def get_items(self, node_id):
+        return self.items.get(node_id, [])
+
+    # Function to get a node and its descendants down to a depth, optionally with their items.
+    # children is always present, empty below the requested depth (hasChildren tells if it was cut).
+    def to_dict(self, node_id, depth=None, with_items=False):
+        node = self.nodes[node_id]
+        result = {key: node[key] for key in ("id", "code", "name", "level", "itemCount")}
+        result["hasChildren"] = bool(node["children"])
+        if with_items:
+            result["items"] = self.get_items(node_id)
+        if depth is None or depth > 0:
+            result["children"] = [self.to_dict(child, None if depth is None else depth - 1, with_items) for child in node["children"]]
+        else:
+            result["children"] = []
+        return result
+
+    # Function to get the whole tree, or the subtree of a node
+    def get_tree(self, node_id=None, depth=None, with_items=False):
+        if node_id is not None:
+            return self.to_dict(node_id, depth, with_items)
+        return [self.to_dict(root, None if depth is None else depth - 1, with_items) for root in self.roots] if depth != 0 else []
+
+    # Function to get the nodes of one level with their item counts (roll-up by group level)
+    def get_level(self, level):
+        return [{key: self.nodes[node_id][key] for key in ("id", "code", "name", "level", "itemCount")} for node_id in sorted(self.levels.get(level, []))]
+
+
+_hierarchy = None
+_hierarchy_lock = threading.Lock()
+
+# Function to get the signature of a classification (order independent), compared with the last built one
+def get_classification_signature(classification):
+    return f"{HIERARCHY_FORMAT}:{compute_slice_watermark(classification)}"
+
+# Function to rebuild the hierarchy tables and tree when the classification of the items changed.
+# data are the ITMMASTER rows just synchronized, read from the warehouse table when not given.
+# Returns True when the hierarchy was rebuilt, False when it was already up to date, None on error.
+def refresh_item_hierarchy(data=None):
+    global _hierarchy
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if not cnxn:
+        print("Failed to connect to the target database.")
+        return None
+    try:
+        cursor = cnxn.cursor()
+        if data is None:
+            data = read_frame(cursor, f"SELECT {', '.join(CLASSIFICATION_COLUMNS)} FROM ITMMASTER", CLASSIFICATION_COLUMNS)
+        classification = get_classification(data)
+        signature = get_classification_signature(classification)
+        ensure_hierarchy_tables(cursor)
+        if load_watermarks(cursor, "ITEM_HIERARCHY").get("classification") == signature:
+            cnxn.commit()
+            print("Item classification unchanged, hierarchy kept.")
+            return False
+
+        nodes, paths = build_hierarchy_frames(classification)
+        cursor.execute("TRUNCATE TABLE ITEM_HIERARCHY")
+        cursor.execute("TRUNCATE TABLE ITEM_HIERARCHY_PATH")
+        if len(nodes):
+            cursor.executemany("INSERT INTO ITEM_HIERARCHY (nodeId, parentId, niveau, code, designation, nbArticles) VALUES (?, ?, ?, ?, ?, ?)",
+                               nodes.astype(object).where(nodes.notna(), None).values.tolist())
+            cursor.executemany("INSERT INTO ITEM_HIERARCHY_PATH (ancestorId, niveau, ITMREF_0) VALUES (?, ?, ?)",
+                               paths.astype(object).values.tolist())
+        save_watermark(cursor, "ITEM_HIERARCHY", "classification", signature, len(classification))
+        cnxn.commit()
+        with _hierarchy_lock:
+            _hierarchy = ItemHierarchy(nodes, paths, signature)
+        print(f"Item hierarchy rebuilt: {len(nodes)} nodes, {len(paths)} item paths.")
+        return True
+    except Exception as e:
+        print(f"Error refreshing the item hierarchy: {e}")
+        return None
+    finally:
+        cnxn.close()
+
+# Function to get the in-memory hierarchy tree, loaded from the hierarchy tables on first use
+def get_item_hierarchy():
+    global _hierarchy
+    with _hierarchy_lock:
+        if _hierarchy is not None:
+            return _hierarchy
+        cnxn = get_connection(load_madin_warehouse_db_config())
+        if not cnxn:
+            raise RuntimeError("Failed to connect to the target database.")
+        try:
+            cursor = cnxn.cursor()
+            ensure_hierarchy_tables(cursor)
+            cnxn.commit()
+            nodes = read_frame(cursor, "SELECT nodeId, parentId, niveau, code, designation, nbArticles FROM ITEM_HIERARCHY",
+                                ["nodeId", "parentId", "niveau", "code", "designation", "nbArticles"])
+            paths = read_frame(cursor, "SELECT ancestorId, niveau, ITMREF_0 FROM ITEM_HIERARCHY_PATH", ["ancestorId", "niveau", "ITMREF_0"])
+            signature = load_watermarks(cursor, "ITEM_HIERARCHY").get("classification")
+        finally:
+            cnxn.close()
+        _hierarchy = ItemHierarchy(nodes, paths, signature)
+        return _hierarchy
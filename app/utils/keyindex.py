@@ -0,0 +1,157 @@
+import os
+import math
+import pickle
+import hashlib
+
+from app.utils.config import get_sync_setting, resolve_app_path
+
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+# Maximum number of parameters sent in one IN (...) query (SQL Server allows 2100)
+EXACT_CHECK_CHUNK_SIZE = 1000
+
+
+# Bloom filter used for string keys; a positive answer only means "maybe present"
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1024)
+        self.size = int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+# Persisted key-presence index of one warehouse table, or of the rows of a table matching a
+# scope (column, value), e.g. the rows of one Sage X3 folder
+class KeyPresenceIndex:
+    def __init__(self, table_name, key_column, key_type, row_count=0, scope=None):
+        self.table_name = table_name
+        self.key_column = key_column
+        self.key_type = key_type
+        self.row_count = row_count
+        self.scope = scope
+        if key_type == "int":
+            # Roaring bitmap for integer ROWIDs, plain set when pyroaring is not installed
+            self.keys = BitMap() if BitMap is not None else set()
+        else:
+            self.keys = BloomFilter(row_count * 2)
+
+    def _normalize(self, key):
+        return int(key) if self.key_type == "int" else str(key)
+
+    # Function to add keys to the index after their rows were inserted in the table
+    def add(self, keys, rows_inserted):
+        for key in keys:
+            self.keys.add(self._normalize(key))
+        self.row_count += rows_inserted
+
+    # Function to return the keys that are not yet present in the warehouse table
+    def find_new_keys(self, cursor, keys):
+        keys = {self._normalize(key) for key in keys}
+        if self.key_type == "int":
+            return {key for key in keys if key not in self.keys}
+
+        # Keys missing from the Bloom filter are new for sure, the others are checked exactly
+        new_keys = {key for key in keys if key not in self.keys}
+        candidates = list(keys - new_keys)
+        existing_keys = set()
+        for start in range(0, len(candidates), EXACT_CHECK_CHUNK_SIZE):
+            chunk = candidates[start:start + EXACT_CHECK_CHUNK_SIZE]
+            placeholders = ", ".join("?" for _ in chunk)
+            scope_condition, scope_params = _scope_condition(self.scope)
+            cursor.execute(f"SELECT [{self.key_column}] FROM [{self.table_name}] WHERE [{self.key_column}] IN ({placeholders}){scope_condition}",
+                           chunk + scope_params)
+            existing_keys.update(str(row[0]) for row in cursor.fetchall())
+        return new_keys | (set(candidates) - existing_keys)
+
+    # Function to persist the index to the local cache directory
+    def save(self):
+        try:
+            index_path = _key_index_path(self.table_name, self.scope)
+            temp_path = index_path + ".tmp"
+            with open(temp_path, "wb") as file:
+                pickle.dump(self, file)
+            os.replace(temp_path, index_path)
+        except Exception as e:
+            print(f"Error saving key index for {self.table_name}: {e}")
+
+
+def _get_key_index_dir():
+    index_dir = resolve_app_path(get_sync_setting("key_index", "directory", "cache/keyindex"))
+    os.makedirs(index_dir, exist_ok=True)
+    return index_dir
+
+def _key_index_path(table_name, scope=None):
+    if scope is None:
+        return os.path.join(_get_key_index_dir(), f"{table_name}.idx")
+    return os.path.join(_get_key_index_dir(), f"{table_name}@{scope[1]}.idx")
+
+def _scope_condition(scope):
+    if scope is None:
+        return "", []
+    return f" AND [{scope[0]}] = ?", [scope[1]]
+
+def _count_rows(cursor, table_name, scope):
+    scope_condition, scope_params = _scope_condition(scope)
+    cursor.execute(f"SELECT COUNT(*) FROM [{table_name}] WHERE 1 = 1{scope_condition}", scope_params)
+    return cursor.fetchone()[0]
+
+# Function to build the key-presence index of a table from the keys stored in the warehouse
+def build_key_index(cursor, table_name, key_column, key_type="int", scope=None):
+    row_count = _count_rows(cursor, table_name, scope)
+    key_index = KeyPresenceIndex(table_name, key_column, key_type, row_count, scope)
+    scope_condition, scope_params = _scope_condition(scope)
+    cursor.execute(f"SELECT [{key_column}] FROM [{table_name}] WHERE [{key_column}] IS NOT NULL{scope_condition}", scope_params)
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        for row in rows:
+            key_index.keys.add(key_index._normalize(row[0]))
+    key_index.save()
+    print(f"Key index for {table_name}{'' if scope is None else ' (' + str(scope[1]) + ')'} built with {row_count} rows.")
+    return key_index
+
+# Function to load the key-presence index of a table, rebuilding it when it is missing or stale
+def load_key_index(cursor, table_name, key_column, key_type="int", scope=None):
+    key_index = None
+    index_path = _key_index_path(table_name, scope)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "rb") as file:
+                key_index = pickle.load(file)
+        except Exception as e:
+            print(f"Error reading key index for {table_name}: {e}")
+
+    if key_index is not None and key_index.key_column == key_column and key_index.key_type == key_type:
+        # The index is only trusted while the table row count matches the indexed count
+        row_count = _count_rows(cursor, table_name, scope)
+        overfull = key_type != "int" and key_index.keys.count > key_index.keys.capacity
+        if row_count == key_index.row_count and not overfull:
+            return key_index
+
+    return build_key_index(cursor, table_name, key_column, key_type, scope)
+
+# Function to drop the persisted indexes of a table, scoped ones included (after a full reload or deletes)
+def invalidate_key_index(table_name):
+    index_dir = _get_key_index_dir()
+    for file_name in os.listdir(index_dir):
+        if file_name == f"{table_name}.idx" or (file_name.startswith(f"{table_name}@") and file_name.endswith(".idx")):
+            os.remove(os.path.join(index_dir, file_name))
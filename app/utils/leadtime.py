@@ -0,0 +1,167 @@
+import pandas as pd
+
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.snapshot import get_changed_keys, read_frame
+
+# Purchase lead time by order line: the PORDER line (ordered quantity and date) merged with its
+# PRECEIPT receipt lines on (dossier, numCommande, ligneCommande). Only the orders of new, changed
+# or removed order or receipt rows are recomputed.
+LEADTIME_TABLE = "PURCHASE_LEADTIME"
+
+LEADTIME_COLUMNS = ["dossier", "numCommande", "ligneCommande", "codeFournisseur", "codeArticle", "dateCommande",
+                    "quantiteCommandee", "quantiteRecue", "nbReceptions", "premiereReception", "derniereReception",
+                    "delaiPremiereReception", "delaiDerniereReception", "delaiMoyen", "soldee"]
+
+ORDER_LINE_KEY = ["dossier", "numCommande", "ligneCommande"]
+
+# Number of orders recomputed per statement (SQL Server accepts 2100 parameters)
+_REFRESH_CHUNK = 1000
+
+# Function to create the lead-time table if it does not exist, returns True if created
+def ensure_leadtime_table(cursor):
+    if cursor.tables(table=LEADTIME_TABLE, tableType="TABLE").fetchone():
+        return False
+    cursor.execute(f"""
+        CREATE TABLE {LEADTIME_TABLE} (
+            dossier VARCHAR(50),
+            numCommande VARCHAR(255),
+            ligneCommande INT,
+            codeFournisseur VARCHAR(255),
+            codeArticle VARCHAR(255),
+            dateCommande DATE,
+            quantiteCommandee FLOAT,
+            quantiteRecue FLOAT,
+            nbReceptions INT,
+            premiereReception DATE,
+            derniereReception DATE,
+            delaiPremiereReception INT,
+            delaiDerniereReception INT,
+            delaiMoyen FLOAT,
+            soldee BIT
+        )
+    """)
+    cursor.execute(f"CREATE CLUSTERED INDEX CIX_{LEADTIME_TABLE} ON {LEADTIME_TABLE} (numCommande, ligneCommande)")
+    cursor.execute(f"CREATE INDEX IX_{LEADTIME_TABLE}_codeFournisseur ON {LEADTIME_TABLE} (codeFournisseur, dateCommande)")
+    return True
+
+# Function to get the distinct order numbers of a list of values
+def _distinct_orders(values):
+    return sorted({str(value) for value in values if value is not None and not pd.isna(value)})
+
+# Function to get the orders whose rows differ between the source extract and the last applied target state
+def get_changed_orders(source_data, target_data):
+    return get_changed_keys(source_data, target_data, "numCommande", _distinct_orders)
+
+_ORDERS_QUERY = """
+    SELECT dossier, numCommande, ligneCommande, codeFournisseur, codeArticle, dateCommande, quantite
+    FROM PORDER WHERE numCommande IS NOT NULL{condition}
+    ORDER BY numCommande, ligneCommande
+"""
+_ORDERS_COLUMNS = ["dossier", "numCommande", "ligneCommande", "codeFournisseur", "codeArticle", "dateCommande", "quantite"]
+
+_RECEIPTS_QUERY = """
+    SELECT dossier, numCommande, ligneCommande, numReception, dateReception, quantite
+    FROM PRECEIPT WHERE numCommande IS NOT NULL{condition}
+    ORDER BY numCommande, ligneCommande
+"""
+_RECEIPTS_COLUMNS = ["dossier", "numCommande", "ligneCommande", "numReception", "dateReception", "quantite"]
+
+# Function to compute the lead-time rows of order lines from their order and receipt rows
+# (receipts of lines not in the orders are ignored)
+def compute_lead_times(orders, receipts):
+    if orders.empty:
+        return pd.DataFrame(columns=LEADTIME_COLUMNS)
+    orders = orders.assign(dateCommande=pd.to_datetime(orders["dateCommande"]),
+                           quantite=pd.to_numeric(orders["quantite"]).astype(float))
+    order_lines = orders.groupby(ORDER_LINE_KEY, as_index=False, dropna=False, sort=True).agg(
+        codeFournisseur=("codeFournisseur", "first"),
+        codeArticle=("codeArticle", "first"),
+        dateCommande=("dateCommande", "min"),
+        quantiteCommandee=("quantite", "sum"))
+
+    receipts = receipts.assign(dateReception=pd.to_datetime(receipts["dateReception"]),
+                               quantite=pd.to_numeric(receipts["quantite"]).astype(float))
+    receipts = receipts.merge(order_lines[ORDER_LINE_KEY + ["dateCommande"]], on=ORDER_LINE_KEY, how="inner")
+    receipts["delai"] = (receipts["dateReception"] - receipts["dateCommande"]).dt.days
+    receipts["quantiteDelai"] = receipts["quantite"] * receipts["delai"]
+    received = receipts.groupby(ORDER_LINE_KEY, as_index=False, dropna=False, sort=True).agg(
+        quantiteRecue=("quantite", "sum"),
+        nbReceptions=("numReception", "nunique"),
+        premiereReception=("dateReception", "min"),
+        derniereReception=("dateReception", "max"),
+        delaiPremiereReception=("delai", "min"),
+        delaiDerniereReception=("delai", "max"),
+        quantiteDelai=("quantiteDelai", "sum"))
+
+    lead_times = order_lines.merge(received, on=ORDER_LINE_KEY, how="left")
+    lead_times["quantiteRecue"] = lead_times["quantiteRecue"].fillna(0)
+    lead_times["nbReceptions"] = lead_times["nbReceptions"].fillna(0).astype(int)
+    # Lead time weighted by the received quantities, undefined until something was received
+    lead_times["delaiMoyen"] = (lead_times["quantiteDelai"] / lead_times["quantiteRecue"].where(lead_times["quantiteRecue"] > 0)).round(2)
+    lead_times["soldee"] = (lead_times["quantiteRecue"] >= lead_times["quantiteCommandee"]).astype(int)
+    for column in ["dateCommande", "premiereReception", "derniereReception"]:
+        lead_times[column] = lead_times[column].dt.date
+    for column in ["delaiPremiereReception", "delaiDerniereReception"]:
+        lead_times[column] = lead_times[column].astype("Int64")
+    lead_times = lead_times[LEADTIME_COLUMNS]
+    return lead_times.astype(object).where(lead_times.notna(), None)
+
+def _write_lead_times(cursor, lead_times):
+    if lead_times.empty:
+        return
+    placeholders = ", ".join("?" for _ in LEADTIME_COLUMNS)
+    cursor.executemany(f"INSERT INTO {LEADTIME_TABLE} ({', '.join(LEADTIME_COLUMNS)}) VALUES ({placeholders})",
+                       lead_times.values.tolist())
+
+# Function to recompute the lead times of the given orders (orders of new, changed or removed
+# order or receipt rows). Runs in the caller's transaction, so the lead times commit with the rows.
+def refresh_lead_time_orders(cursor, orders):
+    orders = _distinct_orders(orders)
+    if not orders:
+        return 0
+    ensure_leadtime_table(cursor)
+    rows_written = 0
+    for start in range(0, len(orders), _REFRESH_CHUNK):
+        chunk = orders[start:start + _REFRESH_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        condition = f" AND numCommande IN ({placeholders})"
+        order_rows = read_frame(cursor, _ORDERS_QUERY.format(condition=condition), _ORDERS_COLUMNS, chunk)
+        receipt_rows = read_frame(cursor, _RECEIPTS_QUERY.format(condition=condition), _RECEIPTS_COLUMNS, chunk)
+        lead_times = compute_lead_times(order_rows, receipt_rows)
+        cursor.execute(f"DELETE FROM {LEADTIME_TABLE} WHERE numCommande IN ({placeholders})", chunk)
+        _write_lead_times(cursor, lead_times)
+        rows_written += len(lead_times)
+    return rows_written
+
+# Function to recompute the whole lead-time table from PORDER and PRECEIPT, in the caller's transaction
+def rebuild_lead_times(cursor):
+    ensure_leadtime_table(cursor)
+    order_rows = read_frame(cursor, _ORDERS_QUERY.format(condition=""), _ORDERS_COLUMNS)
+    receipt_rows = read_frame(cursor, _RECEIPTS_QUERY.format(condition=""), _RECEIPTS_COLUMNS)
+    lead_times = compute_lead_times(order_rows, receipt_rows)
+    cursor.execute(f"TRUNCATE TABLE {LEADTIME_TABLE}")
+    _write_lead_times(cursor, lead_times)
+    return len(lead_times)
+
+# Function to recompute lead times in their own transaction: the given orders, or the whole table
+# when orders is None (after a load committed by company slices)
+def refresh_lead_times(orders=None):
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            if orders is None:
+                rows_written = rebuild_lead_times(cursor)
+            else:
+                rows_written = refresh_lead_time_orders(cursor, orders)
+            cnxn.commit()
+            print(f"{rows_written} {LEADTIME_TABLE} rows recomputed.")
+            return True
+        except Exception as e:
+            print(f"Error refreshing {LEADTIME_TABLE}: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
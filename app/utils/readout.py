@@ -0,0 +1,111 @@
+from datetime import date, timedelta
+
+from app.utils.config import get_sync_setting
+from app.utils.folders import get_folders
+
+# Function to read the filter, projection and page query parameters of a /sage/* readout.
+# spec describes the readout columns: "key" (keyset pagination column), "date" (date range column,
+# or "generated_dates" when the dates are generated by the extract itself),
+# "filters" (query parameter -> column compared for equality, comma separated values allowed),
+# "columns" (columns of the extract the columns parameter can select, no projection without it) and
+# "folders" (extract run on the Sage X3 folders, which adds the dossier parameter).
+# Raises ValueError on invalid parameters.
+def parse_readout_filters(request, spec):
+    query_params = request.query_params
+    readout = {"conditions": [], "params": [], "columns": None, "limit": None, "folders": None, "date_from": None, "date_to": None}
+
+    date_from = query_params.get("date_from")
+    date_to = query_params.get("date_to")
+    if date_from or date_to:
+        if spec.get("date") is None and not spec.get("generated_dates"):
+            raise ValueError("This endpoint does not support date filters.")
+        try:
+            readout["date_from"] = date.fromisoformat(date_from) if date_from else None
+            readout["date_to"] = date.fromisoformat(date_to) if date_to else None
+        except ValueError:
+            raise ValueError("date_from and date_to must be dates in YYYY-MM-DD format.")
+        if spec.get("date") is not None:
+            if readout["date_from"]:
+                readout["conditions"].append(f"readout.[{spec['date']}] >= ?")
+                readout["params"].append(readout["date_from"])
+            if readout["date_to"]:
+                # date_to is inclusive
+                readout["conditions"].append(f"readout.[{spec['date']}] < ?")
+                readout["params"].append(readout["date_to"] + timedelta(days=1))
+
+    for param_name, column in spec.get("filters", {}).items():
+        value = query_params.get(param_name)
+        if value:
+            values = [item.strip() for item in value.split(",") if item.strip()]
+            readout["conditions"].append(f"readout.[{column}] IN ({', '.join('?' for _ in values)})")
+            readout["params"].extend(values)
+
+    columns = query_params.get("columns")
+    if columns:
+        if not spec.get("columns"):
+            raise ValueError("This endpoint does not support column selection.")
+        # Requested names are matched without case and replaced by the extract's own names
+        known_columns = {column.lower(): column for column in spec["columns"]}
+        requested = [column.strip() for column in columns.split(",") if column.strip()]
+        unknown = [column for column in requested if column.lower() not in known_columns]
+        if unknown:
+            raise ValueError(f"Unknown columns {', '.join(unknown)}, expected some of {', '.join(spec['columns'])}.")
+        readout["columns"] = [known_columns[column.lower()] for column in requested]
+        # The pagination key is always returned so that the next page can be requested
+        if spec.get("key") and spec["key"].lower() not in [column.lower() for column in readout["columns"]]:
+            readout["columns"].insert(0, spec["key"])
+
+    after_rowid = query_params.get("after_rowid")
+    limit = query_params.get("limit")
+    if after_rowid or limit:
+        if spec.get("key") is None:
+            raise ValueError("This endpoint does not support pagination.")
+        try:
+            if after_rowid:
+                readout["conditions"].append(f"readout.[{spec['key']}] > ?")
+                readout["params"].append(int(after_rowid))
+            if limit:
+                readout["limit"] = int(limit)
+        except ValueError:
+            raise ValueError("after_rowid and limit must be integers.")
+        max_limit = get_sync_setting("readout", "max_limit", 100000)
+        if readout["limit"] is not None and not 0 < readout["limit"] <= max_limit:
+            raise ValueError(f"limit must be between 1 and {max_limit}.")
+
+    if spec.get("folders"):
+        dossier = query_params.get("dossier")
+        folders = get_folders()
+        if dossier:
+            readout["folders"] = [folder for folder in folders if folder["name"] == dossier]
+            if not readout["folders"]:
+                raise ValueError(f"Unknown dossier {dossier}.")
+        elif readout["limit"] is not None and len(folders) > 1:
+            # ROWIDs are only unique within a folder
+            raise ValueError("dossier is required to paginate over several folders.")
+    return readout
+
+# Function to wrap a source query so that the readout filters, projection and page are evaluated by
+# SQL Server (the predicates on the derived table are pushed down to the Sage X3 tables).
+# Returns the query and its bind parameters (the source query is kept as is without readout parameters).
+def apply_readout_filters(source_query, spec, readout, params=None):
+    if not readout["conditions"] and readout["columns"] is None and readout["limit"] is None:
+        return source_query, params
+    projection = ", ".join(f"readout.[{column}]" for column in readout["columns"]) if readout["columns"] else "readout.*"
+    top = "TOP (?) " if readout["limit"] is not None else ""
+    query = f"SELECT {top}{projection} FROM ({source_query}) AS readout"
+    # Bind parameters in the order of their markers: TOP, source query, readout conditions
+    bind_params = [readout["limit"]] if readout["limit"] is not None else []
+    bind_params.extend(params or [])
+    if readout["conditions"]:
+        query += " WHERE " + " AND ".join(readout["conditions"])
+    bind_params.extend(readout["params"])
+    if readout["limit"] is not None:
+        query += f" ORDER BY readout.[{spec['key']}]"
+    return query, bind_params or None
+
+# Function to get the header giving the cursor of the next page when a page is full
+def get_next_page_headers(data, spec, readout):
+    if readout is None or readout["limit"] is None or len(data) < readout["limit"]:
+        return {}
+    key = next(column for column in data.columns if column.lower() == spec["key"].lower())
+    return {"X-Next-After-Rowid": str(int(data[key].iloc[-1]))}
@@ -0,0 +1,100 @@
+from app.utils.config import get_sync_setting
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.keyindex import invalidate_key_index
+from app.utils.retry import run_batch_with_retry
+
+# Function to compute, per ROWID range, the number of keys and an aggregated checksum of the keys
+def fetch_range_digests(cursor, from_clause, key_column, range_size, condition="", params=()):
+    cursor.execute(f"""
+        SELECT CAST({key_column} AS BIGINT) / {range_size} AS bucket,
+               COUNT(DISTINCT {key_column}),
+               CHECKSUM_AGG(DISTINCT CHECKSUM(CAST({key_column} AS BIGINT)))
+        FROM {from_clause}
+        WHERE {key_column} IS NOT NULL{condition}
+        GROUP BY CAST({key_column} AS BIGINT) / {range_size}
+    """, params)
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+# Function to fetch the distinct keys of one ROWID range
+def fetch_range_keys(cursor, from_clause, key_column, bucket, range_size, condition="", params=()):
+    cursor.execute(f"""
+        SELECT DISTINCT CAST({key_column} AS BIGINT)
+        FROM {from_clause}
+        WHERE {key_column} >= ? AND {key_column} < ?{condition}
+    """, (bucket * range_size, (bucket + 1) * range_size) + tuple(params))
+    return {row[0] for row in cursor.fetchall()}
+
+# Function to delete from a warehouse table the rows whose key no longer exists in Sage X3.
+# Only the ROWID ranges whose digests differ between source and target are fetched.
+# target_scope (column, value) restricts the target to the rows extracted from source_from.
+# before_commit(cursor, values) runs in each delete transaction with the output_column values
+# of the deleted rows (used to adjust the summaries of the table).
+def propagate_deletes(source_from, source_key, target_table, target_key, target_scope=None, output_column=None, before_commit=None):
+    range_size = get_sync_setting("reconcile", "range_size", 10000)
+    batch_size = get_sync_setting("reconcile", "delete_batch_size", 1000)
+
+    source_cnxn = get_connection(load_sage_x3_db_config(), read_only=True)
+    target_db = load_madin_warehouse_db_config()
+    target_cnxn = get_connection(target_db)
+    if not source_cnxn or not target_cnxn:
+        print("Failed to connect to the source or target database.")
+        if source_cnxn:
+            source_cnxn.close()
+        if target_cnxn:
+            target_cnxn.close()
+        return None
+
+    try:
+        source_cursor = source_cnxn.cursor()
+        target_cursor = target_cnxn.cursor()
+
+        target_condition, target_params = "", ()
+        if target_scope is not None:
+            target_condition, target_params = f" AND [{target_scope[0]}] = ?", (target_scope[1],)
+
+        source_digests = fetch_range_digests(source_cursor, source_from, source_key, range_size)
+        target_digests = fetch_range_digests(target_cursor, f"[{target_table}]", f"[{target_key}]", range_size, target_condition, target_params)
+        changed_buckets = [bucket for bucket, digest in target_digests.items() if source_digests.get(bucket) != digest]
+
+        deleted_keys = []
+        for bucket in changed_buckets:
+            target_keys = fetch_range_keys(target_cursor, f"[{target_table}]", f"[{target_key}]", bucket, range_size, target_condition, target_params)
+            if bucket in source_digests:
+                source_keys = fetch_range_keys(source_cursor, source_from, source_key, bucket, range_size)
+            else:
+                source_keys = set()
+            deleted_keys.extend(sorted(target_keys - source_keys))
+
+        deleted_counts = []
+        for start in range(0, len(deleted_keys), batch_size):
+            batch = deleted_keys[start:start + batch_size]
+
+            def delete_batch(batch_cnxn, batch=batch):
+                batch_cursor = batch_cnxn.cursor()
+                placeholders = ", ".join("?" for _ in batch)
+                if output_column is None:
+                    batch_cursor.execute(f"DELETE FROM [{target_table}] WHERE [{target_key}] IN ({placeholders}){target_condition}", batch + list(target_params))
+                    batch_count = batch_cursor.rowcount
+                else:
+                    batch_cursor.execute(f"DELETE FROM [{target_table}] OUTPUT DELETED.[{output_column}] WHERE [{target_key}] IN ({placeholders}){target_condition}", batch + list(target_params))
+                    deleted_values = [row[0] for row in batch_cursor.fetchall()]
+                    batch_count = len(deleted_values)
+                    if before_commit is not None:
+                        before_commit(batch_cursor, deleted_values)
+                batch_cnxn.commit()
+                deleted_counts.append(batch_count)
+
+            # Deletes are idempotent, a failed batch is replayed on a new connection
+            target_cnxn = run_batch_with_retry(target_cnxn, target_db, delete_batch, f"{target_table} deletes")
+        rows_deleted = sum(deleted_counts)
+
+        if rows_deleted > 0:
+            invalidate_key_index(target_table)
+        print(f"{len(changed_buckets)} of {len(target_digests)} ranges differ, {rows_deleted} rows deleted from {target_table}.")
+        return rows_deleted
+    except Exception as e:
+        print(f"Error propagating deletes to {target_table}: {e}")
+        return None
+    finally:
+        source_cnxn.close()
+        target_cnxn.close()
@@ -0,0 +1,117 @@
+import re
+import time
+import random
+import threading
+import pyodbc
+import pandas as pd
+
+from app.utils.config import get_sync_setting
+from app.utils.db import get_connection
+
+# SQL Server native error codes worth retrying: deadlock victim, lock request timeout,
+# resource/availability errors and dropped or refused connections
+RETRYABLE_ERROR_CODES = {1205, 1222, -2, 233, 64, 121, 10053, 10054, 10060, 10928, 10929, 40197, 40501, 40613, 49918, 49919, 49920}
+
+# ODBC SQLSTATEs of transient failures: link failure, connection errors, timeouts, serialization failure
+RETRYABLE_SQLSTATES = {"08S01", "08001", "08004", "HYT00", "HYT01", "40001"}
+
+_retry_counts = {}
+_retry_counts_lock = threading.Lock()
+
+# Function to classify a database error as transient (retryable) or fatal
+def is_retryable_error(error):
+    # SQLAlchemy wraps the pyodbc error of the failed statement
+    error = getattr(error, "orig", error)
+    if not isinstance(error, pyodbc.Error) or not error.args:
+        return False
+    if str(error.args[0]) in RETRYABLE_SQLSTATES:
+        return True
+    message = str(error.args[1]) if len(error.args) > 1 else str(error)
+    for code in re.findall(r"\((-?\d+)\)", message):
+        if int(code) in RETRYABLE_ERROR_CODES:
+            return True
+    return False
+
+# Function to compute the delay before the next attempt (exponential backoff with full jitter)
+def get_backoff_delay(attempt):
+    base_delay = get_sync_setting("retry", "base_delay_seconds", 1)
+    max_delay = get_sync_setting("retry", "max_delay_seconds", 30)
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+def _count_retry(operation_name):
+    with _retry_counts_lock:
+        _retry_counts[operation_name] = _retry_counts.get(operation_name, 0) + 1
+
+# Function to get the number of retries done per operation since the application started
+def get_retry_counts():
+    with _retry_counts_lock:
+        return dict(_retry_counts)
+
+# Function to run an operation, replaying it after a transient error (exponential backoff with jitter).
+# The operation must undo its partial work itself when it fails, e.g. by rolling back its transaction.
+def run_with_retry(operation, operation_name):
+    max_attempts = get_sync_setting("retry", "max_attempts", 5)
+    attempt = 0
+    while True:
+        try:
+            return operation()
+        except Exception as e:
+            attempt += 1
+            if not is_retryable_error(e) or attempt >= max_attempts:
+                raise
+            delay = get_backoff_delay(attempt)
+            print(f"Transient error on {operation_name} (attempt {attempt}/{max_attempts}), retrying in {delay:.1f}s: {e}")
+            _count_retry(operation_name)
+            time.sleep(delay)
+
+# Function to run one batch on a connection, replaying only that batch after a transient error.
+# The batch must commit its own work; before a retry the connection is rolled back and a new
+# one is opened (the dropped one is released when garbage collected). Returns the connection
+# to use for the next batches.
+def run_batch_with_retry(cnxn, db_config, batch_operation, operation_name, read_only=False):
+    state = {"cnxn": cnxn}
+
+    def run_batch():
+        if state["cnxn"] is None:
+            state["cnxn"] = get_connection(db_config, read_only=read_only)
+            if state["cnxn"] is None:
+                raise pyodbc.OperationalError("08001", "Failed to connect to the database.")
+        try:
+            batch_operation(state["cnxn"])
+        except Exception:
+            try:
+                state["cnxn"].rollback()
+            except Exception:
+                pass
+            state["cnxn"] = None
+            raise
+
+    run_with_retry(run_batch, operation_name)
+    return state["cnxn"]
+
+# Function to run one write transaction on a connection, replayed as a whole after a transient error.
+# transaction(cursor) does the writes and returns its result, the commit is done here once it succeeded.
+# Returns the connection to use afterwards and the result of the transaction.
+def run_transaction_with_retry(cnxn, db_config, transaction, operation_name):
+    result = {}
+
+    def run_transaction(transaction_cnxn):
+        result["value"] = transaction(transaction_cnxn.cursor())
+        transaction_cnxn.commit()
+
+    cnxn = run_batch_with_retry(cnxn, db_config, run_transaction, operation_name)
+    return cnxn, result["value"]
+
+# Function to run an extraction query, reconnecting and replaying it after a transient error.
+# read_only sends the query to the read replica of the database when one is configured.
+def read_sql_with_retry(query, db_config, operation_name, params=None, read_only=False):
+    result = {}
+
+    def read_query(cnxn):
+        try:
+            result["data"] = pd.read_sql(query, cnxn, params=params)
+        finally:
+            cnxn.close()
+
+    run_batch_with_retry(None, db_config, read_query, operation_name, read_only=read_only)
+    return result["data"]
@@ -0,0 +1,283 @@
+import re
+import bisect
+import heapq
+import threading
+import unicodedata
+from collections import Counter
+
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+
+# Entities searchable by code and name, from their warehouse dimension table
+SEARCH_ENTITIES = {
+    "customers": {"table": "BPCUSTOMER", "code": "BPCNUM_0", "name": "BPCNAM_0"},
+    "fournisseurs": {"table": "BPSUPPLIER", "code": "BPSNUM_0", "name": "BPSNAM_0"},
+    "itmmaster": {"table": "ITMMASTER", "code": "ITMREF_0", "name": "ITMDES_0"},
+}
+
+# Other names accepted in the search URLs
+SEARCH_ENTITY_ALIASES = {"suppliers": "fournisseurs", "items": "itmmaster"}
+
+# Number of trigram postings read at most by a fuzzy search (keeps typeahead latency bounded)
+FUZZY_MAX_POSTINGS = 20000
+
+_NON_ALPHANUMERIC = re.compile(r"[^0-9a-z]+")
+
+# Function to normalize a text for matching: accents removed, case folded, punctuation as spaces
+def normalize_text(text):
+    if text is None:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(character for character in text if not unicodedata.combining(character))
+    return _NON_ALPHANUMERIC.sub(" ", text.casefold()).strip()
+
+# Function to get the trigrams of the words of a normalized text. Words are padded with a leading
+# space so that word starts weigh more; document words also get a trailing space, query words
+# do not (the last query word is usually being typed).
+def get_trigrams(text, query=False):
+    trigrams = set()
+    for word in text.split():
+        padded = f" {word}" if query else f" {word} "
+        trigrams.update(padded[position:position + 3] for position in range(max(len(padded) - 2, 1)))
+    return trigrams
+
+
+# In-memory search index of one entity. Words and codes are kept in sorted lists with their
+# postings, so that a typed prefix is a bisect range; trigram postings give the fuzzy matches
+# (typos) when the prefixes do not find enough results. Updated in place as rows are synchronized.
+class SearchIndex:
+    def __init__(self, entity):
+        self.entity = entity
+        self.lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self.names = {}
+        self.texts = {}
+        self.sort_keys = {}
+        self.word_codes = {}
+        self.first_word_codes = {}
+        self.code_codes = {}
+        self.trigram_codes = {}
+        self.sorted_words = []
+        self.sorted_first_words = []
+        self.sorted_codes = []
+
+    @staticmethod
+    def _add_posting(postings, sorted_keys, key, code, keep_sorted):
+        codes = postings.get(key)
+        if codes is None:
+            codes = postings[key] = set()
+            if keep_sorted:
+                bisect.insort(sorted_keys, key)
+        codes.add(code)
+
+    @staticmethod
+    def _remove_posting(postings, sorted_keys, key, code):
+        codes = postings.get(key)
+        if codes is None:
+            return
+        codes.discard(code)
+        if not codes:
+            del postings[key]
+            if sorted_keys is not None:
+                position = bisect.bisect_left(sorted_keys, key)
+                if position < len(sorted_keys) and sorted_keys[position] == key:
+                    del sorted_keys[position]
+
+    def _add(self, code, name, keep_sorted=True):
+        text = normalize_text(name)
+        normalized_code = normalize_text(code).replace(" ", "")
+        self.names[code] = name
+        self.texts[code] = (normalized_code, text)
+        self.sort_keys[code] = (len(text), text, code)
+        words = text.split()
+        for word in set(words):
+            self._add_posting(self.word_codes, self.sorted_words, word, code, keep_sorted)
+        if words:
+            self._add_posting(self.first_word_codes, self.sorted_first_words, words[0], code, keep_sorted)
+        self._add_posting(self.code_codes, self.sorted_codes, normalized_code, code, keep_sorted)
+        for trigram in get_trigrams(f"{normalized_code} {text}"):
+            self._add_posting(self.trigram_codes, None, trigram, code, False)
+
+    def _remove(self, code):
+        entry = self.texts.pop(code, None)
+        self.names.pop(code, None)
+        self.sort_keys.pop(code, None)
+        if entry is None:
+            return
+        normalized_code, text = entry
+        words = text.split()
+        for word in set(words):
+            self._remove_posting(self.word_codes, self.sorted_words, word, code)
+        if words:
+            self._remove_posting(self.first_word_codes, self.sorted_first_words, words[0], code)
+        self._remove_posting(self.code_codes, self.sorted_codes, normalized_code, code)
+        for trigram in get_trigrams(f"{normalized_code} {text}"):
+            self._remove_posting(self.trigram_codes, None, trigram, code)
+
+    # Function to add or replace the documents of (code, name) pairs
+    def upsert(self, rows):
+        with self.lock:
+            for code, name in rows:
+                if code is None:
+                    continue
+                code = str(code)
+                if code in self.names and self.names[code] == name:
+                    continue
+                self._remove(code)
+                self._add(code, name)
+
+    # Function to remove the documents of a list of codes
+    def remove(self, codes):
+        with self.lock:
+            for code in codes:
+                self._remove(str(code))
+
+    # Function to replace the whole content of the index (sorted lists built once at the end)
+    def load(self, rows):
+        with self.lock:
+            self._clear()
+            for code, name in rows:
+                if code is not None:
+                    self._add(str(code), name, keep_sorted=False)
+            self.sorted_words = sorted(self.word_codes)
+            self.sorted_first_words = sorted(self.first_word_codes)
+            self.sorted_codes = sorted(self.code_codes)
+
+    @staticmethod
+    def _prefix_codes(postings, sorted_keys, prefix):
+        start = bisect.bisect_left(sorted_keys, prefix)
+        end = bisect.bisect_left(sorted_keys, prefix + "\uffff")
+        return set().union(*[postings[key] for key in sorted_keys[start:end]])
+
+    # Function to get the documents whose words start with every word of the query
+    def _prefix_matches(self, query_words):
+        matches = None
+        for query_word in sorted(query_words, key=len, reverse=True):
+            codes = self._prefix_codes(self.word_codes, self.sorted_words, query_word)
+            matches = codes if matches is None else matches & codes
+            if not matches:
+                return set()
+        return matches
+
+    # Function to get the documents sharing query trigrams, with the share of the query trigrams they contain.
+    # The rarest trigrams are counted first, and counting stops once enough postings were read.
+    def _fuzzy_matches(self, query, exclude):
+        query_trigrams = get_trigrams(query, query=True)
+        known_trigrams = sorted((trigram for trigram in query_trigrams if trigram in self.trigram_codes),
+                                key=lambda trigram: len(self.trigram_codes[trigram]))
+        counts = Counter()
+        counted = 0
+        postings_read = 0
+        for trigram in known_trigrams:
+            if counted >= 2 and postings_read + len(self.trigram_codes[trigram]) > FUZZY_MAX_POSTINGS:
+                break
+            counts.update(self.trigram_codes[trigram])
+            postings_read += len(self.trigram_codes[trigram])
+            counted += 1
+        minimum = max(1, counted // 2)
+        return {code: count / len(query_trigrams) for code, count in counts.items() if count >= minimum and code not in exclude}
+
+    # Function to get the best matches of a query, as dicts (code, name, score) ranked by: exact code,
+    # code prefix, name starting with the query, every query word as a word prefix, fuzzy matches;
+    # shorter names first within a rank
+    def search(self, query, limit=20):
+        query = normalize_text(query)
+        if not query:
+            return []
+        query_words = query.split()
+        with self.lock:
+            results = []
+            seen = set()
+
+            def take(codes, score):
+                codes = [code for code in codes if code not in seen]
+                for code in heapq.nsmallest(limit - len(results), codes, key=self.sort_keys.__getitem__):
+                    seen.add(code)
+                    results.append({"code": code, "name": self.names[code], "score": score})
+
+            compact_query = query.replace(" ", "")
+            take(self.code_codes.get(compact_query, ()), 4.0)
+            if len(results) < limit:
+                take(self._prefix_codes(self.code_codes, self.sorted_codes, compact_query), 3.0)
+            if len(results) < limit:
+                matches = self._prefix_matches(query_words)
+                if matches:
+                    starts = matches & self._prefix_codes(self.first_word_codes, self.sorted_first_words, query_words[0])
+                    take(starts, 2.0)
+                    if len(results) < limit:
+                        take(matches, 1.0)
+            if len(results) < limit and len(query) >= 3:
+                fuzzy = self._fuzzy_matches(query, seen)
+                best = heapq.nlargest(limit - len(results), fuzzy.items(), key=lambda item: (item[1], -len(self.texts[item[0]][1])))
+                for code, share in best:
+                    results.append({"code": code, "name": self.names[code], "score": round(share, 3)})
+            return results
+
+    def __len__(self):
+        return len(self.names)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+# Function to get the canonical entity name of a search URL, None if the entity is not searchable
+def resolve_search_entity(entity):
+    entity = entity.lower()
+    entity = SEARCH_ENTITY_ALIASES.get(entity, entity)
+    return entity if entity in SEARCH_ENTITIES else None
+
+# Function to read the (code, name) pairs of an entity from its warehouse table
+def retrieve_search_rows(entity):
+    design = SEARCH_ENTITIES[entity]
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if not cnxn:
+        raise RuntimeError("Failed to connect to the target database.")
+    try:
+        cursor = cnxn.cursor()
+        cursor.execute(f"SELECT [{design['code']}], [{design['name']}] FROM [{design['table']}]")
+        return [(row[0], row[1]) for row in cursor.fetchall()]
+    finally:
+        cnxn.close()
+
+# Function to get the search index of an entity, built from the warehouse table on first use
+def get_search_index(entity):
+    with _indexes_lock:
+        index = _indexes.get(entity)
+        if index is None:
+            index = SearchIndex(entity)
+            index.load(retrieve_search_rows(entity))
+            _indexes[entity] = index
+            print(f"Search index of {entity} built: {len(index)} entries.")
+        return index
+
+# Function to rebuild the search index of an entity from the warehouse table
+def rebuild_search_index(entity):
+    index = SearchIndex(entity)
+    index.load(retrieve_search_rows(entity))
+    with _indexes_lock:
+        _indexes[entity] = index
+    return len(index)
+
+# Function to apply inserted/changed (code, name) rows and removed codes to a built index
+# (an index not built yet is built from the table on its first search)
+def update_search_index(entity, rows=None, removed=None):
+    index = _indexes.get(entity)
+    if index is None:
+        return
+    if removed:
+        index.remove(removed)
+    if rows:
+        index.upsert(rows)
+
+# Function to align a built index on the synchronized content of its table (DataFrame of the rows)
+def sync_search_index(entity, data):
+    index = _indexes.get(entity)
+    if index is None:
+        return
+    design = SEARCH_ENTITIES[entity]
+    rows = list(zip(data[design["code"]].tolist(), data[design["name"]].tolist()))
+    codes = {str(code) for code, _ in rows if code is not None}
+    with index.lock:
+        index.remove([code for code in index.names if code not in codes])
+        index.upsert(rows)
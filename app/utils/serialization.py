@@ -0,0 +1,116 @@
+import json
+import time
+import zlib
+from decimal import Decimal
+import numpy as np
+import orjson
+import pandas as pd
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+
+from app.utils.config import get_sync_setting
+
+# zstandard is optional: without it responses are only gzip compressed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def _default(value):
+    # Types orjson does not serialize natively
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if value is pd.NaT:
+        return None
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+# Function to convert the datetime columns of a batch to ISO strings in one vectorized pass
+# (same text as the isoformat() used by the default encoder, NaT as null)
+def _prepare_batch(batch):
+    datetime_columns = [column for column, dtype in batch.dtypes.items() if pd.api.types.is_datetime64_any_dtype(dtype)]
+    if not datetime_columns:
+        return batch
+    batch = batch.copy()
+    for column in datetime_columns:
+        values = batch[column].values
+        if getattr(batch[column].dt, "tz", None) is not None:
+            # Timezone-aware columns keep the per-value isoformat with their offset
+            batch[column] = batch[column].map(lambda value: None if value is pd.NaT else value.isoformat())
+            continue
+        with_microseconds = (batch[column].dt.microsecond.fillna(0) != 0).any()
+        text = np.datetime_as_string(values, unit="us" if with_microseconds else "s").astype(object)
+        text[pd.isna(values)] = None
+        batch[column] = text
+    return batch
+
+# Function to encode a batch of rows as the JSON array items (without brackets)
+def encode_batch(batch):
+    batch = _prepare_batch(batch)
+    columns = [str(column) for column in batch.columns]
+    # Column-wise tolist() converts to Python values much faster than to_dict(orient="records")
+    values = [batch[column].tolist() for column in batch.columns]
+    records = [dict(zip(columns, row)) for row in zip(*values)]
+    return orjson.dumps(records, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)[1:-1]
+
+# Function to encode a DataFrame as a JSON array of records, batch by batch
+def iter_json_batches(data, batch_rows):
+    yield b"["
+    for start in range(0, len(data), batch_rows):
+        if start > 0:
+            yield b","
+        yield encode_batch(data.iloc[start:start + batch_rows])
+    yield b"]"
+
+# Function to build the JSON response of a DataFrame: one orjson body for small frames, streamed
+# by batches otherwise so the whole document is never held twice in memory
+def dataframe_response(data, headers=None):
+    batch_rows = get_sync_setting("serialization", "batch_rows", 50000)
+    if len(data) <= batch_rows:
+        return Response(content=b"".join(iter_json_batches(data, batch_rows)), media_type="application/json", headers=headers)
+    return StreamingResponse(iter_json_batches(data, batch_rows), media_type="application/json", headers=headers)
+
+# Function to compare the default serialization path with the orjson batches and the compressed sizes,
+# for a synthetic fact extract; results are given per million rows
+def benchmark_serialization(rows=1000000):
+    generator = np.random.default_rng(0)
+    data = pd.DataFrame({
+        "rowID": np.arange(rows),
+        "societe": generator.choice(["S01", "S02", "S03"], rows),
+        "numFacture": [f"FAC{index:09d}" for index in range(rows)],
+        "ligneFacture": generator.integers(1, 50, rows),
+        "codeClient": generator.choice([f"C{index:05d}" for index in range(2000)], rows),
+        "dateFacture": pd.Timestamp("2013-01-01") + pd.to_timedelta(generator.integers(0, 4000, rows), unit="D"),
+        "codeArticle": generator.choice([f"ART{index:06d}" for index in range(5000)], rows),
+        "quantite": generator.integers(1, 1000, rows),
+        "montantHT": generator.random(rows) * 10000,
+        "montantTTC": generator.random(rows) * 12000,
+        "representant": generator.choice(["R01", "R02", None], rows),
+        "dossier": "SEED",
+    })
+    scale = 1000000 / rows
+    results = {}
+
+    start = time.perf_counter()
+    body = json.dumps(jsonable_encoder(data.to_dict(orient="records"))).encode("utf-8")
+    results["default_json"] = {"ms": round((time.perf_counter() - start) * 1000 * scale), "bytes": round(len(body) * scale)}
+
+    start = time.perf_counter()
+    body = b"".join(iter_json_batches(data, get_sync_setting("serialization", "batch_rows", 50000)))
+    results["orjson_batches"] = {"ms": round((time.perf_counter() - start) * 1000 * scale), "bytes": round(len(body) * scale)}
+
+    start = time.perf_counter()
+    compressed = zlib.compress(body, get_sync_setting("compression", "gzip_level", 6))
+    results["gzip"] = {"ms": round((time.perf_counter() - start) * 1000 * scale), "bytes": round(len(compressed) * scale)}
+
+    if zstandard is not None:
+        start = time.perf_counter()
+        compressed = zstandard.ZstdCompressor(level=get_sync_setting("compression", "zstd_level", 3)).compress(body)
+        results["zstd"] = {"ms": round((time.perf_counter() - start) * 1000 * scale), "bytes": round(len(compressed) * scale)}
+    return results
+
+
+if __name__ == "__main__":
+    for name, result in benchmark_serialization().items():
+        print(f"{name}: {result['ms']} ms, {result['bytes']} bytes per million rows")
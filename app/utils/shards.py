@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from app.utils.config import get_sync_setting
+from app.utils.db import get_connection, load_madin_warehouse_db_config, load_sage_x3_db_config
+from app.utils.bulkload import PyodbcRowWriter
+from app.utils.folders import run_folder_extraction
+from app.utils.keyindex import invalidate_key_index
+from app.utils.ddl import ensure_company_index
+from app.utils.retry import run_batch_with_retry
+from app.utils.snapshot import invalidate_snapshot
+from app.utils.summary import get_company_days, refresh_summary_days
+from app.utils.dimkeys import DIMENSION_KEY_DESIGNS, load_dimension_keys, add_dimension_keys, get_dimension_key_columns
+
+# Function to create the SYNC_WATERMARK table in Madin Warehouse if it does not exist
+def ensure_watermark_table(cursor):
+    cursor.execute("""
+        IF OBJECT_ID('SYNC_WATERMARK', 'U') IS NULL
+            CREATE TABLE SYNC_WATERMARK (
+                table_name VARCHAR(128),
+                shard NVARCHAR(128),
+                watermark VARCHAR(64),
+                rows_loaded INT,
+                updated_at DATETIME,
+                PRIMARY KEY (table_name, shard)
+            )
+    """)
+
+# Function to get the watermark (checksum of the last loaded slice) of every shard of a table
+def load_watermarks(cursor, table_name):
+    ensure_watermark_table(cursor)
+    cursor.execute("SELECT shard, watermark FROM SYNC_WATERMARK WHERE table_name = ?", (table_name,))
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+# Function to record the watermark of a shard, in the transaction that loads the shard
+def save_watermark(cursor, table_name, shard, watermark, rows_loaded):
+    cursor.execute("""
+        MERGE INTO SYNC_WATERMARK AS target
+        USING (VALUES (?, ?)) AS source (table_name, shard)
+        ON target.table_name = source.table_name AND target.shard = source.shard
+        WHEN MATCHED THEN
+            UPDATE SET watermark = ?, rows_loaded = ?, updated_at = GETDATE()
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (table_name, shard, watermark, rows_loaded, updated_at)
+            VALUES (source.table_name, source.shard, ?, ?, GETDATE());
+    """, (table_name, shard, watermark, rows_loaded, watermark, rows_loaded))
+
+# Function to forget the watermarks of every shard of a table, so that its next sharded sync reloads all companies
+def clear_watermarks(cursor, table_name):
+    ensure_watermark_table(cursor)
+    cursor.execute("DELETE FROM SYNC_WATERMARK WHERE table_name = ?", (table_name,))
+
+# Function to compute the watermark of a company slice: row count and sum of the row hashes,
+# so that it does not depend on the order the rows were extracted in
+def compute_slice_watermark(data):
+    if len(data) == 0:
+        return "0:0"
+    row_hashes = pd.util.hash_pandas_object(data, index=False).values
+    return f"{len(data)}:{int(row_hashes.sum(dtype='uint64'))}"
+
+# Rows deleted per statement when a company slice is replaced: below the 5000 locks at which SQL Server
+# escalates a statement to a table lock, which would block the slices of the other companies
+_DELETE_CHUNK = 4000
+
+# Function to delete the rows of one company of a table by chunks (seeks on the company index)
+def delete_company_rows(cursor, table_name, company_column, company):
+    while True:
+        cursor.execute(f"DELETE TOP ({_DELETE_CHUNK}) FROM [{table_name}] WHERE [{company_column}] = ?", (company,))
+        if cursor.rowcount < _DELETE_CHUNK:
+            return
+
+# Function to check if the sync of a table is sharded by company in the settings
+def company_sharding_enabled(table_name):
+    return table_name in get_sync_setting("sharding", "by_company", [])
+
+# Function to get the legal companies of all the synchronized Sage X3 folders
+def retrieve_companies():
+    data = run_folder_extraction(load_sage_x3_db_config(), "SELECT CPY_0 FROM [x3v12src].[SEED].[COMPANY]", "COMPANY list")
+    return sorted(set(data["CPY_0"]))
+
+# Function to synchronize a table company by company: each company slice is extracted, compared with
+# the watermark of the slice last loaded, and reloaded on its own when it changed. Companies run in
+# parallel, so a posting burst in one company does not reload the others.
+def synchronize_by_company(table_name, columns, company_column, retrieve_company_data):
+    madin_warehouse_db = load_madin_warehouse_db_config()
+    cnxn = get_connection(madin_warehouse_db)
+    if not cnxn:
+        print("Failed to connect to the target database.")
+        return False
+    try:
+        cursor = cnxn.cursor()
+        # The slices delete and read their rows through the index led by the company column
+        ensure_company_index(cursor, table_name, company_column)
+        watermarks = load_watermarks(cursor, table_name)
+        cursor.execute(f"SELECT DISTINCT [{company_column}] FROM [{table_name}]")
+        target_companies = {row[0] for row in cursor.fetchall() if row[0] is not None}
+        cnxn.commit()
+        companies = retrieve_companies()
+
+        # Drop the slices of the companies that no longer exist in Sage X3
+        for company in sorted(target_companies - set(companies), key=str):
+            touched_days = get_company_days(cursor, table_name, company_column, company)
+            delete_company_rows(cursor, table_name, company_column, company)
+            refresh_summary_days(cursor, table_name, touched_days, scope=(company_column, company))
+            cursor.execute("DELETE FROM SYNC_WATERMARK WHERE table_name = ? AND shard = ?", (table_name, company))
+            cnxn.commit()
+            print(f"{table_name}: rows of removed company {company} deleted.")
+    except Exception as e:
+        print(f"Error preparing the sharded sync of {table_name}: {e}")
+        return False
+    finally:
+        cnxn.close()
+
+    # Facts with date and dimension keys get them appended to each slice, from maps loaded once for all slices
+    dimension_keys = load_dimension_keys() if table_name in DIMENSION_KEY_DESIGNS else None
+    if dimension_keys is not None:
+        writer = PyodbcRowWriter(table_name, columns + get_dimension_key_columns(table_name))
+    else:
+        writer = PyodbcRowWriter(table_name, columns)
+
+    def synchronize_company(company):
+        try:
+            return _synchronize_company(company)
+        except Exception as e:
+            print(f"Error synchronizing company {company} of {table_name}: {e}")
+            return None
+
+    def _synchronize_company(company):
+        source_data = retrieve_company_data(company)
+        if source_data is None:
+            return None
+        watermark = compute_slice_watermark(source_data)
+        if watermarks.get(company) == watermark:
+            return 0
+        if dimension_keys is not None:
+            source_data = add_dimension_keys(source_data, table_name, dimension_keys)
+        rows = source_data.values.tolist()
+
+        def load_slice(slice_cnxn):
+            slice_cursor = slice_cnxn.cursor()
+            # Days of the rows replaced and loaded, their summaries are recomputed with the slice
+            # (only the summary rows of the company, so parallel slices do not overlap)
+            touched_days = get_company_days(slice_cursor, table_name, company_column, company)
+            delete_company_rows(slice_cursor, table_name, company_column, company)
+            if rows:
+                writer.write(slice_cursor, rows)
+            touched_days += get_company_days(slice_cursor, table_name, company_column, company)
+            refresh_summary_days(slice_cursor, table_name, touched_days, scope=(company_column, company))
+            save_watermark(slice_cursor, table_name, company, watermark, len(rows))
+            slice_cnxn.commit()
+
+        # The slice is replaced in one transaction, replayed as a whole after a transient error
+        slice_cnxn = run_batch_with_retry(None, madin_warehouse_db, load_slice, f"{table_name} shard {company}")
+        slice_cnxn.close()
+        return 1
+
+    with ThreadPoolExecutor(max_workers=get_sync_setting("sharding", "max_parallel_shards", 4)) as executor:
+        results = list(executor.map(synchronize_company, companies))
+
+    changed = sum(result for result in results if result)
+    if changed:
+        # The table changed slice by slice, the whole-table snapshot and key index are rebuilt later
+        invalidate_snapshot(table_name)
+        invalidate_key_index(table_name)
+    if None in results:
+        return False
+    print(f"{table_name}: {changed} of {len(companies)} companies reloaded.")
+    return True
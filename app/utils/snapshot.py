@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+from app.utils.config import get_sync_setting, resolve_app_path
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+# Function to get the directory holding the local table snapshots
+def get_snapshot_dir():
+    snapshot_dir = resolve_app_path(get_sync_setting("snapshot", "directory", "cache/snapshots"))
+    os.makedirs(snapshot_dir, exist_ok=True)
+    return snapshot_dir
+
+# Function to check if snapshots can be used (enabled in the settings and pyarrow installed)
+def snapshots_enabled():
+    return feather is not None and get_sync_setting("snapshot", "enabled", True)
+
+def _snapshot_paths(table_name):
+    snapshot_dir = get_snapshot_dir()
+    return (os.path.join(snapshot_dir, f"{table_name}.feather"),
+            os.path.join(snapshot_dir, f"{table_name}.json"))
+
+# Function to compute a checksum of a DataFrame (values, column names and row order)
+def compute_checksum(data):
+    digest = hashlib.sha256()
+    digest.update("|".join(str(column) for column in data.columns).encode("utf-8"))
+    if len(data) > 0:
+        digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+# Function to read the metadata (checksum, counters) stored next to a snapshot
+def load_snapshot_metadata(table_name):
+    _, metadata_path = _snapshot_paths(table_name)
+    if not os.path.exists(metadata_path):
+        return None
+    try:
+        with open(metadata_path) as file:
+            return json.load(file)
+    except Exception as e:
+        print(f"Error reading snapshot metadata for {table_name}: {e}")
+        return None
+
+def _write_snapshot_metadata(table_name, metadata):
+    _, metadata_path = _snapshot_paths(table_name)
+    temp_path = metadata_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(metadata, file)
+    os.replace(temp_path, metadata_path)
+
+# Function to save the last applied state of a table as a Feather snapshot with its checksum
+def save_snapshot(table_name, data, verified=False):
+    if not snapshots_enabled():
+        return False
+    try:
+        snapshot_path, _ = _snapshot_paths(table_name)
+        checksum = compute_checksum(data)
+        metadata = load_snapshot_metadata(table_name) or {}
+        now = datetime.now().isoformat()
+
+        # Only rewrite the Feather file when the state actually changed
+        if metadata.get("checksum") != checksum or not os.path.exists(snapshot_path):
+            temp_path = snapshot_path + ".tmp"
+            # Uncompressed so that the file can be memory-mapped on read
+            feather.write_feather(data.reset_index(drop=True), temp_path, compression="uncompressed")
+            os.replace(temp_path, snapshot_path)
+            metadata["checksum"] = checksum
+            metadata["rows"] = len(data)
+            metadata["saved_at"] = now
+
+        if verified or "verified_at" not in metadata:
+            metadata["verified_at"] = now
+            metadata["reads_since_verification"] = 0
+        _write_snapshot_metadata(table_name, metadata)
+        return True
+    except Exception as e:
+        print(f"Error saving snapshot for {table_name}: {e}")
+        return False
+
+# Function to load a table snapshot (memory-mapped), returns None if missing or corrupted
+def load_snapshot(table_name):
+    if not snapshots_enabled():
+        return None
+    snapshot_path, _ = _snapshot_paths(table_name)
+    metadata = load_snapshot_metadata(table_name)
+    if metadata is None or not os.path.exists(snapshot_path):
+        return None
+    try:
+        data = feather.read_table(snapshot_path, memory_map=True).to_pandas()
+    except Exception as e:
+        print(f"Error reading snapshot for {table_name}: {e}")
+        return None
+    if compute_checksum(data) != metadata.get("checksum"):
+        print(f"Snapshot checksum mismatch for {table_name}, ignoring snapshot.")
+        return None
+    return data
+
+# Function to check if the snapshot is due for a verification pass against the real target
+def snapshot_needs_verification(table_name):
+    metadata = load_snapshot_metadata(table_name)
+    if metadata is None or "verified_at" not in metadata:
+        return True
+    verify_every_n_syncs = get_sync_setting("snapshot", "verify_every_n_syncs", 10)
+    verify_interval_hours = get_sync_setting("snapshot", "verify_interval_hours", 24)
+    if metadata.get("reads_since_verification", 0) >= verify_every_n_syncs:
+        return True
+    verified_at = datetime.fromisoformat(metadata["verified_at"])
+    return datetime.now() - verified_at >= timedelta(hours=verify_interval_hours)
+
+def _count_snapshot_read(table_name):
+    metadata = load_snapshot_metadata(table_name)
+    if metadata is not None:
+        metadata["reads_since_verification"] = metadata.get("reads_since_verification", 0) + 1
+        _write_snapshot_metadata(table_name, metadata)
+
+# Function to get the last applied state of a table: the local snapshot when it is valid,
+# otherwise (or when a verification pass is due) the real target table
+def load_target_state(table_name, retrieve_data_from_target):
+    if not snapshot_needs_verification(table_name):
+        data = load_snapshot(table_name)
+        if data is not None:
+            _count_snapshot_read(table_name)
+            return data
+
+    print(f"Reading {table_name} from the target database to verify the snapshot.")
+    data = retrieve_data_from_target()
+    if data is not None:
+        save_snapshot(table_name, data, verified=True)
+    return data
+
+# Function to get the keys (values of key_column, made distinct by normalize) of the rows that differ
+# between a source extract and the last applied target state (added, changed or removed rows),
+# compared on row hashes. Every key of the source is returned when there is no comparable target state.
+def get_changed_keys(source_data, target_data, key_column, normalize):
+    if target_data is None or list(source_data.columns) != list(target_data.columns):
+        return normalize(source_data[key_column])
+    source_hashes = pd.util.hash_pandas_object(source_data, index=False).values
+    target_hashes = pd.util.hash_pandas_object(target_data, index=False).values
+    changed_source = source_data.loc[~np.isin(source_hashes, target_hashes), key_column]
+    changed_target = target_data.loc[~np.isin(target_hashes, source_hashes), key_column]
+    return normalize(pd.concat([changed_source, changed_target]))
+
+# Function to read the result of a query on the warehouse into a DataFrame with the given columns
+def read_frame(cursor, query, columns, params=None):
+    if params:
+        cursor.execute(query, params)
+    else:
+        cursor.execute(query)
+    return pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()], columns=columns)
+
+# Function to drop the snapshot of a table so that the next sync reads the real target
+def invalidate_snapshot(table_name):
+    for path in _snapshot_paths(table_name):
+        if os.path.exists(path):
+            os.remove(path)
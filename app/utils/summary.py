@@ -0,0 +1,248 @@
+from datetime import datetime
+
+import pandas as pd
+
+from app.utils.ddl import get_index_columns
+
+# Pre-aggregated summaries of the sales fact tables, by day and by month: date column of the fact,
+# grouping columns and summed measures. The summaries are kept up to date in the transactions
+# that change the fact rows, by recomputing only the days (and months) those rows belong to.
+SUMMARY_DESIGNS = {
+    "SALESINVOICE": {
+        "date": "dateFacture",
+        "dimensions": ["societe", "codeClient", "codeArticle", "representant", "dossier"],
+        "measures": ["quantite", "montantHT", "montantTTC", "montantPrixRevi", "marge"],
+    },
+    "SALESORDER": {
+        "date": "dateCommande",
+        "dimensions": ["societe", "codeClient", "codeArticle", "dossier"],
+        "measures": ["quantite", "montantHT", "montantTTC", "montantPrixRevi"],
+    },
+    "SDELIVERY": {
+        "date": "dateLivraison",
+        "dimensions": ["societe", "codeClient", "codeArticle", "dossier"],
+        "measures": ["quantite", "montantTTc", "MontantPrixRevi"],
+    },
+    "SALESQUOTE": {
+        "date": "dateDevis",
+        "dimensions": ["societe", "codeClient", "codeArticle", "representant", "dossier"],
+        "measures": ["quantite", "montantHT", "montantTTC"],
+    },
+}
+
+# Document-flow funnel by month, company, customer, item and folder: the quantity and amount of each
+# sales stage, read from the monthly summary of its fact table. The funnel rows of a month are
+# recomputed with the summaries of the month, whichever of the four facts changed.
+FUNNEL_TABLE = "SALES_FUNNEL"
+
+FUNNEL_DIMENSIONS = ["societe", "codeClient", "codeArticle", "dossier"]
+
+# Clustered key of the funnel: the company comes right after the month, so that the slices of
+# different companies refreshing the same months lock disjoint key ranges
+FUNNEL_CLUSTER_KEY = ["mois", "societe", "codeClient", "codeArticle"]
+
+# Fact table of each stage with its quantity and amount measures (SDELIVERY has no montantHT,
+# its montantTTc is computed on the net price like the montantHT of the other facts)
+FUNNEL_STAGES = {
+    "SALESQUOTE": {"quantity": ("quantite", "quantiteDevis"), "amount": ("montantHT", "montantDevis")},
+    "SALESORDER": {"quantity": ("quantite", "quantiteCommandee"), "amount": ("montantHT", "montantCommande")},
+    "SDELIVERY": {"quantity": ("quantite", "quantiteLivree"), "amount": ("montantTTc", "montantLivre")},
+    "SALESINVOICE": {"quantity": ("quantite", "quantiteFacturee"), "amount": ("montantHT", "montantFacture")},
+}
+
+# Number of days or months refreshed per statement (SQL Server accepts 2100 parameters)
+_REFRESH_CHUNK = 1000
+
+def _columns(columns):
+    return ", ".join(f"[{column}]" for column in columns)
+
+# Function to get the names of the daily and monthly summary tables of a fact table
+def get_summary_tables(fact_table):
+    return f"{fact_table}_SUMMARY_DAILY", f"{fact_table}_SUMMARY_MONTHLY"
+
+# Function to create the summary tables of a fact table if they do not exist, returns True if created
+def ensure_summary_tables(cursor, fact_table):
+    design = SUMMARY_DESIGNS[fact_table]
+    created = False
+    for table_name, period_column in zip(get_summary_tables(fact_table), ["jour", "mois"]):
+        if cursor.tables(table=table_name, tableType="TABLE").fetchone():
+            continue
+        dimensions = ", ".join(f"[{column}] VARCHAR({50 if column == 'dossier' else 255})" for column in design["dimensions"])
+        measures = ", ".join(f"[{column}] FLOAT" for column in design["measures"])
+        cursor.execute(f"CREATE TABLE [{table_name}] ([{period_column}] DATE, {dimensions}, nbLignes INT, {measures})")
+        cursor.execute(f"CREATE CLUSTERED INDEX [CIX_{table_name}] ON [{table_name}] ([{period_column}])")
+        created = True
+    return created
+
+# Function to normalize the date values of changed rows to the distinct days they belong to
+def _distinct_days(values):
+    days = set()
+    for value in values:
+        if value is None or pd.isna(value):
+            continue
+        days.add(value.date() if isinstance(value, datetime) else pd.Timestamp(value).date())
+    return sorted(days)
+
+def _daily_select(design, fact_table):
+    return f"""
+        SELECT [{design['date']}], {_columns(design['dimensions'])}, COUNT(*),
+               {', '.join(f"SUM([{column}])" for column in design['measures'])}
+        FROM [{fact_table}]
+    """
+
+def _monthly_select(design, daily_table):
+    return f"""
+        SELECT DATEFROMPARTS(YEAR(jour), MONTH(jour), 1), {_columns(design['dimensions'])}, SUM(nbLignes),
+               {', '.join(f"SUM([{column}])" for column in design['measures'])}
+        FROM [{daily_table}]
+    """
+
+# Function to get the measure columns of the funnel table, in stage order
+def get_funnel_measures():
+    return [column for stage in FUNNEL_STAGES.values() for _, column in (stage["quantity"], stage["amount"])]
+
+# Function to create the funnel table (and the summaries it reads) if it does not exist, returns True if created
+def ensure_funnel_table(cursor):
+    for fact_table in FUNNEL_STAGES:
+        ensure_summary_tables(cursor, fact_table)
+    if cursor.tables(table=FUNNEL_TABLE, tableType="TABLE").fetchone():
+        # Tables created with an older clustered key are rebuilt on the current one
+        if get_index_columns(cursor, FUNNEL_TABLE, f"CIX_{FUNNEL_TABLE}") != [column.lower() for column in FUNNEL_CLUSTER_KEY]:
+            cursor.execute(f"CREATE CLUSTERED INDEX [CIX_{FUNNEL_TABLE}] ON [{FUNNEL_TABLE}] ({_columns(FUNNEL_CLUSTER_KEY)}) WITH (DROP_EXISTING = ON)")
+        return False
+    dimensions = ", ".join(f"[{column}] VARCHAR({50 if column == 'dossier' else 255})" for column in FUNNEL_DIMENSIONS)
+    measures = ", ".join(f"[{column}] FLOAT" for column in get_funnel_measures())
+    cursor.execute(f"CREATE TABLE [{FUNNEL_TABLE}] (mois DATE, {dimensions}, {measures})")
+    cursor.execute(f"CREATE CLUSTERED INDEX [CIX_{FUNNEL_TABLE}] ON [{FUNNEL_TABLE}] ({_columns(FUNNEL_CLUSTER_KEY)})")
+    return True
+
+def _funnel_select():
+    measures = get_funnel_measures()
+    stages = []
+    for fact_table, stage in FUNNEL_STAGES.items():
+        _, monthly_table = get_summary_tables(fact_table)
+        stage_columns = {column: f"[{source}]" for source, column in (stage["quantity"], stage["amount"])}
+        values = ", ".join(f"{stage_columns.get(column, '0')} AS [{column}]" for column in measures)
+        stages.append(f"SELECT mois, {_columns(FUNNEL_DIMENSIONS)}, {values} FROM [{monthly_table}]")
+    union = "\n            UNION ALL ".join(stages)
+    return f"""
+        SELECT mois, {_columns(FUNNEL_DIMENSIONS)}, {', '.join(f"SUM([{column}])" for column in measures)}
+        FROM ({union}) AS stages
+    """
+
+# Function to recompute the funnel rows of the given months (months of a refreshed summary), in the caller's transaction
+def _refresh_funnel_months(cursor, months, scope_condition="", scope_params=()):
+    ensure_funnel_table(cursor)
+    insert_columns = f"mois, {_columns(FUNNEL_DIMENSIONS)}, {_columns(get_funnel_measures())}"
+    for start in range(0, len(months), _REFRESH_CHUNK):
+        chunk = months[start:start + _REFRESH_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor.execute(f"DELETE FROM [{FUNNEL_TABLE}] WHERE mois IN ({placeholders}){scope_condition}", chunk + list(scope_params))
+        cursor.execute(f"""
+            INSERT INTO [{FUNNEL_TABLE}] ({insert_columns})
+            {_funnel_select()}
+            WHERE mois IN ({placeholders}){scope_condition}
+            GROUP BY mois, {_columns(FUNNEL_DIMENSIONS)}
+        """, chunk + list(scope_params))
+
+# Function to recompute the whole funnel from the monthly summaries, in the caller's transaction
+def rebuild_funnel(cursor):
+    ensure_funnel_table(cursor)
+    cursor.execute(f"TRUNCATE TABLE [{FUNNEL_TABLE}]")
+    cursor.execute(f"""
+        INSERT INTO [{FUNNEL_TABLE}] (mois, {_columns(FUNNEL_DIMENSIONS)}, {_columns(get_funnel_measures())})
+        {_funnel_select()}
+        GROUP BY mois, {_columns(FUNNEL_DIMENSIONS)}
+    """)
+
+def _refresh_months(cursor, fact_table, months, scope_condition="", scope_params=()):
+    design = SUMMARY_DESIGNS[fact_table]
+    daily_table, monthly_table = get_summary_tables(fact_table)
+    insert_columns = f"mois, {_columns(design['dimensions'])}, nbLignes, {_columns(design['measures'])}"
+    for start in range(0, len(months), _REFRESH_CHUNK):
+        chunk = months[start:start + _REFRESH_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor.execute(f"DELETE FROM [{monthly_table}] WHERE mois IN ({placeholders}){scope_condition}", chunk + list(scope_params))
+        cursor.execute(f"""
+            INSERT INTO [{monthly_table}] ({insert_columns})
+            {_monthly_select(design, daily_table)}
+            WHERE DATEFROMPARTS(YEAR(jour), MONTH(jour), 1) IN ({placeholders}){scope_condition}
+            GROUP BY DATEFROMPARTS(YEAR(jour), MONTH(jour), 1), {_columns(design['dimensions'])}
+        """, chunk + list(scope_params))
+    if fact_table in FUNNEL_STAGES:
+        _refresh_funnel_months(cursor, months, scope_condition, scope_params)
+
+# Function to recompute the summaries of the days touched by changed fact rows (dates of the inserted
+# or deleted rows). Runs in the caller's transaction, so the summaries commit with the fact rows.
+# scope (column, value) restricts the refresh to one value of a grouping column, e.g. one company.
+def refresh_summary_days(cursor, fact_table, dates, scope=None):
+    if fact_table not in SUMMARY_DESIGNS:
+        return
+    days = _distinct_days(dates)
+    if not days:
+        return
+    ensure_summary_tables(cursor, fact_table)
+    design = SUMMARY_DESIGNS[fact_table]
+    daily_table, _ = get_summary_tables(fact_table)
+    scope_condition, scope_params = (f" AND [{scope[0]}] = ?", (scope[1],)) if scope is not None else ("", ())
+    insert_columns = f"jour, {_columns(design['dimensions'])}, nbLignes, {_columns(design['measures'])}"
+    for start in range(0, len(days), _REFRESH_CHUNK):
+        chunk = days[start:start + _REFRESH_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor.execute(f"DELETE FROM [{daily_table}] WHERE jour IN ({placeholders}){scope_condition}", chunk + list(scope_params))
+        cursor.execute(f"""
+            INSERT INTO [{daily_table}] ({insert_columns})
+            {_daily_select(design, fact_table)}
+            WHERE [{design['date']}] IN ({placeholders}){scope_condition}
+            GROUP BY [{design['date']}], {_columns(design['dimensions'])}
+        """, chunk + list(scope_params))
+    _refresh_months(cursor, fact_table, sorted({day.replace(day=1) for day in days}), scope_condition, scope_params)
+
+# Function to recompute the summaries of a date window (both dates included), in the caller's transaction
+def refresh_summary_period(cursor, fact_table, date_from, date_to):
+    if fact_table not in SUMMARY_DESIGNS:
+        return
+    ensure_summary_tables(cursor, fact_table)
+    design = SUMMARY_DESIGNS[fact_table]
+    daily_table, _ = get_summary_tables(fact_table)
+    insert_columns = f"jour, {_columns(design['dimensions'])}, nbLignes, {_columns(design['measures'])}"
+    cursor.execute(f"DELETE FROM [{daily_table}] WHERE jour >= ? AND jour <= ?", (date_from, date_to))
+    cursor.execute(f"""
+        INSERT INTO [{daily_table}] ({insert_columns})
+        {_daily_select(design, fact_table)}
+        WHERE [{design['date']}] >= ? AND [{design['date']}] <= ?
+        GROUP BY [{design['date']}], {_columns(design['dimensions'])}
+    """, (date_from, date_to))
+    months = pd.date_range(date_from.replace(day=1), date_to, freq="MS").date.tolist()
+    _refresh_months(cursor, fact_table, months)
+
+# Function to recompute the whole summaries of a fact table (after a full reload), in the caller's transaction
+def rebuild_summaries(cursor, fact_table):
+    if fact_table not in SUMMARY_DESIGNS:
+        return
+    ensure_summary_tables(cursor, fact_table)
+    design = SUMMARY_DESIGNS[fact_table]
+    daily_table, monthly_table = get_summary_tables(fact_table)
+    cursor.execute(f"TRUNCATE TABLE [{daily_table}]")
+    cursor.execute(f"""
+        INSERT INTO [{daily_table}] (jour, {_columns(design['dimensions'])}, nbLignes, {_columns(design['measures'])})
+        {_daily_select(design, fact_table)}
+        WHERE [{design['date']}] IS NOT NULL
+        GROUP BY [{design['date']}], {_columns(design['dimensions'])}
+    """)
+    cursor.execute(f"TRUNCATE TABLE [{monthly_table}]")
+    cursor.execute(f"""
+        INSERT INTO [{monthly_table}] (mois, {_columns(design['dimensions'])}, nbLignes, {_columns(design['measures'])})
+        {_monthly_select(design, daily_table)}
+        GROUP BY DATEFROMPARTS(YEAR(jour), MONTH(jour), 1), {_columns(design['dimensions'])}
+    """)
+    if fact_table in FUNNEL_STAGES:
+        rebuild_funnel(cursor)
+
+# Function to get the days of the rows of one company of a fact table (days touched when its slice is replaced)
+def get_company_days(cursor, fact_table, company_column, company):
+    if fact_table not in SUMMARY_DESIGNS:
+        return []
+    date_column = SUMMARY_DESIGNS[fact_table]["date"]
+    cursor.execute(f"SELECT DISTINCT [{date_column}] FROM [{fact_table}] WHERE [{company_column}] = ?", (company,))
+    return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,23 @@
+from app.utils.db import load_sage_x3_db_config
+from app.utils.folders import run_folder_extraction
+
+# Warehouse table fed by each MFGOPETRK time type (1 = production order time, 3 = miscellaneous time)
+TIME_TYPE_TABLES = {1: "SUIVITEMPSOF", 3: "SUIVITEMPSDIVERS"}
+
+# Function to read the time tracking lines of every time type in a single pass over MFGOPETRK,
+# in each Sage X3 folder (the folder name in a last dossier column)
+def retrieve_time_tracking_from_sagex3():
+    sagex3_db = load_sage_x3_db_config()
+    try:
+        time_types = ", ".join(str(time_type) for time_type in TIME_TYPE_TABLES)
+        source_query = f"SELECT MFGTRKNUM_0 AS numerosuivi, LEGCPY_0 AS company, CPLQTY_0 AS quantite, REJCPLQTY_0 AS quantiterejet, CPLWST_0 AS posterealise, CPLLAB_0 AS morealise, CASE WHEN TIMUOMCOD_0 = 2 THEN CPLSETTIM_0 / 60.0 ELSE CPLSETTIM_0 END AS tempsreglage, CASE WHEN TIMUOMCOD_0 = 2 THEN CPLOPETIM_0 / 60.0 ELSE CPLOPETIM_0 END AS tempsopérealise, MSGNUM_0 AS message, IPTDAT_0 AS dateimputation, TIMTYP_0 AS Time_type, TIMUOMCOD_0 AS Time_unit FROM SEED.MFGOPETRK INNER JOIN SEED.FACILITY ON FACILITY.FCY_0 = MFGFCY_0 WHERE TIMTYP_0 IN ({time_types})"
+        data = run_folder_extraction(sagex3_db, source_query, "MFGOPETRK extract")
+        return data
+    except Exception as e:
+        print(f"Error executing query: {e}")
+        return None
+
+# Function to route the time tracking lines to the warehouse table of their time type
+def split_time_tracking_by_table(data):
+    return {table_name: data[data["Time_type"] == time_type].reset_index(drop=True)
+            for time_type, table_name in TIME_TYPE_TABLES.items()}
@@ -0,0 +1,140 @@
+from datetime import datetime
+
+import pandas as pd
+
+from app.utils.db import get_connection, load_madin_warehouse_db_config
+from app.utils.snapshot import get_changed_keys, read_frame
+
+# Workstation utilisation by company, workstation and day: capacity of POSTEDECHARGE and time
+# booked in SUIVITEMPSOF (setup, run, quantities and rejects). Only the days of changed capacity
+# or tracking rows are recomputed, with pandas group-bys over the rows of those days.
+UTILISATION_TABLE = "UTILISATION_POSTE"
+
+UTILISATION_COLUMNS = ["company", "poste", "jour", "capacite", "tempsreglage", "tempsoperation",
+                       "quantite", "quantiterejet", "nbSuivis", "tauxCharge"]
+
+# Number of days recomputed per statement (SQL Server accepts 2100 parameters)
+_REFRESH_CHUNK = 1000
+
+# Function to create the utilisation table if it does not exist, returns True if created
+def ensure_utilisation_table(cursor):
+    if cursor.tables(table=UTILISATION_TABLE, tableType="TABLE").fetchone():
+        return False
+    cursor.execute(f"""
+        CREATE TABLE {UTILISATION_TABLE} (
+            company VARCHAR(50),
+            poste VARCHAR(50),
+            jour DATE,
+            capacite FLOAT,
+            tempsreglage FLOAT,
+            tempsoperation FLOAT,
+            quantite FLOAT,
+            quantiterejet FLOAT,
+            nbSuivis INT,
+            tauxCharge FLOAT
+        )
+    """)
+    cursor.execute(f"CREATE CLUSTERED INDEX CIX_{UTILISATION_TABLE} ON {UTILISATION_TABLE} (jour, poste)")
+    return True
+
+# Function to normalize date values to the distinct days they belong to
+def _distinct_days(values):
+    days = set()
+    for value in values:
+        if value is None or pd.isna(value):
+            continue
+        days.add(value.date() if isinstance(value, datetime) else pd.Timestamp(value).date())
+    return sorted(days)
+
+# Function to get the days whose rows differ between the source extract and the last applied target state
+def get_changed_days(source_data, target_data, date_column):
+    return get_changed_keys(source_data, target_data, date_column, _distinct_days)
+
+# Function to compute the utilisation rows from the capacity and tracking rows of a set of days
+def compute_utilisation(capacity, tracking):
+    capacity = capacity.assign(jour=pd.to_datetime(capacity["jour"]).dt.normalize())
+    tracking = tracking.assign(jour=pd.to_datetime(tracking["jour"]).dt.normalize())
+    capacity_by_day = capacity.groupby(["company", "poste", "jour"], as_index=False, dropna=False).agg(
+        capacite=("capacite", "sum"))
+    tracking_by_day = tracking.groupby(["company", "poste", "jour"], as_index=False, dropna=False).agg(
+        tempsreglage=("tempsreglage", "sum"),
+        tempsoperation=("tempsoperation", "sum"),
+        quantite=("quantite", "sum"),
+        quantiterejet=("quantiterejet", "sum"),
+        nbSuivis=("tempsreglage", "size"))
+    utilisation = capacity_by_day.merge(tracking_by_day, on=["company", "poste", "jour"], how="outer")
+    measures = ["tempsreglage", "tempsoperation", "quantite", "quantiterejet", "nbSuivis"]
+    utilisation[measures] = utilisation[measures].fillna(0)
+    utilisation["nbSuivis"] = utilisation["nbSuivis"].astype(int)
+    # Load in percent of the capacity, undefined on the days without capacity
+    booked = utilisation["tempsreglage"] + utilisation["tempsoperation"]
+    utilisation["tauxCharge"] = (booked / utilisation["capacite"].where(utilisation["capacite"] > 0) * 100).round(2)
+    utilisation["jour"] = utilisation["jour"].dt.date
+    utilisation = utilisation.sort_values(["jour", "poste"])[UTILISATION_COLUMNS]
+    return utilisation.astype(object).where(utilisation.notna(), None)
+
+def _write_utilisation(cursor, utilisation):
+    if utilisation.empty:
+        return
+    placeholders = ", ".join("?" for _ in UTILISATION_COLUMNS)
+    cursor.executemany(f"INSERT INTO {UTILISATION_TABLE} ({', '.join(UTILISATION_COLUMNS)}) VALUES ({placeholders})",
+                       utilisation.values.tolist())
+
+# Function to recompute the utilisation of the given days (days of new or changed tracking or
+# capacity rows). Runs in the caller's transaction, so the utilisation commits with the rows.
+def refresh_utilisation_days(cursor, dates):
+    days = _distinct_days(dates)
+    if not days:
+        return 0
+    ensure_utilisation_table(cursor)
+    rows_written = 0
+    for start in range(0, len(days), _REFRESH_CHUNK):
+        chunk = days[start:start + _REFRESH_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        capacity = read_frame(cursor, f"""
+            SELECT company, poste, dateschema, tempstheorique FROM POSTEDECHARGE
+            WHERE dateschema IN ({placeholders})
+        """, ["company", "poste", "jour", "capacite"], chunk)
+        tracking = read_frame(cursor, f"""
+            SELECT company, posterealise, CAST(dateimputation AS DATE), tempsreglage, tempsopérealise, quantite, quantiterejet
+            FROM SUIVITEMPSOF WHERE CAST(dateimputation AS DATE) IN ({placeholders})
+        """, ["company", "poste", "jour", "tempsreglage", "tempsoperation", "quantite", "quantiterejet"], chunk)
+        utilisation = compute_utilisation(capacity, tracking)
+        cursor.execute(f"DELETE FROM {UTILISATION_TABLE} WHERE jour IN ({placeholders})", chunk)
+        _write_utilisation(cursor, utilisation)
+        rows_written += len(utilisation)
+    return rows_written
+
+# Function to recompute the whole utilisation table from POSTEDECHARGE and SUIVITEMPSOF, in the caller's transaction
+def rebuild_utilisation(cursor):
+    ensure_utilisation_table(cursor)
+    capacity = read_frame(cursor, "SELECT company, poste, dateschema, tempstheorique FROM POSTEDECHARGE",
+                           ["company", "poste", "jour", "capacite"])
+    tracking = read_frame(cursor, """
+        SELECT company, posterealise, CAST(dateimputation AS DATE), tempsreglage, tempsopérealise, quantite, quantiterejet
+        FROM SUIVITEMPSOF WHERE dateimputation IS NOT NULL
+    """, ["company", "poste", "jour", "tempsreglage", "tempsoperation", "quantite", "quantiterejet"])
+    utilisation = compute_utilisation(capacity, tracking)
+    cursor.execute(f"TRUNCATE TABLE {UTILISATION_TABLE}")
+    _write_utilisation(cursor, utilisation)
+    return len(utilisation)
+
+# Function to recompute the utilisation of the given days in its own transaction (after a load
+# committed by batches, such as the POSTEDECHARGE merge)
+def refresh_utilisation(dates):
+    cnxn = get_connection(load_madin_warehouse_db_config())
+    if cnxn:
+        try:
+            cursor = cnxn.cursor()
+            rows_written = refresh_utilisation_days(cursor, dates)
+            cnxn.commit()
+            print(f"{rows_written} {UTILISATION_TABLE} rows recomputed.")
+            return True
+        except Exception as e:
+            print(f"Error refreshing {UTILISATION_TABLE}: {e}")
+            return False
+        finally:
+            cnxn.close()
+    else:
+        print("Failed to connect to the target database.")
+        return False
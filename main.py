@@ -1,9 +1,17 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from app.utils.config import get_sync_setting
+from app.utils.compression import CompressionMiddleware
 
-app = FastAPI()
+# orjson for the JSON responses, and zstd/gzip compression negotiated on every response
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(CompressionMiddleware,
+                   minimum_size=get_sync_setting("compression", "minimum_size", 1000),
+                   gzip_level=get_sync_setting("compression", "gzip_level", 6),
+                   zstd_level=get_sync_setting("compression", "zstd_level", 3))
 
 # Import and include your route definitions
-from app.routes  import customers, sales, date,company,itmmaster,salesOrder,salesDelivery,salesInvoice,salesQuote,fournisseur,porder,preceipt,Production,SuivitempsOF,Suivitempsdivers,PostdeCharge
+from app.routes  import customers, sales, date,company,itmmaster,salesOrder,salesDelivery,salesInvoice,salesQuote,fournisseur,porder,preceipt,Production,SuivitempsOF,Suivitempsdivers,PostdeCharge,monitoring,suivitemps,summary,utilisation,search,itemhierarchy,leadtime,funnel
 
 app.include_router(date.router) 
 app.include_router(customers.router) 
@@ -20,4 +28,12 @@ app.include_router(preceipt.router)
 app.include_router(Production.router)
 app.include_router(SuivitempsOF.router)
 app.include_router(Suivitempsdivers.router)
+app.include_router(suivitemps.router)
 app.include_router(PostdeCharge.router)
+app.include_router(monitoring.router)
+app.include_router(summary.router)
+app.include_router(utilisation.router)
+app.include_router(search.router)
+app.include_router(itemhierarchy.router)
+app.include_router(leadtime.router)
+app.include_router(funnel.router)
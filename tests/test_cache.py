@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+import types
+
+import pandas as pd
+import pytest
+
+import app.utils.cache as cache
+from app.utils.cache import QueryResultCache
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    values = {"ttl_seconds": 300, "max_entries": 64, "max_bytes": 536870912}
+    monkeypatch.setattr(cache, "get_sync_setting", lambda section, key, default=None: values.get(key, default))
+    return values
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def make_frame(rows=1):
+    return pd.DataFrame({"value": range(rows)})
+
+
+def get(result_cache, key, retrieve, endpoint="/sage/test"):
+    return asyncio.run(result_cache.get_or_retrieve(endpoint, key, retrieve))
+
+
+def test_entries_expire_after_the_ttl(settings, clock):
+    result_cache = QueryResultCache()
+    calls = []
+    retrieve = lambda: calls.append(1) or make_frame()
+
+    get(result_cache, "a", retrieve)
+    clock.value += 299
+    get(result_cache, "a", retrieve)
+    assert len(calls) == 1
+    clock.value += 2
+    get(result_cache, "a", retrieve)
+    assert len(calls) == 2
+    assert result_cache.get_stats()["endpoints"]["/sage/test"]["hits"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(settings, clock):
+    settings["max_entries"] = 2
+    result_cache = QueryResultCache()
+    for key in ["a", "b"]:
+        get(result_cache, key, make_frame)
+    # a is used again, b becomes the least recently used entry
+    get(result_cache, "a", lambda: pytest.fail("a should be cached"))
+    get(result_cache, "c", make_frame)
+    assert list(result_cache.entries) == ["a", "c"]
+    assert result_cache.get_stats()["endpoints"]["/sage/test"]["evictions"] == 1
+
+
+def test_entries_are_evicted_past_the_byte_bound(settings, clock):
+    size = int(make_frame(1000).memory_usage(index=True, deep=True).sum())
+    settings["max_bytes"] = size * 2
+    result_cache = QueryResultCache()
+    for key in ["a", "b", "c"]:
+        get(result_cache, key, lambda: make_frame(1000))
+    assert list(result_cache.entries) == ["b", "c"]
+    assert result_cache.get_stats()["bytes"] == size * 2
+    # Larger than the whole cache: served, not kept
+    assert len(get(result_cache, "d", lambda: make_frame(3000))) == 3000
+    assert "d" not in result_cache.entries
+
+
+def test_identical_requests_share_one_extract(settings):
+    result_cache = QueryResultCache()
+    calls = []
+    release = threading.Event()
+
+    def retrieve():
+        calls.append(1)
+        release.wait(5)
+        return make_frame(3)
+
+    async def run():
+        requests = [asyncio.ensure_future(result_cache.get_or_retrieve("/sage/test", "a", retrieve)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*requests)
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    counters = result_cache.get_stats()["endpoints"]["/sage/test"]
+    assert (counters["misses"], counters["coalesced"]) == (1, 4)
+    assert result_cache.in_flight == {}
+
+
+def test_errors_reach_every_waiting_request_and_are_not_cached(settings):
+    result_cache = QueryResultCache()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        time.sleep(0.05)
+        raise RuntimeError("extract failed")
+
+    async def run():
+        requests = [result_cache.get_or_retrieve("/sage/test", "a", failing) for _ in range(3)]
+        return await asyncio.gather(*requests, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert result_cache.entries == {} and result_cache.in_flight == {}
+    # The next request runs the extract again
+    assert len(get(result_cache, "a", make_frame)) == 1
+
+
+def test_cancelled_first_request_does_not_cancel_the_waiting_ones(settings):
+    result_cache = QueryResultCache()
+    calls = []
+
+    def retrieve():
+        calls.append(1)
+        time.sleep(0.2)
+        return make_frame(2)
+
+    async def run():
+        first = asyncio.ensure_future(result_cache.get_or_retrieve("/sage/test", "a", retrieve))
+        await asyncio.sleep(0.02)
+        second = asyncio.ensure_future(result_cache.get_or_retrieve("/sage/test", "a", retrieve))
+        await asyncio.sleep(0.02)
+        # The client of the first request disconnects
+        first.cancel()
+        data = await second
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return data
+
+    data = asyncio.run(run())
+    assert len(data) == 2
+    assert len(calls) == 1
+    # The result of the extract is kept for the next requests
+    assert get(result_cache, "a", lambda: pytest.fail("a should be cached")) is data
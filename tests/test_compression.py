@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from starlette.responses import Response, StreamingResponse
+
+from app.utils.compression import CompressionMiddleware
+
+zstandard = pytest.importorskip("zstandard")
+
+
+def call(app, accept_encoding="zstd"):
+    scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"",
+             "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    messages = []
+    requested = []
+    done = None
+
+    async def receive():
+        # The request body, then the disconnect once the response is complete
+        if not requested:
+            requested.append(True)
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            done.set()
+
+    async def run():
+        nonlocal done
+        done = asyncio.Event()
+        await app(scope, receive, send)
+
+    asyncio.run(run())
+    start = messages[0]
+    headers = {key.decode(): value.decode() for key, value in start["headers"]}
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], headers, body
+
+
+def decompress(body):
+    # The frames of a compressobj do not record the content size
+    return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+
+def make_app(content):
+    async def app(scope, receive, send):
+        await Response(content, media_type="application/json")(scope, receive, send)
+    return CompressionMiddleware(app, minimum_size=1000)
+
+
+def test_large_response_is_zstd_compressed():
+    content = b'{"value": "' + b"x" * 5000 + b'"}'
+    status, headers, body = call(make_app(content))
+    assert status == 200
+    assert headers["content-encoding"] == "zstd"
+    assert "Accept-Encoding" in headers["vary"]
+    assert int(headers["content-length"]) == len(body) < len(content)
+    assert decompress(body) == content
+
+
+def test_response_below_minimum_size_is_not_compressed():
+    content = b'{"value": 1}'
+    status, headers, body = call(make_app(content))
+    assert status == 200
+    assert "content-encoding" not in headers
+    assert int(headers["content-length"]) == len(content)
+    assert body == content
+
+
+def test_streamed_response_is_compressed_by_blocks():
+    chunks = [b"[", b'{"value": 1}', b",", b'{"value": 2}', b"]"]
+
+    async def app(scope, receive, send):
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        await StreamingResponse(stream(), media_type="application/json")(scope, receive, send)
+
+    status, headers, body = call(CompressionMiddleware(app, minimum_size=1000))
+    assert headers["content-encoding"] == "zstd"
+    assert "content-length" not in headers
+    assert decompress(body) == b"".join(chunks)
+
+
+def test_gzip_is_used_when_zstd_is_not_accepted():
+    content = b"x" * 5000
+    status, headers, body = call(make_app(content), accept_encoding="gzip")
+    assert headers["content-encoding"] == "gzip"
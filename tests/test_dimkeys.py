@@ -0,0 +1,51 @@
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from app.utils.dimkeys import DimensionKeyMap, add_dimension_keys, compute_date_keys, get_dimension_key_columns
+
+
+def test_compute_date_keys():
+    keys = compute_date_keys(np.array([datetime(2024, 3, 5, 14, 30), date(1999, 12, 31), "2020-02-29"], dtype=object))
+    assert list(keys) == [20240305, 19991231, 20200229]
+    assert all(type(key) is int for key in keys)
+
+
+def test_compute_date_keys_missing_dates_give_none():
+    keys = compute_date_keys(pd.Series([pd.Timestamp("2024-01-02"), pd.NaT, None]).to_numpy())
+    assert list(keys) == [20240102, None, None]
+
+
+def test_lookup_known_keys_and_missing_values():
+    key_map = DimensionKeyMap("customer", {"C1": 1, "C2": 2})
+    assert list(key_map.lookup(["C2", None, "C1", np.nan])) == [2, None, 1, None]
+
+
+def test_lookup_assigns_unknown_keys_once(monkeypatch):
+    key_map = DimensionKeyMap("item", {"I1": 1})
+    assigned = []
+
+    def assign(natural_keys):
+        assigned.append(list(natural_keys))
+        keys = dict(key_map.keys)
+        for natural_key in natural_keys:
+            keys[natural_key] = max(keys.values()) + 1
+        key_map._set_keys(keys)
+
+    monkeypatch.setattr(key_map, "assign", assign)
+    assert list(key_map.lookup(["I2", "I1", "I2", 3])) == [2, 1, 2, 3]
+    assert assigned == [["I2", "3"]]
+    # Known now, no second assignment
+    assert list(key_map.lookup(["I2"])) == [2]
+    assert len(assigned) == 1
+
+
+def test_add_dimension_keys_follows_the_fact_design():
+    maps = {dimension: DimensionKeyMap(dimension, keys) for dimension, keys in
+            {"customer": {}, "item": {}, "workstation": {"W1": 7}, "company": {"C1": 3}}.items()}
+    data = pd.DataFrame({"poste": ["W1"], "company": ["C1"], "dateschema": [pd.Timestamp("2024-05-06")], "tempstheorique": [7.5]})
+    result = add_dimension_keys(data, "POSTEDECHARGE", maps)
+    assert get_dimension_key_columns("POSTEDECHARGE") == ["DateKey", "workstationKey", "companyKey"]
+    assert result[["DateKey", "workstationKey", "companyKey"]].values.tolist() == [[20240506, 7, 3]]
+    assert "DateKey" not in data.columns
@@ -0,0 +1,61 @@
+import pandas as pd
+
+from app.utils.hierarchy import HIERARCHY_LEVELS, ItemHierarchy, build_hierarchy_frames, get_classification
+
+
+def make_classification(items):
+    rows = []
+    for item, groups in items.items():
+        row = {"ITMREF_0": item}
+        for level in range(HIERARCHY_LEVELS):
+            code = groups[level] if level < len(groups) else None
+            row[f"TSICOD_{level}"] = code
+            row[f"TSICOD_NAME_{level}"] = f"Group {code}" if code else None
+        rows.append(row)
+    return get_classification(pd.DataFrame(rows))
+
+
+def test_build_hierarchy_frames_nodes_and_paths():
+    nodes, paths = build_hierarchy_frames(make_classification({
+        "I1": ["A", "B"],
+        "I2": ["A", "C"],
+        "I3": ["A"],
+        "I4": ["D", "", "E"],
+    }))
+    nodes = nodes.assign(parentId=nodes["parentId"].astype(object).where(nodes["parentId"].notna(), None))
+    assert nodes.set_index("nodeId")[["parentId", "niveau", "nbArticles"]].to_dict("index") == {
+        "A": {"parentId": None, "niveau": 0, "nbArticles": 3},
+        "D": {"parentId": None, "niveau": 0, "nbArticles": 1},
+        "A/B": {"parentId": "A", "niveau": 1, "nbArticles": 1},
+        "A/C": {"parentId": "A", "niveau": 1, "nbArticles": 1},
+    }
+    # One row per item and ancestor, an item stops at its first blank group
+    assert sorted(map(tuple, paths[["ancestorId", "ITMREF_0"]].values.tolist())) == [
+        ("A", "I1"), ("A", "I2"), ("A", "I3"), ("A/B", "I1"), ("A/C", "I2"), ("D", "I4")]
+
+
+def test_codes_holding_the_separator_do_not_collide():
+    nodes, _ = build_hierarchy_frames(make_classification({"I1": ["A/B"], "I2": ["A", "B"]}))
+    assert sorted(nodes["nodeId"]) == ["A", "A%2FB", "A/B"]
+    assert nodes.set_index("nodeId").loc["A%2FB", "code"] == "A/B"
+
+
+def test_empty_classification():
+    nodes, paths = build_hierarchy_frames(make_classification({"I1": []}))
+    assert nodes.empty and paths.empty
+
+
+def test_tree_always_has_children():
+    nodes, paths = build_hierarchy_frames(make_classification({"I1": ["A", "B"], "I2": ["C"]}))
+    hierarchy = ItemHierarchy(nodes, paths, "signature")
+
+    roots = hierarchy.get_tree(depth=1)
+    assert [root["id"] for root in roots] == ["A", "C"]
+    assert [(root["children"], root["hasChildren"]) for root in roots] == [([], True), ([], False)]
+
+    full = hierarchy.get_tree()
+    assert full[0]["children"][0]["id"] == "A/B"
+    assert full[0]["children"][0]["children"] == []
+    assert hierarchy.get_tree(depth=0) == []
+    assert hierarchy.get_items("A") == ["I1"]
+    assert [node["id"] for node in hierarchy.get_level(0)] == ["A", "C"]
@@ -0,0 +1,63 @@
+from datetime import date
+
+import pandas as pd
+
+from app.utils.leadtime import LEADTIME_COLUMNS, compute_lead_times, get_changed_orders
+
+
+def make_orders(rows):
+    return pd.DataFrame(rows, columns=["dossier", "numCommande", "ligneCommande", "codeFournisseur", "codeArticle", "dateCommande", "quantite"])
+
+
+def make_receipts(rows):
+    return pd.DataFrame(rows, columns=["dossier", "numCommande", "ligneCommande", "numReception", "dateReception", "quantite"])
+
+
+def test_compute_lead_times_weighted_by_received_quantity():
+    orders = make_orders([("D1", "PO1", 1, "S1", "I1", date(2024, 1, 1), 10)])
+    receipts = make_receipts([
+        ("D1", "PO1", 1, "R1", date(2024, 1, 5), 4),
+        ("D1", "PO1", 1, "R2", date(2024, 1, 11), 6),
+    ])
+    lead_time = compute_lead_times(orders, receipts).iloc[0].to_dict()
+    assert lead_time["quantiteCommandee"] == 10
+    assert lead_time["quantiteRecue"] == 10
+    assert lead_time["nbReceptions"] == 2
+    assert lead_time["premiereReception"] == date(2024, 1, 5)
+    assert lead_time["derniereReception"] == date(2024, 1, 11)
+    assert (lead_time["delaiPremiereReception"], lead_time["delaiDerniereReception"]) == (4, 10)
+    assert lead_time["delaiMoyen"] == 7.6
+    assert lead_time["soldee"] == 1
+
+
+def test_line_without_receipts_has_no_average_lead_time():
+    orders = make_orders([
+        ("D1", "PO1", 1, "S1", "I1", date(2024, 1, 1), 10),
+        ("D1", "PO1", 2, "S1", "I2", date(2024, 1, 1), 5),
+    ])
+    receipts = make_receipts([("D1", "PO1", 1, "R1", date(2024, 1, 3), 3)])
+    lead_times = compute_lead_times(orders, receipts).set_index("ligneCommande")
+    assert lead_times.loc[2, "delaiMoyen"] is None
+    assert lead_times.loc[2, "premiereReception"] is None
+    assert lead_times.loc[2, "quantiteRecue"] == 0
+    assert lead_times.loc[2, "nbReceptions"] == 0
+    assert lead_times.loc[2, "soldee"] == 0
+    # Partly received line
+    assert lead_times.loc[1, "delaiMoyen"] == 2.0
+    assert lead_times.loc[1, "soldee"] == 0
+
+
+def test_receipts_of_unknown_lines_are_ignored():
+    orders = make_orders([("D1", "PO1", 1, "S1", "I1", date(2024, 1, 1), 1)])
+    receipts = make_receipts([("D1", "PO9", 1, "R1", date(2024, 1, 3), 1)])
+    lead_times = compute_lead_times(orders, receipts)
+    assert list(lead_times.columns) == LEADTIME_COLUMNS
+    assert len(lead_times) == 1 and lead_times.iloc[0]["nbReceptions"] == 0
+
+
+def test_get_changed_orders():
+    target = pd.DataFrame({"numCommande": ["PO1", "PO2", "PO3"], "quantite": [1, 2, 3]})
+    source = pd.DataFrame({"numCommande": ["PO1", "PO2", "PO4"], "quantite": [1, 5, 4]})
+    # PO2 changed, PO3 removed, PO4 added
+    assert get_changed_orders(source, target) == ["PO2", "PO3", "PO4"]
+    assert get_changed_orders(source, None) == ["PO1", "PO2", "PO4"]
@@ -0,0 +1,59 @@
+from app.utils.search import SearchIndex, normalize_text
+
+
+def make_index(rows):
+    index = SearchIndex("customers")
+    index.load(rows)
+    return index
+
+
+def test_normalize_text_removes_accents_case_and_punctuation():
+    assert normalize_text("  Société Générale-Épargne ") == "societe generale epargne"
+    assert normalize_text(None) == ""
+
+
+def test_exact_code_ranks_above_code_prefix():
+    index = make_index([("C1001", "Dupont"), ("C100", "Martin"), ("C1002", "Durand")])
+    results = index.search("C100")
+    assert results[0]["code"] == "C100"
+    assert results[0]["score"] == 4.0
+    assert {result["code"] for result in results[1:3]} == {"C1001", "C1002"}
+    assert all(result["score"] == 3.0 for result in results[1:3])
+
+
+def test_name_start_ranks_above_word_prefix():
+    index = make_index([("A", "Boulangerie Martin"), ("B", "Martin Boulangerie")])
+    results = index.search("mart")
+    assert [result["code"] for result in results] == ["B", "A"]
+    assert [result["score"] for result in results] == [2.0, 1.0]
+
+
+def test_fuzzy_match_finds_typos():
+    index = make_index([("A", "Transports Lefebvre"), ("B", "Garage Moreau")])
+    results = index.search("lefevbre")
+    assert results and results[0]["code"] == "A"
+    assert results[0]["score"] < 1.0
+
+
+def test_upsert_then_remove_leaves_no_orphaned_postings():
+    index = make_index([("A", "Garage Moreau")])
+    index.upsert([("B", "Transports Lefebvre"), ("A", "Garage Moreau et Fils")])
+    index.remove(["B", "A"])
+
+    assert len(index) == 0
+    assert index.word_codes == {}
+    assert index.first_word_codes == {}
+    assert index.code_codes == {}
+    assert index.trigram_codes == {}
+    assert index.sorted_words == []
+    assert index.sorted_first_words == []
+    assert index.sorted_codes == []
+    assert index.search("moreau") == []
+
+
+def test_upsert_replaces_the_old_name():
+    index = make_index([("A", "Garage Moreau")])
+    index.upsert([("A", "Transports Lefebvre")])
+    assert index.search("garage") == []
+    assert [result["code"] for result in index.search("transports")] == ["A"]
+    assert "garage" not in index.word_codes
@@ -0,0 +1,45 @@
+from datetime import date
+
+import pandas as pd
+
+from app.utils.utilisation import UTILISATION_COLUMNS, compute_utilisation, get_changed_days
+
+
+def make_capacity(rows):
+    return pd.DataFrame(rows, columns=["company", "poste", "jour", "capacite"])
+
+
+def make_tracking(rows):
+    return pd.DataFrame(rows, columns=["company", "poste", "jour", "tempsreglage", "tempsoperation", "quantite", "quantiterejet"])
+
+
+def test_compute_utilisation_sums_tracking_against_capacity():
+    capacity = make_capacity([("C1", "W1", "2024-01-02", 8.0), ("C1", "W1", "2024-01-03", 8.0)])
+    tracking = make_tracking([
+        ("C1", "W1", pd.Timestamp("2024-01-02 08:30"), 1.0, 3.0, 10, 1),
+        ("C1", "W1", pd.Timestamp("2024-01-02 14:00"), 0.0, 2.0, 5, 0),
+    ])
+    utilisation = compute_utilisation(capacity, tracking)
+    assert list(utilisation.columns) == UTILISATION_COLUMNS
+    rows = utilisation.set_index("jour").to_dict("index")
+    assert rows[date(2024, 1, 2)]["tempsoperation"] == 5.0
+    assert rows[date(2024, 1, 2)]["nbSuivis"] == 2
+    assert rows[date(2024, 1, 2)]["tauxCharge"] == 75.0
+    # A capacity day without tracking is idle
+    assert rows[date(2024, 1, 3)]["nbSuivis"] == 0
+    assert rows[date(2024, 1, 3)]["tauxCharge"] == 0.0
+
+
+def test_tracking_without_capacity_has_no_load_rate():
+    utilisation = compute_utilisation(make_capacity([]), make_tracking([("C1", "W2", "2024-01-02", 1.0, 1.0, 1, 0)]))
+    row = utilisation.iloc[0]
+    assert row["capacite"] is None
+    assert row["tauxCharge"] is None
+    assert row["nbSuivis"] == 1
+
+
+def test_get_changed_days():
+    target = pd.DataFrame({"dateschema": pd.to_datetime(["2024-01-01", "2024-01-02"]), "tempstheorique": [8.0, 8.0]})
+    source = pd.DataFrame({"dateschema": pd.to_datetime(["2024-01-01", "2024-01-02"]), "tempstheorique": [8.0, 7.0]})
+    assert get_changed_days(source, target, "dateschema") == [date(2024, 1, 2)]
+    assert get_changed_days(source, source, "dateschema") == []